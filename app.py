@@ -1,581 +1,505 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
+from werkzeug.utils import safe_join
 import cv2
 import numpy as np
 import os
 import base64
 import io
-import csv
 import argparse
-import hashlib
-import json
-from line_detector import detect_lines
+from urllib.parse import quote, urlencode
+from image_cache import ImageCache
+from batch_jobs import JobManager, JobConflictError
+from pipeline import normalize_parameters, preview_scale
+from result_store import ResultStore, default_store_path
+from tile_pyramid import TilePyramid, default_tile_dir
+from file_hash import FileHashCache, HASH_ALGORITHMS, DEFAULT_HASH_ALGORITHM, default_hash_cache_path
+from stage_timing import StageMetrics, StageTimer, timed_stage
+from image_catalog import ImageCatalog, default_catalog_path
+from csv_index import CsvIndex
+from control_store import ControlPointStore, default_control_store_path
+from controls_export import EXPORT_FORMATS, gzip_chunks
 
-def determine_orientation(line):
-    """
-    線の向き（縦/横）を判定する関数
-    """
-    rho, theta = line[0]
-    # theta が π/4 より小さいか、3π/4 より大きい場合は縦向き
-    # それ以外は横向き
-    return 'vertical' if (theta < np.pi/4 or theta > 3*np.pi/4) else 'horizontal'
+# コマンドライン引数の解析
+parser = argparse.ArgumentParser(description='地図の図郭検出パラメータ調整ツール')
+parser.add_argument('target_dir', nargs='?', default='./targets',
+                    help='処理対象の画像が格納されているディレクトリ（デフォルト: ./targets）')
+parser.add_argument('-w', '--workers', type=int, default=None,
+                    help='バッチ処理で使用する並列プロセス数（デフォルト: CPUコア数）')
+parser.add_argument('--cache-mb', type=int, default=1024,
+                    help='パラメータ調整用の画像キャッシュの上限（MB、デフォルト: 1024）')
+parser.add_argument('--result-store', default=None,
+                    help='処理結果を保存するSQLiteファイル（デフォルト: 対象ディレクトリの隣の <ディレクトリ名>.results.sqlite3）')
+parser.add_argument('--no-result-store', action='store_true',
+                    help='処理結果を保存・再利用しない')
+parser.add_argument('--hash-algorithm', choices=sorted(HASH_ALGORITHMS), default=DEFAULT_HASH_ALGORITHM,
+                    help='制御点ファイルに記録する画像のハッシュアルゴリズム（デフォルト: md5。crc32 などは高速）')
+parser.add_argument('--hash-cache', default=None,
+                    help='画像のハッシュ値を保存するSQLiteファイル（デフォルト: 対象ディレクトリの隣の <ディレクトリ名>.hashes.sqlite3）')
+parser.add_argument('--tile-dir', default=None,
+                    help='ハンディモード用のタイルの保存先（デフォルト: 対象ディレクトリの隣の <ディレクトリ名>.tiles）')
+parser.add_argument('--catalog', default=None,
+                    help='画像の索引のSQLiteファイル（デフォルト: 対象ディレクトリの隣の <ディレクトリ名>.catalog.sqlite3）')
+parser.add_argument('--recursive', action='store_true',
+                    help='サブディレクトリの画像も対象にする（画像名は対象ディレクトリからの相対パス）')
+parser.add_argument('--control-store', default=None,
+                    help='制御点を保存するSQLiteファイル（デフォルト: 対象ディレクトリの隣の <ディレクトリ名>.controls.sqlite3）')
+args = parser.parse_args()
 
-def offset_line(line, offset_percentage, image_width, image_height, orientation):
-    """
-    線をオフセットさせる関数
-    """
-    rho, theta = line[0]
-    # 画像サイズに基づいてオフセット量を計算
-    max_offset = min(image_width, image_height) * 0.3  # 最大30%までオフセット可能
-    offset_amount = max_offset * (offset_percentage / 100.0)
-
-    # 向きに応じてオフセット方向を決定
-    if orientation == 'vertical':
-        # 縦線の場合、内側に向かってオフセット
-        # 画像の中心からの距離に基づいて方向を決定
-        center_x = image_width / 2
-        line_x = rho * np.cos(theta)
-        if line_x > center_x:
-            # 右側の線は左に（内側に）オフセット
-            new_rho = rho - offset_amount
-        else:
-            # 左側の線は右に（内側に）オフセット
-            new_rho = rho + offset_amount
-    else:
-        # 横線の場合、内側に向かってオフセット
-        # 画像の中心からの距離に基づいて方向を決定
-        center_y = image_height / 2
-        line_y = rho * np.sin(theta)
-        if line_y > center_y:
-            # 下側の線は上に（内側に）オフセット
-            new_rho = rho - offset_amount
-        else:
-            # 上側の線は下に（内側に）オフセット
-            new_rho = rho + offset_amount
+# グローバル変数として設定
+TARGETS_DIR = args.target_dir
+WORKERS = args.workers
 
-    return np.array([[new_rho, theta]])
+app = Flask(__name__)
+CORS(app)
 
-def draw_line_full_extent(image, line, color, thickness=3):
-    """
-    線を画像の端から端まで描画する関数
-    元の描画方法を使用して、十分に長い線を描画
-    """
-    rho, theta = line[0]
-    a = np.cos(theta)
-    b = np.sin(theta)
-    x0 = a * rho
-    y0 = b * rho
-
-    # 元の方法を使用：十分に長い線を描画
-    # 画像サイズに関係なく、十分に長い線を描画することで
-    # 画像の境界で自然に切り取られる
-    extension = 20000  # 十分に大きな値
-    x1 = int(x0 + extension * (-b))
-    y1 = int(y0 + extension * (a))
-    x2 = int(x0 - extension * (-b))
-    y2 = int(y0 - extension * (a))
-
-    cv2.line(image, (x1, y1), (x2, y2), color, thickness)
-
-def calculate_representative_lines(line_groups, lines):
-    """
-    各グループの代表線を計算する関数
-    グループ内の全ての線のrhoとthetaの平均を取る
-    """
-    representative_lines = []
+# バッチ処理ジョブの管理
+job_manager = JobManager()
 
-    for group in line_groups:
-        if not group:  # 空のグループをスキップ
-            continue
+# デコード・前処理結果のキャッシュ
+image_cache = ImageCache(max_bytes=args.cache_mb * 1024 * 1024)
 
-        # グループ内の全ての線のrhoとthetaを集める
-        rhos = []
-        thetas = []
-        for line_idx in group:
-            rho, theta = lines[line_idx][0]
-            rhos.append(rho)
-            thetas.append(theta)
+# 画像の内容とパラメータごとの処理結果のストア（再起動後も再利用する）
+RESULT_STORE_PATH = None if args.no_result_store else (args.result_store or default_store_path(TARGETS_DIR))
+result_store = ResultStore(RESULT_STORE_PATH) if RESULT_STORE_PATH else None
 
-        # 平均を計算
-        avg_rho = sum(rhos) / len(rhos)
-        avg_theta = sum(thetas) / len(thetas)
+# 制御点の画像変更チェックに使うハッシュ値のキャッシュ（変更されていない画像は再度読み込まない）
+HASH_ALGORITHM = args.hash_algorithm
+hash_cache = FileHashCache(args.hash_cache or default_hash_cache_path(TARGETS_DIR))
 
-        representative_lines.append(np.array([[avg_rho, avg_theta]]))
+# ハンディモードで表示するタイル（要求されたときに生成してディスクにキャッシュする）
+tile_pyramid = TilePyramid(args.tile_dir or default_tile_dir(TARGETS_DIR), image_cache,
+                           root_dir=TARGETS_DIR)
 
-    return representative_lines
+# 制御点のストア（初回の起動時に以前の形式の制御点ファイル <画像ファイル名>.controls.geojson を取り込む）
+control_store = ControlPointStore(args.control_store or default_control_store_path(TARGETS_DIR))
+if not control_store.geojson_imported():
+    control_store.import_geojson(TARGETS_DIR, recursive=args.recursive)
 
-def compute_intersection(line1, line2):
-    """
-    2つの線の交点を計算する関数
-    line1, line2: [rho, theta] 形式の線のパラメータ
-    """
-    rho1, theta1 = line1
-    rho2, theta2 = line2
+# 画像の一覧・制御点の有無の索引（ディレクトリの更新時刻を見て差分で更新する）
+image_catalog = ImageCatalog(TARGETS_DIR, args.catalog or default_catalog_path(TARGETS_DIR),
+                             recursive=args.recursive, control_store=control_store)
 
-    # 平行線の場合は交点なし
-    if abs(theta1 - theta2) < 1e-10 or abs(abs(theta1 - theta2) - np.pi) < 1e-10:
-        return None
+# /api/process とバッチ処理の段階ごとの処理時間の集計（/api/metrics で出力）
+stage_metrics = StageMetrics()
 
-    # 線の方程式の係数を計算
-    a1 = np.cos(theta1)
-    b1 = np.sin(theta1)
-    a2 = np.cos(theta2)
-    b2 = np.sin(theta2)
+# バッチ処理の結果を書き出す交点CSVと、その索引（プレビューのページ送りと画像ごとの結果の絞り込みに使う）
+INTERSECTIONS_CSV = 'intersections.csv'
+csv_index = CsvIndex(INTERSECTIONS_CSV, status_store=image_catalog)
 
-    # 連立方程式を解いて交点を計算
-    det = a1 * b2 - a2 * b1
-    if abs(det) < 1e-10:  # 行列式がほぼ0なら平行
-        return None
+# 一覧のページの件数の上限
+MAX_PAGE_SIZE = 1000
 
-    x = (b2 * rho1 - b1 * rho2) / det
-    y = (-a2 * rho1 + a1 * rho2) / det
+# 全制御点を書き出す際に、索引から一度に読む件数
+IMAGE_SCAN_CHUNK = 500
 
-    return (int(x), int(y))
+# バージョン付きURLで配信する画像ファイル・タイルのキャッシュ期間（秒）
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
 
-def calculate_intersections(line_groups, lines):
+# プレビュー画像の形式（形式名 -> (拡張子, 品質を指定するフラグ, MIMEタイプ)）
+PREVIEW_FORMATS = {
+    'jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 'image/jpeg'),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY, 'image/webp'),
+}
+DEFAULT_PREVIEW_QUALITY = 95  # cv2.imencode のJPEGのデフォルトと同じ
+
+def parse_preview_options(options):
     """
-    グループ化された線同士の交点を計算する関数
+    プレビュー画像の指定（max_dimension: 長辺の画素数、format: jpeg / webp、quality: 1-100）を
+    検証して (max_dimension, format, quality) を返す。不正な値の場合は ValueError を送出する
+    max_dimension を省略した場合は元の解像度のまま
     """
-    # 各グループの代表線を計算
-    representative_lines = calculate_representative_lines(line_groups, lines)
-
-    intersections = []
-    # 全ての代表線の組み合わせについて交点を計算
-    for i, line1 in enumerate(representative_lines):
-        for j, line2 in enumerate(representative_lines):
-            if i < j:  # 重複を避けるため、i < j の組み合わせのみ処理
-                intersection = compute_intersection(line1[0], line2[0])
-                if intersection:
-                    intersections.append(intersection)
+    options = options or {}
+    max_dimension = options.get('max_dimension')
+    if max_dimension is not None:
+        max_dimension = int(max_dimension)
+        if max_dimension <= 0:
+            raise ValueError('max_dimension は1以上を指定してください')
+    image_format = options.get('format') or 'jpeg'
+    if image_format not in PREVIEW_FORMATS:
+        raise ValueError(f'未対応のプレビュー形式です: {image_format}')
+    quality = int(options.get('quality') or DEFAULT_PREVIEW_QUALITY)
+    if not 1 <= quality <= 100:
+        raise ValueError('quality は1から100の範囲で指定してください')
+    return max_dimension, image_format, quality
+
+@timed_stage('encode')
+def encode_preview(image, image_format, quality):
+    """画像を指定した形式でエンコードし、(MIMEタイプ, バイト列) を返す"""
+    extension, quality_flag, mimetype = PREVIEW_FORMATS[image_format]
+    ok, buffer = cv2.imencode(extension, image, [quality_flag, quality])
+    if not ok:
+        raise ValueError(f'画像のエンコードに失敗しました: {image_format}')
+    return mimetype, buffer.tobytes()
+
+def image_file_path(image_name):
+    """
+    画像名（対象ディレクトリからの相対パス）に対応するファイルのパス
+    対象ディレクトリの外を指す画像名の場合は None
+    """
+    if not image_name:
+        return None
+    return safe_join(TARGETS_DIR, image_name)
 
-    return intersections
+def parse_page_size(value, default):
+    """ページの件数の指定を検証する（1から MAX_PAGE_SIZE。不正な値の場合は ValueError）"""
+    if value is None or value == '':
+        return default
+    limit = int(value)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit は1から{MAX_PAGE_SIZE}の範囲で指定してください')
+    return limit
 
-def group_similar_lines(lines):
+@app.route('/api/images', methods=['GET'])
+def get_images():
     """
-    類似した直線をグループ化する関数
-    corner_getter.pyのロジックを参考にした実装
+    サンプル画像のリストを取得
+    limit を指定した場合はその件数ずつ返し、次のページは cursor に next_cursor を指定して取得する
+    prefix: 画像名の先頭、controls: present / missing（制御点の有無）、
+    status: success / error / unprocessed（交点CSVの処理結果）で絞り込める
+    details=true の場合は items に画像ごとの情報（大きさ・制御点の有無・処理結果など）を含める
     """
-    if lines is None or len(lines) == 0:
-        return []
-
-    # 近接する直線の組み合わせを取得
-    deletion_indexes = []
-    for i, line1 in enumerate(lines):
-        for j, line2 in enumerate(lines):
-            if i != j:
-                rho1, theta1 = line1[0]
-                rho2, theta2 = line2[0]
-                # rhoの差が500以内かつthetaの差がπ/18以内の時に近接していると定義
-                if abs(rho1 - rho2) < 500 and abs(theta1 - theta2) < np.pi/18:
-                    deletion_indexes.append([i, j])
-
-    # 近接する直線を近接グループに分ける
-    merged_indexes = []
-    for deletion_set in deletion_indexes:
-        merged = False
-        for i, merged_set in enumerate(merged_indexes):
-            if set(deletion_set).intersection(set(merged_set)):
-                merged_indexes[i] = list(set(merged_indexes[i] + deletion_set))
-                merged = True
-                break
-        if not merged:
-            merged_indexes.append(deletion_set)
-
-    # 各グループの重複を除去
-    index_groups = [list(set(group)) for group in merged_indexes]
-
-    # グループ化された直線のインデックスを取得
-    grouped_indexes = set()
-    for group in index_groups:
-        grouped_indexes.update(group)
-
-    # 独立した直線（グループに属さない直線）を追加
-    independent_lines = []
-    for i in range(len(lines)):
-        if i not in grouped_indexes:
-            independent_lines.append([i])
-
-    # 全てのグループを結合
-    all_groups = index_groups + independent_lines
-
-    return all_groups
+    try:
+        limit = parse_page_size(request.args.get('limit'), None)
+        controls = request.args.get('controls') or None
+        if controls not in (None, 'present', 'missing'):
+            raise ValueError(f'controls は present または missing を指定してください: {controls}')
+        status = request.args.get('status') or None
+        if status not in (None, 'success', 'error', 'unprocessed'):
+            raise ValueError(f'status は success・error・unprocessed のいずれかを指定してください: {status}')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    prefix = request.args.get('prefix') or None
+    cursor = request.args.get('cursor') or None
+    has_controls = None if controls is None else controls == 'present'
+    details = request.args.get('details') == 'true'
 
-# コマンドライン引数の解析
-parser = argparse.ArgumentParser(description='地図の図郭検出パラメータ調整ツール')
-parser.add_argument('target_dir', nargs='?', default='./targets',
-                    help='処理対象の画像が格納されているディレクトリ（デフォルト: ./targets）')
-args = parser.parse_args()
+    try:
+        if status is not None or details:
+            # 追記された交点CSVの処理結果を画像の索引に反映する
+            csv_index.load()
+        # 次のページがあるかどうかの判定に1件多く読む
+        images = image_catalog.list_images(prefix, has_controls, cursor,
+                                           limit + 1 if limit is not None else None, status=status)
+        next_cursor = None
+        if limit is not None and len(images) > limit:
+            images = images[:limit]
+            next_cursor = images[-1]['name']
+        total = image_catalog.count(prefix, has_controls, status)
+        response = {
+            'images': [item['name'] for item in images],
+            'next_cursor': next_cursor,
+            'total': total,
+        }
+        if details:
+            response['items'] = images
+        return jsonify(response)
 
-# グローバル変数として設定
-TARGETS_DIR = args.target_dir
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-app = Flask(__name__)
-CORS(app)
-
-@app.route('/api/images', methods=['GET'])
-def get_images():
-    """サンプル画像のリストを取得"""
-    images = []
-    if os.path.exists(TARGETS_DIR):
-        for file in os.listdir(TARGETS_DIR):
-            if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                images.append(file)
-    return jsonify({'images': sorted(images)})
+def timings_field(data, timer):
+    """timings: true が指定された場合にレスポンスに含める段階ごとの処理時間"""
+    return {'timings': timer.to_dict()} if data.get('timings') else {}
 
 @app.route('/api/process', methods=['POST'])
 def process_image():
-    """画像処理を実行"""
+    """
+    画像処理を実行
+    段階ごとの処理時間は Server-Timing ヘッダーで返し、/api/metrics のヒストグラムに集計する
+    trace_allocations: true の場合は段階ごとのメモリ割り当て量も計測する（timings に含める）
+    """
+    options = request.get_json(silent=True) or {}
+    with StageTimer(trace_allocations=bool(options.get('trace_allocations'))) as timer:
+        response = app.make_response(run_process_image(timer))
+    stage_metrics.observe('process', timer.to_dict())
+    response.headers['Server-Timing'] = timer.server_timing()
+    return response
+
+def run_process_image(timer):
+    """/api/process の処理本体（timings: true の場合は段階ごとの処理時間を timings として含める）"""
     try:
         data = request.json
         image_name = data.get('image_name')
-        params = data.get('parameters', {})
 
         # パラメータの取得（デフォルト値を設定）
-        binary_threshold = params.get('binary_threshold', 100)
-        erode_kernel = params.get('erode_kernel', 3)
-        erode_iteration = params.get('erode_iteration', 2)
-        line_accumulation = params.get('line_accumulation', 10000)
-        rho_precision = params.get('rho_precision', 2)
-        theta_precision = params.get('theta_precision', np.pi/90)
-        line_offset = params.get('line_offset', 0)  # デフォルト値は0（オフセットなし）
+        params = normalize_parameters(data.get('parameters', {}))
+
+        # 結果画像の大きさと形式（省略時は元の解像度のJPEG）
+        try:
+            max_dimension, image_format, quality = parse_preview_options(data.get('preview'))
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+
+        # image: 線と交点を描画した画像を返す / vector: 描画する内容だけを返す（json または float32）
+        mode = data.get('mode') or 'image'
+        vector_format = data.get('vector_format') or 'json'
+        if mode not in ('image', 'vector') or vector_format not in ('json', 'float32'):
+            return jsonify({'error': f'未対応のモードです: {mode} / {vector_format}'}), 400
 
         # 画像パスの構築
-        image_path = os.path.join(TARGETS_DIR, image_name)
+        image_path = image_file_path(image_name)
 
-        if not os.path.exists(image_path):
+        if image_path is None or not os.path.exists(image_path):
             return jsonify({'error': 'Image not found'}), 404
 
-        # 画像を読み込み
-        original_image = cv2.imread(image_path)
-        if original_image is None:
+        # 同じ画像・パラメータの結果が保存されていれば直線検出を行わずに使う
+        digest = result = None
+        if result_store:
+            with timed_stage('hash'):
+                digest = result_store.content_hash(image_path)
+            with timed_stage('result_store'):
+                result = result_store.get(digest, params)
+
+        # 画像ごとのパイプラインを取得（デコード結果と各段階の結果は再利用する）
+        # 保存した結果を vector モードで返す場合は画素を使わないため、画像をデコードしない
+        image_size = None
+        if result is not None and mode == 'vector':
+            image_size = result.get('image_size')
+        pipeline = image_cache.pipeline(image_path, image_size=image_size)
+        if pipeline is None:
             return jsonify({'error': 'Failed to load image'}), 400
 
-        # detect_lines関数を実行
-        lines = detect_lines(
-            image_path,
-            binary_threshold=binary_threshold,
-            erode_kernel=erode_kernel,
-            erode_iteration=erode_iteration,
-            line_accumulation=line_accumulation,
-            rho_precision=rho_precision,
-            theta_precision=theta_precision
-        )
-
-        # 結果画像を作成（元の画像に線を重ねる）
-        result_image = original_image.copy()
-
-        if lines is not None:
-            # 直線をグループ化する
-            line_groups = group_similar_lines(lines)
-
-            # グループ数が10を超える場合はエラーを返す
-            if len(line_groups) > 10:
-                return jsonify({
-                    'error': 'グループ数が多すぎます（最大10個まで）。パラメータを調整してグループ数を減らしてください。',
-                    'groups_count': len(line_groups)
-                }), 400  # Bad Request ステータスコード
-
-            # グループごとに異なる色で描画
-            colors = [
-                (0, 0, 255),    # 赤
-                (0, 255, 0),    # 緑
-                (255, 0, 0),    # 青
-                (0, 255, 255),  # 黄
-                (255, 0, 255),  # マゼンタ
-                (255, 255, 0),  # シアン
-                (128, 0, 128),  # 紫
-                (255, 165, 0),  # オレンジ
-            ]
-
-            # 画像サイズを取得
-            image_height, image_width = result_image.shape[:2]
-
-            for group_idx, group in enumerate(line_groups):
-                color = colors[group_idx % len(colors)]
-                for line_idx in group:
-                    line = lines[line_idx]
-
-                    # オフセット処理を適用
-                    if line_offset > 0:
-                        orientation = determine_orientation(line)
-                        line = offset_line(line, line_offset, image_width, image_height, orientation)
-
-                    # 線を画像の端から端まで描画
-                    draw_line_full_extent(result_image, line, color, 3)
-
-            # オフセットが適用された線の代表線を計算して交点を求める
-            offset_representative_lines = []
-            for group in line_groups:
-                if not group:  # 空のグループをスキップ
-                    continue
-
-                # グループ内の全ての線のrhoとthetaを集める（オフセット適用後）
-                rhos = []
-                thetas = []
-                for line_idx in group:
-                    line = lines[line_idx]
-
-                    # オフセット処理を適用
-                    if line_offset > 0:
-                        orientation = determine_orientation(line)
-                        line = offset_line(line, line_offset, image_width, image_height, orientation)
-
-                    rho, theta = line[0]
-                    rhos.append(rho)
-                    thetas.append(theta)
-
-                # 平均を計算
-                avg_rho = sum(rhos) / len(rhos)
-                avg_theta = sum(thetas) / len(thetas)
-
-                offset_representative_lines.append(np.array([[avg_rho, avg_theta]]))
-
-            # オフセット適用後の代表線同士の交点を計算
-            intersections = []
-            for i, line1 in enumerate(offset_representative_lines):
-                for j, line2 in enumerate(offset_representative_lines):
-                    if i < j:  # 重複を避けるため、i < j の組み合わせのみ処理
-                        intersection = compute_intersection(line1[0], line2[0])
-                        if intersection:
-                            intersections.append(intersection)
-
-            # 交点を画像上に描画
-            for point in intersections:
-                # 交点が画像の範囲内にある場合のみ描画
-                if 0 <= point[0] < image_width and 0 <= point[1] < image_height:
-                    cv2.circle(result_image, point, 10, (255, 255, 255), -1)  # 白い円で交点を描画
-                    cv2.circle(result_image, point, 10, (0, 0, 0), 2)  # 黒い輪郭線
-
-        # 画像をbase64エンコード
-        _, buffer = cv2.imencode('.jpg', result_image)
-        img_base64 = base64.b64encode(buffer).decode('utf-8')
+        if result is not None:
+            pipeline.restore(params, result)
+        else:
+            result = pipeline.summary(params)
+            if result_store:
+                with timed_stage('result_store'):
+                    result_store.put(digest, params, result)
+
+        lines = result['lines']
+        line_groups = result['groups']
+        intersections = result['intersections']
+
+        # グループ数が10を超える場合はエラーを返す
+        if 'groups_count' in result['error_details']:
+            return jsonify({
+                'error': 'グループ数が多すぎます（最大10個まで）。パラメータを調整してグループ数を減らしてください。',
+                'groups_count': result['error_details']['groups_count']
+            }), 400  # Bad Request ステータスコード
+
+        if mode == 'vector':
+            return vector_overlay_response(
+                pipeline, params, image_name, image_path,
+                (max_dimension, image_format, quality), vector_format,
+                timer if data.get('timings') else None)
+
+        # 結果画像を作成（元の画像、または縮小したプレビューに線と交点を重ねる）
+        result_image = pipeline.render(params, max_dimension)
+
+        # 画像をエンコードしてbase64に変換
+        mimetype, encoded = encode_preview(result_image, image_format, quality)
+        with timed_stage('base64'):
+            img_base64 = base64.b64encode(encoded).decode('utf-8')
 
         return jsonify({
             'success': True,
-            'image': f'data:image/jpeg;base64,{img_base64}',
+            'image': f'data:{mimetype};base64,{img_base64}',
+            'image_width': pipeline.image.width,
+            'image_height': pipeline.image.height,
+            'preview_width': result_image.shape[1],
+            'preview_height': result_image.shape[0],
             'lines_count': len(lines) if lines is not None else 0,
-            'groups_count': len(line_groups) if lines is not None else 0,
-            'intersections_count': len(intersections) if lines is not None else 0
+            'groups_count': len(line_groups),
+            'intersections_count': len(intersections),
+            **timings_field(data, timer),
         })
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def vector_overlay_response(pipeline, params, image_name, image_path, preview_options, vector_format,
+                            timer=None):
+    """
+    /api/process の vector モードのレスポンス
+    画像の描画・エンコードは行わず、オフセット適用後の直線・グループ番号・代表線・交点（元の画像の座標）と、
+    下地にする線なしのプレビュー画像のURLを返す
+    float32 の場合は [幅, 高さ, 直線数N, 代表線数M, 交点数K, (rho, theta, グループ番号)×N,
+    (rho, theta)×M, (x, y)×K] のリトルエンディアンの float32 の配列を返す
+    timer を指定した場合は json の timings に段階ごとの処理時間を含める
+    """
+    overlay = pipeline.overlay(params)
+    width, height = pipeline.image.width, pipeline.image.height
+    lines, line_groups = overlay['lines'], overlay['line_groups']
+    representative_lines, intersections = overlay['representative_lines'], overlay['intersections']
+
+    if vector_format == 'float32':
+        header = np.array([width, height, len(lines), len(representative_lines), len(intersections)])
+        body = np.concatenate([
+            header,
+            np.column_stack([lines, line_groups]).ravel(),
+            representative_lines.ravel(),
+            intersections.ravel(),
+        ]).astype('<f4')
+        return app.response_class(body.tobytes(), mimetype='application/octet-stream')
+
+    max_dimension, image_format, quality = preview_options
+    scale = preview_scale(width, height, max_dimension)
+    query = {'format': image_format, 'quality': quality, 'v': image_version(image_path)}
+    if scale != 1.0:
+        query['max_dimension'] = max_dimension
+    return jsonify({
+        'success': True,
+        'image_width': width,
+        'image_height': height,
+        'preview_url': f"/api/image/{quote(image_name)}/preview?{urlencode(query)}",
+        'preview_width': max(1, round(width * scale)),
+        'preview_height': max(1, round(height * scale)),
+        'lines': np.round(lines.astype(np.float64), 4).tolist(),
+        'line_groups': line_groups.tolist(),
+        'representative_lines': np.round(representative_lines.astype(np.float64), 4).tolist(),
+        'intersections': intersections.tolist(),
+        'lines_count': len(lines),
+        'groups_count': len(pipeline.groups(params)),
+        'intersections_count': len(pipeline.intersections(params)),
+        **({'timings': timer.to_dict()} if timer is not None else {}),
+    })
+
+@app.route('/api/cache', methods=['GET'])
+def get_cache_stats():
+    """画像キャッシュの使用状況を取得"""
+    stats = image_cache.stats()
+    if result_store:
+        stats['result_store'] = result_store.stats()
+    stats['hash_cache'] = hash_cache.stats()
+    stats['image_catalog'] = image_catalog.stats()
+    stats['control_store'] = control_store.stats()
+    return jsonify({'success': True, **stats})
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """/api/process とバッチ処理の段階ごとの処理時間のヒストグラム（Prometheus のテキスト形式）"""
+    return app.response_class(stage_metrics.prometheus(),
+                              content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/process-all', methods=['POST'])
 def process_all_images():
-    """すべての画像の交点を計算してCSVとして出力"""
+    """すべての画像の交点を計算するジョブを開始（結果はCSVに順次書き出す）"""
     try:
         data = request.json
         params = data.get('parameters', {})
-
-        # パラメータの取得（デフォルト値を設定）
-        binary_threshold = params.get('binary_threshold', 100)
-        erode_kernel = params.get('erode_kernel', 3)
-        erode_iteration = params.get('erode_iteration', 2)
-        line_accumulation = params.get('line_accumulation', 10000)
-        rho_precision = params.get('rho_precision', 2)
-        theta_precision = params.get('theta_precision', np.pi/90)
-        line_offset = params.get('line_offset', 0)
-
-        # 画像リストを取得
-        images = []
-        if os.path.exists(TARGETS_DIR):
-            for file in os.listdir(TARGETS_DIR):
-                if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    images.append(file)
-
-        # 結果を格納するリスト
-        results = []
-
-        # 各画像に対して処理を実行
-        for image_name in images:
-            try:
-                image_path = os.path.join(TARGETS_DIR, image_name)
-
-                # 画像を読み込み
-                original_image = cv2.imread(image_path)
-                if original_image is None:
-                    # 画像読み込みエラー
-                    result = [image_name] + [''] * 8 + ['画像の読み込みに失敗しました']
-                    results.append(result)
-                    continue
-
-                # 画像サイズを取得
-                image_height, image_width = original_image.shape[:2]
-
-                # 線を検出
-                lines = detect_lines(
-                    image_path,
-                    binary_threshold=binary_threshold,
-                    erode_kernel=erode_kernel,
-                    erode_iteration=erode_iteration,
-                    line_accumulation=line_accumulation,
-                    rho_precision=rho_precision,
-                    theta_precision=theta_precision
-                )
-
-                if lines is None or len(lines) == 0:
-                    # 線が検出されなかった
-                    result = [image_name] + [''] * 8 + ['線が検出されませんでした']
-                    results.append(result)
-                    continue
-
-                # 直線をグループ化
-                line_groups = group_similar_lines(lines)
-
-                if len(line_groups) > 10:
-                    # グループ数が多すぎる
-                    result = [image_name] + [''] * 8 + [f'グループ数が多すぎます（{len(line_groups)}個）']
-                    results.append(result)
-                    continue
-
-                # オフセット適用後の代表線を計算
-                offset_representative_lines = []
-                for group in line_groups:
-                    if not group:  # 空のグループをスキップ
-                        continue
-
-                    # グループ内の全ての線のrhoとthetaを集める（オフセット適用後）
-                    rhos = []
-                    thetas = []
-                    for line_idx in group:
-                        line = lines[line_idx]
-
-                        # オフセット処理を適用
-                        if line_offset > 0:
-                            orientation = determine_orientation(line)
-                            line = offset_line(line, line_offset, image_width, image_height, orientation)
-
-                        rho, theta = line[0]
-                        rhos.append(rho)
-                        thetas.append(theta)
-
-                    # 平均を計算
-                    avg_rho = sum(rhos) / len(rhos)
-                    avg_theta = sum(thetas) / len(thetas)
-
-                    offset_representative_lines.append(np.array([[avg_rho, avg_theta]]))
-
-                # 交点を計算
-                intersections = []
-                for i, line1 in enumerate(offset_representative_lines):
-                    for j, line2 in enumerate(offset_representative_lines):
-                        if i < j:  # 重複を避けるため、i < j の組み合わせのみ処理
-                            intersection = compute_intersection(line1[0], line2[0])
-                            if intersection:
-                                intersections.append(intersection)
-
-                if len(intersections) != 4:
-                    # 交点が4つでない
-                    result = [image_name] + [''] * 8 + [f'交点が4つではありません（{len(intersections)}個）']
-                    results.append(result)
-                    continue
-
-                # 交点を左上、右上、左下、右下の順に並べ替え
-                x_coords = [p[0] for p in intersections]
-                y_coords = [p[1] for p in intersections]
-                x_avg = sum(x_coords) / 4
-                y_avg = sum(y_coords) / 4
-
-                sorted_intersections = [None] * 4
-                for point in intersections:
-                    x, y = point
-                    if x < x_avg and y < y_avg:  # 左上
-                        sorted_intersections[0] = point
-                    elif x > x_avg and y < y_avg:  # 右上
-                        sorted_intersections[1] = point
-                    elif x < x_avg and y > y_avg:  # 左下
-                        sorted_intersections[2] = point
-                    else:  # 右下
-                        sorted_intersections[3] = point
-
-                # Noneがある場合（並べ替えに失敗した場合）
-                if None in sorted_intersections:
-                    result = [image_name] + [''] * 8 + ['交点の並べ替えに失敗しました']
-                    results.append(result)
-                    continue
-
-                # 結果をリストに追加（成功）
-                result = [image_name]
-                for point in sorted_intersections:
-                    result.extend(point)
-                result.append('')  # エラーなし
-                results.append(result)
-
-            except Exception as e:
-                # 処理中に例外が発生した場合
-                result = [image_name] + [''] * 8 + [f'処理中にエラーが発生しました: {str(e)}']
-                results.append(result)
-
-        # CSVファイルを作成
-        csv_path = 'intersections.csv'
-        with open(csv_path, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            # ヘッダーを書き込み
-            writer.writerow(['画像ファイル名', 'x0', 'y0', 'x1', 'y1', 'x2', 'y2', 'x3', 'y3', 'error'])
-            # データを書き込み
-            writer.writerows(results)
-
-        # 成功と失敗の数をカウント
-        success_count = sum(1 for result in results if result[-1] == '')
+        # 前回のCSVのうち、画像とパラメータが変わっていない成功行を再利用する
+        resume = bool(data.get('resume', False))
+
+        # 画像リストを取得（出力順を一定にするためファイル名順に並べる）
+        images = image_catalog.names()
+
+        # ジョブを登録し、完了を待たずにジョブIDを返す
+        csv_path = INTERSECTIONS_CSV
+        try:
+            job = job_manager.submit(TARGETS_DIR, images, params, csv_path, workers=WORKERS,
+                                     resume=resume, result_store_path=RESULT_STORE_PATH,
+                                     metrics=stage_metrics)
+        except JobConflictError as e:
+            return jsonify({
+                'error': '実行中のバッチ処理があります。完了またはキャンセルしてから再実行してください。',
+                'job_id': str(e)
+            }), 409
 
         return jsonify({
             'success': True,
-            'message': f'全{len(results)}個の画像を処理し、うち{success_count}画像の交点を計算しました。CSVファイルに保存しました。',
+            'job_id': job.job_id,
+            'status_url': f'/api/jobs/{job.job_id}',
+            'total': job.total,
             'csv_path': csv_path
-        })
+        }), 202
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """バッチジョブの進捗を取得"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'success': True, **job.to_dict()})
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """バッチジョブをキャンセル"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job.cancel()
+    return jsonify({'success': True, **job.to_dict()})
+
 @app.route('/api/csv-preview', methods=['GET'])
 def get_csv_preview():
-    """CSVファイルのプレビューを取得"""
+    """
+    CSVファイルのプレビューを取得（デフォルトは先頭の100行）
+    CSV全体は読み込まず、索引（行数・行の位置）を使って必要な行だけを読む
+    limit: 行数、offset: 先頭からの行番号、cursor: 前回の next_cursor（続きの行。不正な値・CSVが作り直された場合は400）、
+    status: success / error、prefix: 画像ファイル名の先頭 で絞り込める
+    """
     try:
-        csv_path = 'intersections.csv'
-        if not os.path.exists(csv_path):
-            return jsonify({'error': 'CSVファイルが見つかりません'}), 404
+        limit = parse_page_size(request.args.get('limit'), 100)
+        offset = int(request.args.get('offset') or 0)
+        cursor = request.args.get('cursor') or None
+        if offset < 0:
+            raise ValueError('offset は0以上を指定してください')
+        status = request.args.get('status') or None
+        if status not in (None, 'success', 'error'):
+            raise ValueError(f'status は success または error を指定してください: {status}')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    prefix = request.args.get('prefix') or None
 
-        # CSVファイルを読み込み
-        with open(csv_path, 'r', encoding='utf-8') as csvfile:
-            reader = csv.reader(csvfile)
-            rows = list(reader)
+    try:
+        index = csv_index.load()
+        if index is None:
+            return jsonify({'error': 'CSVファイルが見つかりません'}), 404
 
-        if len(rows) == 0:
+        headers = index['header']
+        if headers is None:
             return jsonify({'error': 'CSVファイルが空です'}), 400
 
-        # ヘッダーとデータを分離
-        headers = rows[0] if len(rows) > 0 else []
-        data = rows[1:] if len(rows) > 1 else []
+        if cursor is not None:
+            try:
+                start = csv_index.parse_cursor(cursor, index)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            start = csv_index.offset_of_row(offset)
+
+        error_column = headers.index('error') if 'error' in headers else None
 
-        # 最大100行まで表示
-        preview_data = data[:100]
+        def matches(row):
+            if prefix is not None and not (row and row[0].startswith(prefix)):
+                return False
+            if status is not None:
+                failed = (error_column is not None and len(row) > error_column
+                          and row[error_column] != '')
+                return failed == (status == 'error')
+            return True
+
+        filtered = prefix is not None or status is not None
+        data, next_offset = csv_index.read_rows(start, limit, matches if filtered else None)
 
         return jsonify({
             'success': True,
             'headers': headers,
-            'data': preview_data,
-            'total_rows': len(data),
-            'preview_rows': len(preview_data)
+            'data': data,
+            'total_rows': index['rows'],
+            'error_rows': index['error_rows'],
+            'preview_rows': len(data),
+            'next_cursor': (csv_index.make_cursor(next_offset, index)
+                            if next_offset is not None else None),
         })
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def calculate_md5_hash(file_path):
-    """ファイルのMD5ハッシュを計算"""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-def get_control_points_path(image_name):
-    """制御点ファイルのパスを取得"""
-    return os.path.join(TARGETS_DIR, f"{image_name}.controls.geojson")
+def calculate_image_hash(file_path, algorithm=None):
+    """
+    画像のハッシュ値を計算（省略時は起動時に指定したアルゴリズム）
+    変更されていないファイルはキャッシュした値を返す
+    """
+    return hash_cache.digest(file_path, algorithm or HASH_ALGORITHM)
 
 def sort_control_points(control_points):
     """制御点を左上→右上→右下→左下の順に並び替え"""
@@ -602,49 +526,43 @@ def sort_control_points(control_points):
         else:  # 右下
             quadrants[3].append(point)
 
-    # 各象限内で最も適切な点を選択（複数ある場合は最初の点）
+    # 各象限内で最も適切な点を選択（複数ある場合は最初の点）し、左上→右上→右下→左下の順に並べる
     sorted_points = []
-    for quadrant in quadrants:
+    for quadrant in (quadrants[0], quadrants[1], quadrants[3], quadrants[2]):
         if quadrant:
             sorted_points.append(quadrant[0])
 
     return sorted_points
 
-@app.route('/api/image/<filename>', methods=['GET'])
+@app.route('/api/image/<path:filename>', methods=['GET'])
 def get_image_info(filename):
-    """画像データと状態を取得"""
+    """画像の状態と画像ファイルのURLを取得"""
     try:
-        image_path = os.path.join(TARGETS_DIR, filename)
+        image_path = image_file_path(filename)
 
-        if not os.path.exists(image_path):
+        if image_path is None or not os.path.exists(image_path):
             return jsonify({'error': 'Image not found'}), 404
 
-        # 制御点ファイルの存在確認
-        control_points_path = get_control_points_path(filename)
-        has_controls = os.path.exists(control_points_path)
+        # 制御点の確認
+        control_data = control_store.get(filename)
+        has_controls = control_data is not None
 
         image_changed = False
         if has_controls:
-            # 制御点ファイルを読み込んでハッシュを比較
+            # 保存時と同じアルゴリズムで現在の画像のハッシュを計算して比較
             try:
-                with open(control_points_path, 'r', encoding='utf-8') as f:
-                    control_data = json.load(f)
-
-                # 現在の画像のハッシュを計算
-                current_hash = calculate_md5_hash(image_path)
-                stored_hash = control_data.get('hash', '')
+                algorithm = control_data['hash_algorithm']
+                current_hash = calculate_image_hash(image_path, algorithm)
+                image_catalog.set_hash(filename, image_path, algorithm, current_hash)
+                stored_hash = control_data['hash']
 
                 image_changed = (current_hash != stored_hash)
             except:
                 image_changed = True
 
-        # 画像データを返す（base64エンコード）
-        with open(image_path, 'rb') as f:
-            image_data = base64.b64encode(f.read()).decode('utf-8')
-
         return jsonify({
             'success': True,
-            'image_data': f'data:image/jpeg;base64,{image_data}',
+            'image_url': image_file_url(filename, image_path),
             'has_controls': has_controls,
             'image_changed': image_changed
         })
@@ -652,28 +570,134 @@ def get_image_info(filename):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/control-points/<filename>', methods=['GET'])
+def image_version(image_path):
+    """
+    画像ファイルのURLに付けるバージョン（ファイルのサイズと更新時刻）
+    画像が変更されない限りURLは変わらず、ブラウザのキャッシュをそのまま使える
+    """
+    stat = os.stat(image_path)
+    return f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+def image_file_url(filename, image_path):
+    """画像ファイルのURL"""
+    return f"/api/image/{quote(filename)}/file?v={image_version(image_path)}"
+
+@app.route('/api/image/<path:filename>/file', methods=['GET'])
+def get_image_file(filename):
+    """
+    画像ファイルをそのまま配信（ETag・Last-Modified による条件付きリクエストと Range に対応）
+    バージョン（v）付きのURLで要求された場合は、内容が変わらないため長期間キャッシュさせる
+    """
+    image_path = image_file_path(filename)
+    if image_path is None or not os.path.isfile(image_path):
+        return jsonify({'error': 'Image not found'}), 404
+
+    max_age = IMAGE_MAX_AGE if request.args.get('v') else 0
+    response = send_file(os.path.abspath(image_path), conditional=True, etag=True,
+                         max_age=max_age)
+    if max_age:
+        response.cache_control.immutable = True
+    else:
+        # バージョンなしのURLは毎回 ETag で変更を確認させる
+        response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/image/<path:filename>/preview', methods=['GET'])
+def get_image_preview(filename):
+    """
+    線を描画していない縮小画像を配信（クエリの max_dimension・format・quality は /api/process の preview と同じ）
+    クライアント側で直線や交点を重ねて描画する下地に使う
+    """
+    image_path = image_file_path(filename)
+    if image_path is None or not os.path.isfile(image_path):
+        return jsonify({'error': 'Image not found'}), 404
+
+    try:
+        max_dimension, image_format, quality = parse_preview_options(request.args)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    preview = image_cache.preview(image_path, max_dimension)
+    if preview is None:
+        return jsonify({'error': 'Failed to load image'}), 400
+    mimetype, encoded = encode_preview(preview, image_format, quality)
+
+    max_age = IMAGE_MAX_AGE if request.args.get('v') else 0
+    etag = f'{image_version(image_path)}-{max_dimension}-{image_format}-{quality}'
+    response = send_file(io.BytesIO(encoded), mimetype=mimetype, conditional=True,
+                         etag=etag, max_age=max_age)
+    if max_age:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/image/<path:filename>/tiles', methods=['GET'])
+def get_image_tiles(filename):
+    """
+    タイルピラミッドの情報（画像の大きさ・各レベルのタイル数）とタイルのURLの形式を取得
+    レベル0が元の解像度で、レベルが1つ上がるごとに1/2に縮小する
+    """
+    try:
+        image_path = image_file_path(filename)
+        if image_path is None or not os.path.isfile(image_path):
+            return jsonify({'error': 'Image not found'}), 404
+
+        info = tile_pyramid.info(image_path)
+        if info is None:
+            return jsonify({'error': '画像の読み込みに失敗しました'}), 400
+
+        # 画像ファイルと同じバージョンを付け、画像が変わらない限りブラウザのキャッシュを使わせる
+        return jsonify({
+            'success': True,
+            **info,
+            'tile_url': (f"/api/image/{quote(filename)}/tiles/{{level}}/{{column}}_{{row}}.jpg"
+                         f"?v={image_version(image_path)}"),
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/image/<path:filename>/tiles/<int:level>/<int:column>_<int:row>.jpg', methods=['GET'])
+def get_image_tile(filename, level, column, row):
+    """タイル画像を配信（まだ生成していない場合は生成する）"""
+    image_path = image_file_path(filename)
+    if image_path is None or not os.path.isfile(image_path):
+        return jsonify({'error': 'Image not found'}), 404
+
+    tile_path = tile_pyramid.tile_path(image_path, level, column, row)
+    if tile_path is None:
+        return jsonify({'error': 'Tile not found'}), 404
+
+    max_age = IMAGE_MAX_AGE if request.args.get('v') else 0
+    response = send_file(tile_path, mimetype='image/jpeg', conditional=True, etag=True,
+                         max_age=max_age)
+    if max_age:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/control-points/<path:filename>', methods=['GET'])
 def get_control_points(filename):
     """制御点データを取得"""
     try:
-        control_points_path = get_control_points_path(filename)
+        control_data = control_store.get(filename)
 
-        if not os.path.exists(control_points_path):
+        if control_data is None:
             return jsonify({'control_points': []}), 200
 
-        with open(control_points_path, 'r', encoding='utf-8') as f:
-            control_data = json.load(f)
-
         return jsonify({
             'success': True,
-            'control_points': control_data.get('control_points', []),
-            'hash': control_data.get('hash', '')
+            'control_points': control_data['control_points'],
+            'hash': control_data['hash'],
+            'hash_algorithm': control_data['hash_algorithm']
         })
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/control-points/<filename>', methods=['POST'])
+@app.route('/api/control-points/<path:filename>', methods=['POST'])
 def save_control_points(filename):
     """制御点データを保存"""
     try:
@@ -681,23 +705,17 @@ def save_control_points(filename):
         control_points = data.get('control_points', [])
 
         # 画像パスの確認
-        image_path = os.path.join(TARGETS_DIR, filename)
-        if not os.path.exists(image_path):
+        image_path = image_file_path(filename)
+        if image_path is None or not os.path.exists(image_path):
             return jsonify({'error': 'Image not found'}), 404
 
         # 画像のハッシュを計算
-        image_hash = calculate_md5_hash(image_path)
-
-        # 制御点データを作成
-        control_data = {
-            'hash': image_hash,
-            'control_points': control_points
-        }
+        image_hash = calculate_image_hash(image_path)
+        image_catalog.set_hash(filename, image_path, HASH_ALGORITHM, image_hash)
 
-        # 制御点ファイルに保存
-        control_points_path = get_control_points_path(filename)
-        with open(control_points_path, 'w', encoding='utf-8') as f:
-            json.dump(control_data, f, ensure_ascii=False, indent=2)
+        # 制御点ストアに保存
+        control_store.put(filename, control_points, image_hash, HASH_ALGORITHM)
+        image_catalog.set_controls(filename, True)
 
         return jsonify({
             'success': True,
@@ -708,102 +726,73 @@ def save_control_points(filename):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/download-all-controls', methods=['GET'])
-def download_all_controls():
-    """全制御点をCSVでダウンロード"""
-    try:
-        # 画像リストを取得
-        images = []
-        if os.path.exists(TARGETS_DIR):
-            for file in os.listdir(TARGETS_DIR):
-                if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    images.append(file)
-
-        # CSVデータを作成
-        csv_data = []
-        csv_data.append(['ファイル名', 'left_top_x', 'left_top_y', 'right_top_x', 'right_top_y',
-                        'right_bottom_x', 'right_bottom_y', 'left_bottom_x', 'left_bottom_y'])
-
-        for image_name in sorted(images):
-            control_points_path = get_control_points_path(image_name)
-
-            row = [image_name]
-
-            if os.path.exists(control_points_path):
+def iter_control_rows():
+    """
+    画像名の順に (画像名, 左上・右上・右下・左下の順の制御点) を返す（制御点がない画像は None）
+    画像の索引と制御点ストアをそれぞれ画像名の順に読んで突き合わせる
+    """
+    records = control_store.iter_all()
+    record = next(records, None)
+    after = None
+    while True:
+        images = image_catalog.list_images(after=after, limit=IMAGE_SCAN_CHUNK)
+        for image in images:
+            image_name = image['name']
+            while record is not None and record[0] < image_name:
+                record = next(records, None)
+
+            points = None
+            if record is not None and record[0] == image_name:
                 try:
-                    with open(control_points_path, 'r', encoding='utf-8') as f:
-                        control_data = json.load(f)
-
-                    control_points = control_data.get('control_points', [])
-
-                    # 制御点を並び替え
-                    sorted_points = sort_control_points(control_points)
-
-                    # 最大4点まで、不足分は空白
-                    for i in range(4):
-                        if i < len(sorted_points):
-                            row.extend(sorted_points[i])
-                        else:
-                            row.extend(['', ''])
-
-                except:
-                    # エラーの場合は空白で埋める
-                    row.extend([''] * 8)
-            else:
-                # 制御点ファイルがない場合は空白で埋める
-                row.extend([''] * 8)
-
-            csv_data.append(row)
-
-        # CSVファイルを作成
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerows(csv_data)
-
-        # レスポンスを作成
-        response_data = output.getvalue()
-        output.close()
-
-        # バイナリデータに変換
-        response = io.BytesIO()
-        response.write(response_data.encode('utf-8-sig'))  # BOM付きUTF-8
-        response.seek(0)
-
-        return send_file(
-            response,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name='control_points.csv'
-        )
+                    points = sort_control_points(record[1]['control_points'])
+                except Exception:
+                    # 制御点を並び替えられない場合は制御点がないものとする
+                    points = None
+            yield image_name, points
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        if len(images) < IMAGE_SCAN_CHUNK:
+            return
+        after = images[-1]['name']
+
+@app.route('/api/download-all-controls', methods=['GET'])
+def download_all_controls():
+    """
+    全制御点をダウンロード（画像1つずつ書き出しながら送信し、全体をメモリに持たない）
+    format: csv（デフォルト）/ geojson / parquet / arrow（parquet・arrow は pyarrow がある場合のみ）
+    compress=gzip の場合は gzip で圧縮する
+    """
+    export_format = request.args.get('format') or 'csv'
+    compress = request.args.get('compress') or None
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f'未対応の形式です: {export_format}',
+                        'formats': sorted(EXPORT_FORMATS)}), 400
+    if compress not in (None, 'gzip'):
+        return jsonify({'error': f'未対応の圧縮形式です: {compress}'}), 400
+
+    write_chunks, mimetype, extension = EXPORT_FORMATS[export_format]
+    chunks = write_chunks(iter_control_rows())
+    download_name = f'control_points{extension}'
+    if compress == 'gzip':
+        chunks = gzip_chunks(chunks)
+        mimetype = 'application/gzip'
+        download_name += '.gz'
+
+    response = app.response_class(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+    return response
 
 @app.route('/api/clear-all-control-points', methods=['DELETE'])
 def clear_all_control_points():
     """全制御点を削除"""
     try:
-        deleted_count = 0
-        error_count = 0
-
-        # 画像リストを取得
-        if os.path.exists(TARGETS_DIR):
-            for file in os.listdir(TARGETS_DIR):
-                if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    control_points_path = get_control_points_path(file)
-
-                    if os.path.exists(control_points_path):
-                        try:
-                            os.remove(control_points_path)
-                            deleted_count += 1
-                        except Exception:
-                            error_count += 1
+        deleted_count = control_store.clear()
+        image_catalog.clear_controls()
 
         return jsonify({
             'success': True,
-            'message': f'{deleted_count}個の制御点ファイルを削除しました',
+            'message': f'{deleted_count}画像の制御点を削除しました',
             'deleted_count': deleted_count,
-            'error_count': error_count
+            'error_count': 0
         })
 
     except Exception as e:
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+バッチ処理をバックグラウンドで実行し、進捗の確認やキャンセルを可能にするジョブ管理。
+"""
+
+import csv
+import threading
+import time
+import uuid
+
+from batch_processor import CSV_HEADER, ERROR_COLUMN, iter_batch_rows, load_reusable_rows
+
+# CSVをディスクに書き出す間隔（秒）
+FLUSH_INTERVAL = 1.0
+
+# 終了したジョブを保持する数（古いものから破棄する）
+MAX_FINISHED_JOBS = 20
+
+
+class JobConflictError(Exception):
+    """既に実行中のジョブがある場合の例外"""
+
+
+class BatchJob:
+    """
+    1回分のバッチ処理
+    結果は image_names の順にCSVへ追記し、一定間隔でディスクに書き出す
+    resume=True の場合は、前回のCSVのうち画像とパラメータが変わっていない成功行を再利用し、
+    それ以外（変更された画像・失敗した画像・未処理の画像）だけを処理する
+    再利用する行と処理した行は image_names の順に並べて書き出すため、CSVの行の順は再開しない場合と同じ
+    （キャンセルした場合は、処理しなかった画像の行がない）
+    """
+
+    def __init__(self, job_id, target_dir, image_names, params, csv_path, workers=None,
+                 resume=False, result_store_path=None, metrics=None):
+        self.job_id = job_id
+        self.target_dir = target_dir
+        self.image_names = list(image_names)
+        self.params = params
+        self.csv_path = csv_path
+        self.workers = workers
+        self.resume = resume
+        self.result_store_path = result_store_path
+        self.metrics = metrics  # 段階ごとの処理時間を集計する StageMetrics（省略可）
+
+        self.status = 'pending'  # pending / running / completed / cancelled / failed
+        self.total = len(self.image_names)
+        self.processed = 0
+        self.failed = 0
+        self.skipped = 0  # 前回の結果を再利用した画像数
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.processing_started_at = None  # 前回のCSVを読み終えて処理を始めた時刻
+        self.finished_at = None
+
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def is_active(self):
+        return self.status in ('pending', 'running')
+
+    def cancel(self):
+        """キャンセルを要求する（処理中の画像が終わり次第停止する）"""
+        self._cancel_event.set()
+
+    def run(self):
+        """ジョブを実行（バックグラウンドスレッドから呼ばれる）"""
+        with self._lock:
+            self.status = 'running'
+            self.started_at = time.time()
+
+        rows = None
+        try:
+            reusable = {}
+            if self.resume:
+                reusable = load_reusable_rows(self.csv_path, self.target_dir,
+                                              self.image_names, self.params)
+            pending_names = [name for name in self.image_names if name not in reusable]
+
+            with self._lock:
+                self.processing_started_at = time.time()
+
+            # iter_batch_rows は pending_names の順に行を返すため、image_names の順に
+            # 再利用する行と処理した行を合わせて書き出す（前回のCSVは作り直す）
+            rows = iter_batch_rows(self.target_dir, pending_names, self.params,
+                                   workers=self.workers,
+                                   result_store_path=self.result_store_path,
+                                   metrics=self.metrics)
+            with open(self.csv_path, 'w', newline='', encoding='utf-8') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(CSV_HEADER)
+                last_flush = time.monotonic()
+
+                for name in self.image_names:
+                    reused = reusable.get(name)
+                    if reused is None:
+                        # キャンセル後は再利用する行だけを書き出す
+                        if self._cancel_event.is_set():
+                            continue
+                        row = next(rows)
+                    else:
+                        row = reused
+                    writer.writerow(row)
+                    # 中断しても処理済みの行が残るよう、一定間隔でディスクに書き出す
+                    if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                        csvfile.flush()
+                        last_flush = time.monotonic()
+
+                    with self._lock:
+                        self.processed += 1
+                        if reused is not None:
+                            self.skipped += 1
+                        elif row[ERROR_COLUMN] != '':
+                            self.failed += 1
+
+            with self._lock:
+                self.status = 'cancelled' if self._cancel_event.is_set() else 'completed'
+
+        except Exception as e:
+            with self._lock:
+                self.status = 'failed'
+                self.error = str(e)
+        finally:
+            # 未着手の画像をプールから取り消す
+            if rows is not None:
+                rows.close()
+            with self._lock:
+                self.finished_at = time.time()
+
+    def to_dict(self):
+        """進捗をJSONで返せる形式に変換"""
+        with self._lock:
+            if self.started_at is None:
+                elapsed = 0.0
+            else:
+                elapsed = (self.finished_at or time.time()) - self.started_at
+            # 処理速度には再利用した行と前回のCSVを読む時間を含めない
+            if self.processing_started_at is None:
+                processing_elapsed = 0.0
+            else:
+                processing_elapsed = (self.finished_at or time.time()) - self.processing_started_at
+            newly_processed = self.processed - self.skipped
+            succeeded = self.processed - self.failed
+            result = {
+                'job_id': self.job_id,
+                'status': self.status,
+                'total': self.total,
+                'processed': self.processed,
+                'succeeded': succeeded,
+                'failed': self.failed,
+                'skipped': self.skipped,
+                'remaining': self.total - self.processed,
+                'elapsed_seconds': round(elapsed, 3),
+                'images_per_second': (round(newly_processed / processing_elapsed, 3)
+                                      if processing_elapsed > 0 else 0.0),
+                'cancel_requested': self._cancel_event.is_set(),
+                'csv_path': self.csv_path,
+            }
+            if self.status == 'completed':
+                result['message'] = f'全{self.total}個の画像を処理し、うち{succeeded}画像の交点を計算しました。CSVファイルに保存しました。'
+                if self.skipped:
+                    result['message'] += f'（{self.skipped}画像は前回の結果を再利用しました）'
+            elif self.status == 'cancelled':
+                result['message'] = f'{self.total}個中{self.processed}個の画像を処理した時点でキャンセルしました。'
+            if self.error is not None:
+                result['error'] = self.error
+            return result
+
+
+class JobManager:
+    """
+    バッチジョブを管理するクラス
+    同じCSVに書き込むため、同時に実行できるジョブは1つまで
+    終了したジョブは新しい順に max_finished 個まで保持し、それより古いものは破棄する
+    """
+
+    def __init__(self, max_finished=MAX_FINISHED_JOBS):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.max_finished = max_finished
+
+    def _discard_old_jobs(self):
+        """保持する数を超えた古い終了済みのジョブを破棄する（_lock を取得して呼ぶ）"""
+        finished = sorted((job for job in self._jobs.values() if job.finished_at is not None),
+                          key=lambda job: job.finished_at, reverse=True)
+        for job in finished[self.max_finished:]:
+            del self._jobs[job.job_id]
+
+    def submit(self, target_dir, image_names, params, csv_path, workers=None, resume=False,
+               result_store_path=None, metrics=None):
+        """ジョブを登録してバックグラウンドで開始する"""
+        with self._lock:
+            for job in self._jobs.values():
+                if job.is_active:
+                    raise JobConflictError(job.job_id)
+
+            job = BatchJob(uuid.uuid4().hex, target_dir, image_names, params,
+                           csv_path, workers=workers, resume=resume,
+                           result_store_path=result_store_path, metrics=metrics)
+            self._jobs[job.job_id] = job
+            self._discard_old_jobs()
+
+        thread = threading.Thread(target=job.run, name=f'batch-job-{job.job_id}', daemon=True)
+        thread.start()
+        return job
+
+    def get(self, job_id):
+        """ジョブを取得（存在しない場合はNone）"""
+        with self._lock:
+            return self._jobs.get(job_id)
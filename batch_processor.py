@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+すべての画像の交点をプロセスプールで並列に計算するバッチ処理エンジン。
+"""
+
+import csv
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from line_detector import load_image
+from pipeline import LinePipeline, normalize_parameters, parameters_key
+from result_store import ResultStore
+from stage_timing import StageTimer, timed_stage
+
+# 交点CSVのヘッダー
+# error の後の3列は再開時に処理済みかどうかを判定するための、画像ファイルのサイズ・更新時刻とパラメータの組
+CSV_HEADER = ['画像ファイル名', 'x0', 'y0', 'x1', 'y1', 'x2', 'y2', 'x3', 'y3', 'error',
+              'file_size', 'file_mtime_ns', 'parameters_key']
+ERROR_COLUMN = CSV_HEADER.index('error')
+
+
+def file_fingerprint(image_path):
+    """画像ファイルが変更されたかどうかの判定に使う (サイズ, 更新時刻) の文字列"""
+    stat = os.stat(image_path)
+    return [str(stat.st_size), str(stat.st_mtime_ns)]
+
+
+def error_row(image_name, message, fingerprint=('', ''), params_key=''):
+    """エラー時のCSV行を作成"""
+    return [image_name] + [''] * 8 + [message] + list(fingerprint) + [params_key]
+
+
+# ワーカープロセスごとに開いた結果ストア（パス -> ResultStore）
+_result_stores = {}
+
+
+def _open_result_store(path):
+    if path is None:
+        return None
+    store = _result_stores.get(path)
+    if store is None:
+        store = _result_stores[path] = ResultStore(path)
+    return store
+
+
+def process_image_row(target_dir, image_name, params, result_store_path=None):
+    """
+    1枚の画像の交点を計算し、CSVの1行として返す関数
+    ワーカープロセス内で実行されるため、例外はすべてエラー行に変換する
+    result_store_path を指定した場合は、保存済みの結果があればそれを使い、なければ計算して保存する
+    """
+    try:
+        image_path = os.path.join(target_dir, image_name)
+        fingerprint = file_fingerprint(image_path)
+        params = normalize_parameters(params)
+        params_key = parameters_key(params)
+
+        result_store = _open_result_store(result_store_path)
+        digest = result = None
+        if result_store:
+            with timed_stage('hash'):
+                digest = result_store.content_hash(image_path)
+            with timed_stage('result_store'):
+                result = result_store.get(digest, params)
+
+        if result is None:
+            # 画像を読み込み（交点計算に必要なのはサイズと線だけなのでグレースケールでデコードする）
+            decoded_image = load_image(image_path, grayscale=True)
+            if decoded_image is None:
+                # 画像読み込みエラー
+                return error_row(image_name, '画像の読み込みに失敗しました', fingerprint, params_key)
+
+            # 線の検出から交点の並べ替えまでをパイプラインで実行
+            result = LinePipeline(decoded_image).summary(params)
+            if result_store:
+                with timed_stage('result_store'):
+                    result_store.put(digest, params, result)
+
+        if result['error'] is not None:
+            return error_row(image_name, result['error'], fingerprint, params_key)
+
+        # 結果を返す（成功）
+        row = [image_name]
+        for point in result['corners']:
+            row.extend(point)
+        row.append('')  # エラーなし
+        row.extend(fingerprint)
+        row.append(params_key)
+        return row
+
+    except Exception as e:
+        # 処理中に例外が発生した場合
+        return error_row(image_name, f'処理中にエラーが発生しました: {str(e)}')
+
+
+def process_image_row_timed(target_dir, image_name, params, result_store_path=None):
+    """process_image_row を段階ごとの処理時間を計測しながら実行し、(CSVの行, StageTimer.to_dict()) を返す"""
+    with StageTimer() as timer:
+        row = process_image_row(target_dir, image_name, params, result_store_path)
+    return row, timer.to_dict()
+
+
+def load_reusable_rows(csv_path, target_dir, image_names, params):
+    """
+    前回のCSVから、そのまま使える行を画像ファイル名ごとに返す（再開用）
+    使えるのは交点の計算に成功し、画像ファイルのサイズ・更新時刻とパラメータが今回と同じ行だけ
+    CSVがない場合やヘッダーが異なる（以前の形式の）場合は空の辞書を返す
+    """
+    if not os.path.exists(csv_path):
+        return {}
+
+    targets = set(image_names)
+    params_key = parameters_key(params)
+    reusable = {}
+    with open(csv_path, 'r', newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        if next(reader, None) != CSV_HEADER:
+            return {}
+        for row in reader:
+            # 書き込み途中で中断された行などは使わない
+            if len(row) != len(CSV_HEADER) or row[0] not in targets:
+                continue
+            if row[ERROR_COLUMN] != '' or row[-1] != params_key:
+                continue
+            try:
+                fingerprint = file_fingerprint(os.path.join(target_dir, row[0]))
+            except OSError:
+                continue
+            if row[ERROR_COLUMN + 1:-1] == fingerprint:
+                reusable[row[0]] = row
+    return reusable
+
+
+def _init_worker():
+    """ワーカープロセスの初期化（OpenCV内部のスレッドとコア数を奪い合わないようにする）"""
+    cv2.setNumThreads(1)
+
+
+def iter_batch_rows(target_dir, image_names, params, workers=None, max_in_flight=None,
+                    result_store_path=None, metrics=None):
+    """
+    画像をプロセスプールで並列処理し、CSVの行を入力順に返すジェネレーター
+
+    workers: 並列プロセス数（None の場合はCPUコア数、1以下なら逐次処理）
+    max_in_flight: 同時に投入する画像数の上限（None の場合は workers の2倍）
+    投入数を制限することで、画像数に関わらずメモリ使用量を一定に保つ
+    metrics: StageMetrics を指定した場合は、各画像の段階ごとの処理時間を 'batch' として集計する
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # 処理時間を集計する場合はワーカーで計測し、行とともに受け取る
+    task = process_image_row if metrics is None else process_image_row_timed
+
+    def collect(result):
+        if metrics is None or not isinstance(result, tuple):
+            return result
+        row, timings = result
+        metrics.observe('batch', timings)
+        return row
+
+    if workers <= 1:
+        for image_name in image_names:
+            yield collect(task(target_dir, image_name, params, result_store_path))
+        return
+
+    if max_in_flight is None:
+        max_in_flight = workers * 2
+    max_in_flight = max(max_in_flight, workers)
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        try:
+            for image_name in image_names:
+                future = executor.submit(task, target_dir, image_name, params,
+                                         result_store_path)
+                pending.append((image_name, future))
+                # 上限に達したら先頭の結果を待ってから次を投入する
+                if len(pending) >= max_in_flight:
+                    yield collect(_pop_result(pending))
+
+            while pending:
+                yield collect(_pop_result(pending))
+        finally:
+            # 途中で打ち切られた場合は未着手の処理を取り消す
+            for _, future in pending:
+                future.cancel()
+
+
+def _pop_result(pending):
+    """先頭の処理結果を取り出す（ワーカー自体の異常もエラー行にする）"""
+    image_name, future = pending.popleft()
+    try:
+        return future.result()
+    except Exception as e:
+        return error_row(image_name, f'処理中にエラーが発生しました: {str(e)}')
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+直線検出パイプラインのベンチマーク。
+図郭線・ノイズ・傾き・地図の内容（等高線や文字に見立てた線と矩形）を描いた合成の地図画像を
+指定した大きさで生成し、デコード・グレースケール変換・二値化・erode・Hough変換・グループ化・交点・
+描画・エンコードの各段階の処理時間、スループット（メガピクセル/秒）、ピークメモリ使用量（RSS）を
+JSONで出力する。
+
+各ケース（画像の大きさ × 検出方法）は新しいプロセスで実行するため、ピークRSSはケースごとの値になる。
+pyramid_levels を指定したケースは、同じ画像を元の解像度で検出した結果と直線・4隅・Hough変換の処理時間を比べる
+（full_resolution）。
+
+使用例:
+  python benchmark.py --sizes 10000x8000 20000x15000 --pyramid-levels 0 2 --border-band 0 10 \\
+      --repeat 3 --output bench.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from line_detector import load_image, binarize, erode_binary, hough_lines
+from line_utils import sort_intersections
+from pipeline import DEFAULT_PARAMETERS, LinePipeline, PipelineError
+
+# 計測する段階（出力の順序）
+STAGES = (
+    'decode',
+    'grayscale',
+    'threshold',
+    'erode',
+    'hough',
+    'group',
+    'intersection',
+    'draw',
+    'encode',
+)
+
+# 合成画像の生成で一度に処理する行数（大きな画像でもメモリ使用量を抑える）
+GENERATE_CHUNK_ROWS = 1024
+
+
+def generate_sheet(width, height, seed=0, skew=0.5, noise=8.0, clutter=150, margin=0.06):
+    """
+    合成の地図画像（BGR）と図郭の4隅（左上、右上、左下、右下）を返す
+    skew: 図郭の傾き（度）、noise: ガウスノイズの標準偏差、clutter: 図郭内に描く線・矩形の数、
+    margin: 画像の端から図郭までの距離（短辺に対する割合）
+    同じ地図を異なる解像度でスキャンした画像に見立て、線の太さや地図の内容の大きさは画像の大きさに比例させる
+    """
+    rng = np.random.default_rng(seed)
+    gray = np.full((height, width), 235, np.uint8)  # 紙の色
+    short_side = min(width, height)
+
+    # 図郭（画像の中心を軸に skew 度回転した矩形）
+    inset = margin * short_side
+    center = np.array([width / 2, height / 2])
+    angle = np.deg2rad(skew)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    frame = np.array([
+        [inset, inset], [width - inset, inset],
+        [width - inset, height - inset], [inset, height - inset],
+    ])
+    frame = (frame - center) @ rotation.T + center
+
+    # 地図の内容: 等高線や道路に見立てた折れ線と、文字に見立てた小さな矩形
+    low, high = frame.min(axis=0) + inset / 2, frame.max(axis=0) - inset / 2
+    line_scale = max(1, short_side // 2000)
+    for _ in range(clutter):
+        points = np.cumsum(rng.normal(0, short_side / 60, (rng.integers(5, 40), 2)), axis=0)
+        points += rng.uniform(low, high)
+        cv2.polylines(gray, [np.clip(points, low, high).astype(np.int32)], False,
+                      int(rng.integers(40, 200)), int(rng.integers(1, 4)) * line_scale)
+    for _ in range(clutter):
+        x, y = rng.uniform(low, high).astype(int)
+        size = int(rng.integers(short_side // 400 + 2, short_side // 100 + 4))
+        cv2.rectangle(gray, (x, y), (x + size * 3, y + size), int(rng.integers(20, 200)), -1)
+
+    # 外側の太い図郭線と、二値化で残らない薄い内側の図郭線
+    thickness = max(3, short_side // 400)
+    cv2.polylines(gray, [np.round(frame).astype(np.int32)], True, 0, thickness)
+    inner = (frame - center) * (1 - 2 * thickness * 4 / short_side) + center
+    cv2.polylines(gray, [np.round(inner).astype(np.int32)], True, 140, max(1, thickness // 3))
+
+    # ノイズ（行ごとに加える）
+    if noise > 0:
+        for top in range(0, height, GENERATE_CHUNK_ROWS):
+            rows = gray[top:top + GENERATE_CHUNK_ROWS]
+            rows[:] = np.clip(rows + rng.normal(0, noise, rows.shape).astype(np.int16), 0, 255)
+
+    color = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+    upper_left, upper_right, lower_right, lower_left = frame.tolist()
+    return color, [upper_left, upper_right, lower_left, lower_right]
+
+
+def _timed(timings, stage, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings[stage] = time.perf_counter() - start
+    return result
+
+
+def run_stages(image_path, params):
+    """
+    1回分の処理を実行し、段階ごとの処理時間（秒）と検出結果を返す
+    /api/process と同様にカラーでデコードし、元の解像度に描画してJPEGにエンコードする
+    """
+    timings = {}
+    decoded = _timed(timings, 'decode', load_image, image_path)
+    gray = _timed(timings, 'grayscale', lambda: decoded.gray)
+    binary = _timed(timings, 'threshold', binarize, gray, params['binary_threshold'])
+    _timed(timings, 'erode', erode_binary, binary, params['erode_kernel'],
+           params['erode_iteration'])
+    lines = _timed(timings, 'hough', hough_lines, binary, params['rho_precision'],
+                   params['theta_precision'], params['line_accumulation'],
+                   pyramid_levels=params['pyramid_levels'], border_band=params['border_band'])
+
+    pipeline = LinePipeline(decoded, detector=lambda **_: lines)
+    groups = _timed(timings, 'group', pipeline.groups, params)
+
+    def intersection():
+        # 代表線・交点の計算と4隅の並べ替え
+        intersections = pipeline.intersections(params)
+        if len(intersections) == 4:
+            sort_intersections(intersections)
+        return intersections
+    intersections = _timed(timings, 'intersection', intersection)
+
+    result_image = _timed(timings, 'draw', pipeline.render, params)
+    _timed(timings, 'encode', cv2.imencode, '.jpg', result_image)
+
+    try:
+        corners = pipeline.corners(params)
+        error = None
+    except PipelineError as e:
+        corners = None
+        error = e.message
+    return timings, {
+        'lines': lines,
+        'lines_count': len(lines) if lines is not None else 0,
+        'groups_count': len(groups),
+        'intersections_count': len(intersections),
+        'corners': corners,
+        'error': error,
+    }
+
+
+def compare_with_full_resolution(image_path, params, lines, corners, repeat, hough_seconds):
+    """
+    pyramid_levels を指定したケースの検出結果を、同じ border_band で元の解像度（pyramid_levels=0）で
+    検出した結果と比べる。直線の過不足・順序、4隅の差（画素）と Hough変換の処理時間を返す
+    """
+    decoded = load_image(image_path)
+    binary = binarize(decoded.gray, params['binary_threshold'])
+    full_params = dict(params, pyramid_levels=0)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        full_lines = hough_lines(binary, params['rho_precision'], params['theta_precision'],
+                                 params['line_accumulation'], border_band=params['border_band'])
+        seconds.append(time.perf_counter() - start)
+
+    def as_list(found):
+        return [] if found is None else [tuple(line) for line in found.reshape(-1, 2).tolist()]
+    pyramid, full = as_list(lines), as_list(full_lines)
+
+    try:
+        full_corners = LinePipeline(decoded, detector=lambda **_: full_lines).corners(full_params)
+    except PipelineError:
+        full_corners = None
+    corner_delta = None
+    if corners is not None and full_corners is not None:
+        corner_delta = max(float(np.hypot(x - fx, y - fy))
+                           for (x, y), (fx, fy) in zip(corners, full_corners))
+    full_seconds = statistics.median(seconds)
+    return {
+        'hough_seconds': full_seconds,
+        'hough_speedup': full_seconds / hough_seconds if hough_seconds > 0 else None,
+        'lines_count': len(full),
+        'missing_lines': len(set(full) - set(pyramid)),
+        'extra_lines': len(set(pyramid) - set(full)),
+        'same_lines': pyramid == full,  # 同じ直線が同じ順で得られたか
+        'corners_found': full_corners is not None,
+        'corner_delta_px': corner_delta,
+    }
+
+
+def _peak_rss_bytes():
+    """このプロセスのピークRSS（バイト）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux はキロバイト、macOS はバイト単位
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(image_path, params, repeat, expected_corners):
+    """
+    1つのケースを repeat 回実行し、段階ごとの処理時間の中央値などを返す
+    新しいプロセスで実行されることを想定している（ピークRSSをケースごとに計測するため）
+    """
+    cv2.setNumThreads(1)
+    runs = []
+    for _ in range(repeat):
+        timings, detection = run_stages(image_path, params)
+        runs.append(timings)
+
+    stages = {}
+    for stage in STAGES:
+        seconds = [timings[stage] for timings in runs]
+        stages[stage] = {'seconds': statistics.median(seconds), 'runs': seconds}
+
+    # 元の解像度との比較はピークRSSに含めない
+    peak_rss_bytes = _peak_rss_bytes()
+    lines = detection.pop('lines')
+    full_resolution = None
+    if params['pyramid_levels'] > 0:
+        full_resolution = compare_with_full_resolution(image_path, params, lines,
+                                                       detection['corners'], repeat,
+                                                       stages['hough']['seconds'])
+
+    corner_error = None
+    if detection['corners'] is not None:
+        corner_error = max(float(np.hypot(x - ex, y - ey))
+                           for (x, y), (ex, ey) in zip(detection['corners'], expected_corners))
+    detection['corners'] = ([list(point) for point in detection['corners']]
+                            if detection['corners'] is not None else None)
+    return {
+        'stages': stages,
+        'detection': dict(detection, corner_error_px=corner_error),
+        'full_resolution': full_resolution,
+        'peak_rss_bytes': peak_rss_bytes,
+    }
+
+
+def parse_size(spec):
+    """"幅x高さ" を (幅, 高さ) にする"""
+    try:
+        width, height = (int(v) for v in spec.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'大きさは 幅x高さ で指定してください: {spec}')
+    return width, height
+
+
+def main():
+    parser = argparse.ArgumentParser(description='直線検出パイプラインのベンチマーク')
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[(10000, 8000)],
+                        help='合成画像の大きさ（幅x高さ、複数指定可。デフォルト: 10000x8000）')
+    parser.add_argument('--pyramid-levels', nargs='+', type=int, default=[0],
+                        help='比較する pyramid_levels（複数指定可。デフォルト: 0）')
+    parser.add_argument('--border-band', nargs='+', type=float, default=[0],
+                        help='比較する border_band（複数指定可。デフォルト: 0）')
+    parser.add_argument('--line-accumulation', type=int, default=None,
+                        help='直線の閾値（デフォルト: 図郭の短辺の長さの半分）')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='各ケースの繰り返し回数（中央値を出力。デフォルト: 3）')
+    parser.add_argument('--seed', type=int, default=0, help='合成画像の乱数のシード')
+    parser.add_argument('--skew', type=float, default=0.5, help='図郭の傾き（度、デフォルト: 0.5）')
+    parser.add_argument('--noise', type=float, default=8.0,
+                        help='ノイズの標準偏差（デフォルト: 8）')
+    parser.add_argument('--clutter', type=int, default=150,
+                        help='地図の内容として描く線・矩形の数（デフォルト: 150）')
+    parser.add_argument('-o', '--output', default=None,
+                        help='結果のJSONの出力先（デフォルト: 標準出力）')
+    args = parser.parse_args()
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'settings': {
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'skew': args.skew,
+            'noise': args.noise,
+            'clutter': args.clutter,
+        },
+        'cases': [],
+    }
+
+    # ピークRSSをケースごとに計測するため、ケースごとに新しいプロセスで実行する
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for width, height in args.sizes:
+            print(f'{width}x{height} の合成画像を生成しています', file=sys.stderr)
+            color, expected_corners = generate_sheet(width, height, seed=args.seed, skew=args.skew,
+                                                     noise=args.noise, clutter=args.clutter)
+            image_path = os.path.join(tmp_dir, f'sheet_{width}x{height}.jpg')
+            cv2.imwrite(image_path, color)
+            del color
+            file_size = os.path.getsize(image_path)
+
+            line_accumulation = args.line_accumulation
+            if line_accumulation is None:
+                line_accumulation = int(min(width, height) * (1 - 2 * 0.06) / 2)
+
+            for pyramid_levels in args.pyramid_levels:
+                for border_band in args.border_band:
+                    params = dict(DEFAULT_PARAMETERS, line_accumulation=line_accumulation,
+                                  pyramid_levels=pyramid_levels, border_band=border_band)
+                    print(f'  pyramid_levels={pyramid_levels} border_band={border_band}',
+                          file=sys.stderr)
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        case = executor.submit(run_case, image_path, params, args.repeat,
+                                               expected_corners).result()
+
+                    megapixels = width * height / 1e6
+                    for timing in case['stages'].values():
+                        timing['megapixels_per_second'] = (
+                            megapixels / timing['seconds'] if timing['seconds'] > 0 else None)
+                    total = sum(timing['seconds'] for timing in case['stages'].values())
+                    report['cases'].append({
+                        'width': width,
+                        'height': height,
+                        'megapixels': megapixels,
+                        'file_size': file_size,
+                        'parameters': params,
+                        'stages': case['stages'],
+                        'total_seconds': total,
+                        'megapixels_per_second': megapixels / total if total > 0 else None,
+                        'peak_rss_bytes': case['peak_rss_bytes'],
+                        'expected_corners': expected_corners,
+                        'detection': case['detection'],
+                        'full_resolution': case['full_resolution'],
+                    })
+                    comparison = case['full_resolution']
+                    if comparison is not None:
+                        print(f"    元の解像度との比較: Hough変換 {comparison['hough_speedup']:.2f}倍速、"
+                              f"不足 {comparison['missing_lines']}本・余分 {comparison['extra_lines']}本、"
+                              f"4隅の差 {comparison['corner_delta_px']}px", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
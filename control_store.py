@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ハンディモードで設定した制御点のストア（SQLite）。
+画像ごとの制御点・保存時の画像のハッシュ値を1つのSQLiteファイルに保存し、
+全画像の制御点の書き出しを画像名の順の1回の問い合わせで行えるようにする。
+
+以前の形式（画像の隣の <画像ファイル名>.controls.geojson）との相互変換は
+  python control_store.py import [対象ディレクトリ] [--recursive] [--overwrite]
+  python control_store.py export [対象ディレクトリ]
+で行う。サーバーは初回の起動時に、対象ディレクトリの制御点ファイルを自動で取り込む。
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from image_catalog import CONTROLS_SUFFIX
+
+
+def default_control_store_path(target_dir):
+    """対象ディレクトリの隣に置く制御点ストアのパス（例: ./targets -> ./targets.controls.sqlite3）"""
+    target_dir = os.path.abspath(target_dir)
+    return os.path.join(os.path.dirname(target_dir),
+                        os.path.basename(target_dir) + '.controls.sqlite3')
+
+
+def controls_file_path(root_dir, name):
+    """画像名（対象ディレクトリからの相対パス）に対応する以前の形式の制御点ファイルのパス"""
+    return os.path.join(root_dir, *name.split('/')) + CONTROLS_SUFFIX
+
+
+class ControlPointStore:
+    """
+    画像名ごとに制御点を保存するクラス
+    SQLiteファイルはWALモードで開き、接続はスレッドごとに作成する
+    保存・取得するデータは以前の制御点ファイルと同じ形式
+    （{'hash': ..., 'hash_algorithm': ..., 'control_points': [[x, y], ...]}）
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._create_tables()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _create_tables(self):
+        connection = self._connection()
+        with connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS control_points (
+                    name TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL,
+                    hash_algorithm TEXT NOT NULL,
+                    control_points TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    @staticmethod
+    def _record(digest, algorithm, control_points):
+        return {
+            'hash': digest,
+            'hash_algorithm': algorithm,
+            'control_points': json.loads(control_points),
+        }
+
+    def get(self, name):
+        """画像の制御点データを返す（ない場合は None）"""
+        row = self._connection().execute(
+            'SELECT hash, hash_algorithm, control_points FROM control_points WHERE name = ?',
+            (name,)).fetchone()
+        return self._record(*row) if row is not None else None
+
+    def put(self, name, control_points, digest, algorithm):
+        """画像の制御点と保存時の画像のハッシュ値を保存する（既存のデータは置き換える）"""
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO control_points VALUES (?, ?, ?, ?, ?)',
+                               (name, digest, algorithm, json.dumps(control_points), time.time()))
+
+    def delete(self, name):
+        """画像の制御点を削除し、削除したかどうかを返す"""
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute('DELETE FROM control_points WHERE name = ?', (name,))
+        return cursor.rowcount > 0
+
+    def clear(self):
+        """すべての制御点を削除し、削除件数を返す"""
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute('DELETE FROM control_points')
+        return cursor.rowcount
+
+    def iter_all(self):
+        """(画像名, 制御点データ) を画像名の順に返す"""
+        cursor = self._connection().execute(
+            'SELECT name, hash, hash_algorithm, control_points FROM control_points ORDER BY name')
+        for name, digest, algorithm, control_points in cursor:
+            yield name, self._record(digest, algorithm, control_points)
+
+    def names(self, prefix=None):
+        """制御点がある画像名の集合（prefix: 画像名の先頭）"""
+        query = 'SELECT name FROM control_points'
+        values = []
+        if prefix:
+            query += ' WHERE name >= ? AND name < ?'
+            values = [prefix, prefix + '\U0010ffff']
+        return {name for name, in self._connection().execute(query, values)}
+
+    def geojson_imported(self):
+        """以前の形式の制御点ファイルを取り込み済みか"""
+        row = self._connection().execute(
+            "SELECT value FROM settings WHERE key = 'geojson_imported_at'").fetchone()
+        return row is not None
+
+    def import_geojson(self, root_dir, recursive=False, overwrite=False):
+        """
+        対象ディレクトリの以前の形式の制御点ファイルを取り込み、(取り込んだ件数, 飛ばした件数) を返す
+        overwrite=False の場合は、ストアに制御点がある画像のファイルは飛ばす
+        読み込めないファイルも飛ばす。取り込んだファイルは削除しない
+        """
+        imported = skipped = 0
+        connection = self._connection()
+        with connection:
+            for directory, subdirectories, files in os.walk(root_dir):
+                if recursive:
+                    subdirectories[:] = sorted(d for d in subdirectories if not d.startswith('.'))
+                else:
+                    subdirectories[:] = []
+                relative = os.path.relpath(directory, root_dir)
+                prefix = '' if relative == os.curdir else relative.replace(os.sep, '/') + '/'
+                for file_name in files:
+                    if not file_name.endswith(CONTROLS_SUFFIX):
+                        continue
+                    name = prefix + file_name[:-len(CONTROLS_SUFFIX)]
+                    try:
+                        with open(os.path.join(directory, file_name), 'r', encoding='utf-8') as f:
+                            data = json.load(f)
+                        # hash_algorithm がない以前の制御点ファイルはMD5
+                        values = (name, data.get('hash', ''), data.get('hash_algorithm', 'md5'),
+                                  json.dumps(data.get('control_points', [])), time.time())
+                    except (OSError, ValueError, AttributeError):
+                        skipped += 1
+                        continue
+                    verb = 'INSERT OR REPLACE' if overwrite else 'INSERT OR IGNORE'
+                    cursor = connection.execute(f'{verb} INTO control_points VALUES (?, ?, ?, ?, ?)',
+                                                values)
+                    if cursor.rowcount > 0:
+                        imported += 1
+                    else:
+                        skipped += 1
+            connection.execute("INSERT OR REPLACE INTO settings VALUES ('geojson_imported_at', ?)",
+                               (str(time.time()),))
+        return imported, skipped
+
+    def export_geojson(self, root_dir):
+        """すべての制御点を以前の形式の制御点ファイルとして対象ディレクトリに書き出し、件数を返す"""
+        root = os.path.abspath(root_dir)
+        exported = 0
+        for name, record in self.iter_all():
+            path = os.path.abspath(controls_file_path(root, name))
+            # 対象ディレクトリの外を指す画像名は書き出さない
+            if os.path.commonpath([root, path]) != root:
+                continue
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                continue
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(record, f, ensure_ascii=False, indent=2)
+            exported += 1
+        return exported
+
+    def stats(self):
+        count, = self._connection().execute('SELECT COUNT(*) FROM control_points').fetchone()
+        return {
+            'path': self.path,
+            'images': count,
+            'geojson_imported': self.geojson_imported(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='制御点ストアと以前の形式の制御点ファイルの相互変換')
+    parser.add_argument('command', choices=['stats', 'import', 'export'],
+                        help='stats: 保存件数を表示 / import: 制御点ファイルを取り込む / '
+                             'export: 制御点ファイルとして書き出す')
+    parser.add_argument('target_dir', nargs='?', default='./targets',
+                        help='処理対象の画像が格納されているディレクトリ（デフォルト: ./targets）')
+    parser.add_argument('--store', default=None,
+                        help='制御点ストアのSQLiteファイル（デフォルト: 対象ディレクトリの隣の <ディレクトリ名>.controls.sqlite3）')
+    parser.add_argument('--recursive', action='store_true',
+                        help='import でサブディレクトリの制御点ファイルも取り込む')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='import でストアに制御点がある画像もファイルの内容で置き換える')
+    args = parser.parse_intermixed_args()
+
+    store = ControlPointStore(args.store or default_control_store_path(args.target_dir))
+    if args.command == 'import':
+        imported, skipped = store.import_geojson(args.target_dir, recursive=args.recursive,
+                                                 overwrite=args.overwrite)
+        print(f'{imported}件の制御点を取り込みました（{skipped}件は飛ばしました）。')
+    elif args.command == 'export':
+        print(f'{store.export_geojson(args.target_dir)}件の制御点ファイルを書き出しました。')
+    else:
+        print(json.dumps(store.stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
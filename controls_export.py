@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+全制御点のダウンロード（/api/download-all-controls）の出力形式。
+画像ごとの (画像名, 左上・右上・右下・左下の順の制御点) を受け取り、CSV・GeoJSON・Parquet・Arrow の
+バイト列を少しずつ返すジェネレーター。全体をメモリに持たないため、画像数に関わらずメモリ使用量は一定。
+制御点の座標は画像の画素座標（左上が原点、y は下向き）のまま書き出す。
+"""
+
+import csv
+import io
+import json
+import zlib
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # Parquet・Arrow 形式は pyarrow がインストールされている場合のみ使用できる
+    pyarrow = None
+
+# 制御点の列（左上・右上・右下・左下の順）
+CONTROL_COLUMNS = ['left_top_x', 'left_top_y', 'right_top_x', 'right_top_y',
+                   'right_bottom_x', 'right_bottom_y', 'left_bottom_x', 'left_bottom_y']
+
+# CSVのヘッダー
+CSV_HEADER = ['ファイル名'] + CONTROL_COLUMNS
+
+# テキスト形式で一度に送信するおおよそのバイト数
+CHUNK_SIZE = 64 * 1024
+
+# Parquet・Arrow 形式で一度に書き出す行数（Parquet の行グループ・Arrow のレコードバッチの行数）
+BATCH_ROWS = 4096
+
+
+def _columns(points):
+    """制御点（最大4点）を8列の値にする（ない点は None）"""
+    values = [None] * len(CONTROL_COLUMNS)
+    for i, point in enumerate((points or [])[:4]):
+        values[2 * i], values[2 * i + 1] = point
+    return values
+
+
+def _buffered(pieces):
+    """文字列を CHUNK_SIZE ごとにまとめて UTF-8 のバイト列で返す"""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def csv_chunks(rows):
+    """BOM付きUTF-8のCSV（1行ずつ書き出す。制御点がない画像・ない点は空欄）"""
+    def pieces():
+        output = io.StringIO()
+        writer = csv.writer(output)
+
+        def line(values):
+            writer.writerow(values)
+            text = output.getvalue()
+            output.seek(0)
+            output.truncate()
+            return text
+
+        yield '\ufeff' + line(CSV_HEADER)
+        for name, points in rows:
+            yield line([name] + ['' if value is None else value for value in _columns(points)])
+    return _buffered(pieces())
+
+
+def _geometry(points):
+    """4点ある場合は左上から時計回りに閉じた Polygon、1〜3点の場合は MultiPoint、ない場合は None"""
+    if not points:
+        return None
+    points = [list(point) for point in points[:4]]
+    if len(points) == 4:
+        return {'type': 'Polygon', 'coordinates': [points + [points[0]]]}
+    return {'type': 'MultiPoint', 'coordinates': points}
+
+
+def geojson_chunks(rows):
+    """画像ごとの Feature（properties は CSV と同じ列）からなる FeatureCollection"""
+    def pieces():
+        yield '{"type": "FeatureCollection", "features": ['
+        separator = '\n'
+        for name, points in rows:
+            properties = {'name': name, **dict(zip(CONTROL_COLUMNS, _columns(points)))}
+            feature = {'type': 'Feature', 'geometry': _geometry(points), 'properties': properties}
+            yield separator + json.dumps(feature, ensure_ascii=False)
+            separator = ',\n'
+        yield '\n]}\n'
+    return _buffered(pieces())
+
+
+class _ChunkSink:
+    """pyarrow の書き込み先。書き込まれたバイト列を溜め、take() で取り出す"""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _arrow_schema():
+    return pyarrow.schema([('name', pyarrow.string())] +
+                          [(column, pyarrow.float64()) for column in CONTROL_COLUMNS])
+
+
+def _record_batch(rows, schema):
+    columns = zip(*rows)
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema)
+
+
+def _record_batches(rows, schema):
+    """BATCH_ROWS 行ごとの RecordBatch"""
+    batch = []
+    for name, points in rows:
+        batch.append([name] + _columns(points))
+        if len(batch) == BATCH_ROWS:
+            yield _record_batch(batch, schema)
+            batch = []
+    if batch:
+        yield _record_batch(batch, schema)
+
+
+def _arrow_chunks(rows, open_writer):
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    writer = open_writer(sink, schema)
+    wrote = False
+    for batch in _record_batches(rows, schema):
+        writer.write_batch(batch)
+        wrote = True
+        data = sink.take()
+        if data:
+            yield data
+    if not wrote:
+        # 画像がない場合も列だけのファイルにする
+        writer.write_batch(pyarrow.RecordBatch.from_pylist([], schema=schema))
+    writer.close()
+    yield sink.take()
+
+
+def parquet_chunks(rows):
+    """Parquet（BATCH_ROWS 行ごとの行グループ。画像名と制御点の座標の列）"""
+    return _arrow_chunks(rows, lambda sink, schema: pyarrow.parquet.ParquetWriter(sink, schema))
+
+
+def arrow_chunks(rows):
+    """Arrow IPC ストリーム形式（BATCH_ROWS 行ごとのレコードバッチ）"""
+    return _arrow_chunks(rows, lambda sink, schema: pyarrow.ipc.new_stream(sink, schema))
+
+
+def gzip_chunks(chunks):
+    """バイト列を gzip 形式で圧縮しながら返す"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# 出力形式 -> (ジェネレーター, MIMEタイプ, 拡張子)
+EXPORT_FORMATS = {
+    'csv': (csv_chunks, 'text/csv', '.csv'),
+    'geojson': (geojson_chunks, 'application/geo+json', '.geojson'),
+}
+if pyarrow is not None:
+    EXPORT_FORMATS['parquet'] = (parquet_chunks, 'application/vnd.apache.parquet', '.parquet')
+    EXPORT_FORMATS['arrow'] = (arrow_chunks, 'application/vnd.apache.arrow.stream', '.arrows')
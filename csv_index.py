@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+交点CSV（intersections.csv）のサイドカー索引。
+CSV全体を読み込まずにプレビューのページ送りができるよう、
+行数・エラー行数・一定行数ごとの行の位置（バイト数）を <CSVのパス>.index.json に保存する。
+画像ごとの成功/失敗は索引には持たず、追記された行の分だけ status_store（画像の索引 ImageCatalog）に反映する。
+
+バッチ処理はCSVに行を追記していくため、前回から追記された部分だけを読んで索引を更新する。
+CSVが作り直された場合（ファイルが置き換えられた・短くなった・索引の末尾と内容が異なる）は最初から作り直す。
+"""
+
+import csv
+import json
+import os
+import threading
+import uuid
+import zlib
+
+# 行の位置を記録する間隔（行数）
+CHECKPOINT_INTERVAL = 1000
+
+# 索引の形式のバージョン（形式を変えた場合は上げる。異なる索引は作り直す）
+INDEX_VERSION = 2
+
+# 追記されたかどうかの確認に使う、索引済みの部分の末尾のバイト数
+_TAIL_BYTES = 64
+
+
+def index_path(csv_path):
+    """CSVの索引のパス（例: intersections.csv -> intersections.csv.index.json）"""
+    return csv_path + '.index.json'
+
+
+def iter_records(f, offset):
+    """
+    バイナリモードで開いたCSVの offset から、(開始位置, 終了位置, 行) を順に返す
+    引用符で囲まれた改行を含む行にも対応する。改行で終わっていない末尾の行（書き込み途中の行）は返さない
+    """
+    f.seek(offset)
+    start = offset
+    pending = b''
+    while True:
+        line = f.readline()
+        if not line:
+            return
+        pending += line
+        if not pending.endswith(b'\n'):
+            return
+        # 引用符の数が奇数の場合は、引用符で囲まれた改行の途中
+        if pending.count(b'"') % 2:
+            continue
+        end = start + len(pending)
+        text = pending.decode('utf-8')
+        row = next(csv.reader([text]), [])
+        yield start, end, row
+        start = end
+        pending = b''
+
+
+def _empty_index():
+    return {
+        'version': INDEX_VERSION,
+        'generation': uuid.uuid4().hex,  # 索引を作り直すたびに変わる（カーソル・status_store との対応の確認に使う）
+        'inode': None,
+        'size': 0,
+        'tail': '',
+        'header': None,
+        'data_offset': 0,
+        'end_offset': 0,
+        'rows': 0,
+        'error_rows': 0,
+        'checkpoints': [],  # [行番号（0始まり、ヘッダーを除く）, 位置] を CHECKPOINT_INTERVAL 行ごとに
+    }
+
+
+def _state(index):
+    """status_store に反映済みの時点を表す文字列（索引の世代と索引済みの末尾の位置）"""
+    return f"{index['generation']}:{index['end_offset']}"
+
+
+class CsvIndex:
+    """
+    交点CSVの索引
+    load() はCSVが変わっていれば索引を更新してから返す（索引はメモリとサイドカーファイルに保持する）
+    status_store を指定した場合は、画像ごとの成功/失敗（同じ画像の行が複数ある場合は最後の行）を
+    status_store.update_csv_statuses で反映する。status_store は反映済みの時点（csv_status_state）を保持し、
+    サイドカーファイルの時点と異なる場合（記録先を作り直した場合など）は索引を作り直して反映し直す
+    """
+
+    def __init__(self, csv_path, status_store=None):
+        self.csv_path = csv_path
+        self.index_path = index_path(csv_path)
+        self.status_store = status_store
+        self._index = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        最新の索引を返す（CSVがない場合はNone）
+        header: ヘッダー行、rows: データ行数、error_rows: エラー行数
+        """
+        with self._lock:
+            try:
+                stat = os.stat(self.csv_path)
+            except FileNotFoundError:
+                self._index = None
+                if self.status_store is not None and self.status_store.csv_status_state() is not None:
+                    self.status_store.update_csv_statuses({}, None, reset=True)
+                return None
+            index = self._index
+            if index is None:
+                index = self._read_sidecar()
+                if (self.status_store is not None
+                        and self.status_store.csv_status_state() != _state(index)):
+                    index = _empty_index()
+            if index['inode'] == stat.st_ino and index['size'] == stat.st_size:
+                self._index = index
+                return index
+
+            with open(self.csv_path, 'rb') as f:
+                rebuilt = not self._is_prefix(index, f, stat)
+                if rebuilt:
+                    index = _empty_index()
+                else:
+                    # 返した索引を使っている呼び出し側に影響しないよう、コピーに追加する
+                    # （checkpoints は追記するだけで、呼び出し側は自身の rows より前しか参照しないため共有する）
+                    index = dict(index)
+                statuses = self._extend(index, f)
+            index['inode'] = stat.st_ino
+            index['size'] = stat.st_size
+            if self.status_store is not None:
+                self.status_store.update_csv_statuses(statuses, _state(index), reset=rebuilt)
+            self._index = index
+            self._write_sidecar(index)
+            return index
+
+    def _read_sidecar(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('version') == INDEX_VERSION:
+                return index
+        except (OSError, ValueError):
+            pass
+        return _empty_index()
+
+    def _write_sidecar(self, index):
+        """索引を保存する（保存できない場合はメモリ上の索引だけを使う）"""
+        tmp_path = f'{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _is_prefix(index, f, stat):
+        """索引済みの部分が現在のCSVの先頭と同じか（追記されただけか）"""
+        end = index['end_offset']
+        if index['inode'] != stat.st_ino or stat.st_size < end:
+            return False
+        tail_start = max(0, end - _TAIL_BYTES)
+        f.seek(tail_start)
+        return f.read(end - tail_start).hex() == index['tail']
+
+    @staticmethod
+    def _extend(index, f):
+        """索引済みの位置から末尾までの行を索引に加え、加えた行の画像ごとの成功/失敗を返す"""
+        error_column = None
+        if index['header'] is not None and 'error' in index['header']:
+            error_column = index['header'].index('error')
+
+        statuses = {}
+        end = index['end_offset']
+        for start, end, row in iter_records(f, index['end_offset']):
+            if index['header'] is None:
+                index['header'] = row
+                index['data_offset'] = end
+                if 'error' in row:
+                    error_column = row.index('error')
+                continue
+            if index['rows'] % CHECKPOINT_INTERVAL == 0:
+                index['checkpoints'].append([index['rows'], start])
+            index['rows'] += 1
+            failed = error_column is not None and len(row) > error_column and row[error_column] != ''
+            if failed:
+                index['error_rows'] += 1
+            if row:
+                statuses[row[0]] = 'error' if failed else 'success'
+
+        index['end_offset'] = end
+        tail_start = max(0, end - _TAIL_BYTES)
+        f.seek(tail_start)
+        index['tail'] = f.read(end - tail_start).hex()
+        return statuses
+
+    def make_cursor(self, offset, index=None):
+        """
+        行の位置（read_rows の次の行の位置）をカーソルの文字列にする
+        索引の世代を含めたチェックサムを付け、作り直したCSVや書き換えたカーソルを parse_cursor で検出できるようにする
+        """
+        index = index or self.load()
+        checksum = zlib.crc32(f"{index['generation']}:{offset}".encode('ascii'))
+        return f'{offset}.{checksum:08x}'
+
+    def parse_cursor(self, cursor, index=None):
+        """make_cursor で作ったカーソルを行の位置に戻す（現在の索引のものでない場合は ValueError）"""
+        index = index or self.load()
+        try:
+            offset = int(cursor.split('.', 1)[0])
+        except ValueError:
+            raise ValueError(f'cursor が不正です: {cursor}') from None
+        if (index is None or self.make_cursor(offset, index) != cursor
+                or not index['data_offset'] <= offset <= index['end_offset']):
+            raise ValueError(f'cursor が不正か、CSVが作り直されています: {cursor}')
+        return offset
+
+    def offset_of_row(self, row_number):
+        """データ行の行番号（0始まり）の位置（バイト数）。行数以上の場合は索引済みの末尾"""
+        index = self.load()
+        if index is None:
+            return None
+        if row_number >= index['rows']:
+            return index['end_offset']
+        checkpoint = index['checkpoints'][row_number // CHECKPOINT_INTERVAL]
+        offset = checkpoint[1]
+        skip = row_number - checkpoint[0]
+        if skip == 0:
+            return offset
+        with open(self.csv_path, 'rb') as f:
+            for i, (_, end, _) in enumerate(iter_records(f, offset), 1):
+                if i == skip:
+                    return end
+        return index['end_offset']
+
+    def read_rows(self, offset, limit, predicate=None):
+        """
+        位置 offset（データ行の先頭）から、predicate に合う行を最大 limit 行読む
+        戻り値は (行のリスト, 次の行の位置)。索引済みの末尾まで読んだ場合は次の行の位置は None
+        """
+        index = self.load()
+        if index is None:
+            return [], None
+        offset = max(offset, index['data_offset'])
+        rows = []
+        with open(self.csv_path, 'rb') as f:
+            for start, end, row in iter_records(f, offset):
+                if end > index['end_offset']:
+                    break
+                if predicate is None or predicate(row):
+                    if len(rows) == limit:
+                        return rows, start
+                    rows.append(row)
+                if end == index['end_offset']:
+                    break
+        return rows, None
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+画像ファイルのハッシュ値の計算とキャッシュ。
+ハッシュ値は (パス, アルゴリズム) ごとにファイルのサイズ・更新時刻・inode 番号とともに
+SQLiteファイルに保存し、これらが変わっていないファイルはサーバーを再起動しても再度読み込まない。
+"""
+
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+    import xxhash
+except ImportError:  # xxhash はインストールされている場合のみ使用する
+    xxhash = None
+
+# ハッシュ値の計算で一度に処理するサイズ
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+# 以前から制御点ファイルに記録しているアルゴリズム（hash_algorithm がない制御点ファイルはこれとみなす）
+DEFAULT_HASH_ALGORITHM = 'md5'
+
+
+class _Crc32:
+    "zlib.crc32 を hashlib と同じ update / hexdigest で使うためのクラス（暗号学的ハッシュではないが高速）"
+
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self):
+        return format(self._value, '08x')
+
+
+# 選択できるアルゴリズム
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+    'crc32': _Crc32,
+}
+if xxhash is not None:
+    HASH_ALGORITHMS['xxh3_64'] = xxhash.xxh3_64
+
+
+def compute_digest(path, algorithm=DEFAULT_HASH_ALGORITHM):
+    """ファイル全体のハッシュ値を計算（mmap で読み込み、大きな単位でまとめて処理する）"""
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f'Unsupported hash algorithm: {algorithm}')
+    hasher = HASH_ALGORITHMS[algorithm]()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:  # 空のファイルは mmap できない
+            return hasher.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, HASH_CHUNK_SIZE):
+                    hasher.update(view[offset:offset + HASH_CHUNK_SIZE])
+            finally:
+                view.release()
+    return hasher.hexdigest()
+
+
+def default_hash_cache_path(target_dir):
+    """対象ディレクトリの隣に置くハッシュ値のキャッシュのパス（例: ./targets -> ./targets.hashes.sqlite3）"""
+    target_dir = os.path.abspath(target_dir)
+    return os.path.join(os.path.dirname(target_dir),
+                        os.path.basename(target_dir) + '.hashes.sqlite3')
+
+
+def _file_signature(stat):
+    "ファイルが変更されていないかの判定に使う (サイズ, 更新時刻, inode)"
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+class FileHashCache:
+    """
+    ハッシュ値のキャッシュ
+    path にSQLiteファイルを指定すると再起動後も保持する（None の場合はメモリ上のみ）
+    他のテーブルと同じSQLiteファイルを共有してもよい
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._memory = {}  # (絶対パス, アルゴリズム) -> ((サイズ, 更新時刻, inode), ハッシュ値)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            connection = self._connection()
+            with connection:
+                connection.execute('''
+                    CREATE TABLE IF NOT EXISTS file_hashes (
+                        path TEXT NOT NULL,
+                        algorithm TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL,
+                        inode INTEGER NOT NULL,
+                        digest TEXT NOT NULL,
+                        updated_at REAL NOT NULL,
+                        PRIMARY KEY (path, algorithm)
+                    )
+                ''')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def digest(self, path, algorithm=DEFAULT_HASH_ALGORITHM):
+        """ファイルのハッシュ値（サイズ・更新時刻・inode が前回と同じならファイルを読まない）"""
+        abspath = os.path.abspath(path)
+        signature = _file_signature(os.stat(abspath))
+        key = (abspath, algorithm)
+
+        with self._lock:
+            cached = self._memory.get(key)
+        if cached is None and self.path is not None:
+            row = self._connection().execute(
+                'SELECT size, mtime_ns, inode, digest FROM file_hashes WHERE path = ? AND algorithm = ?',
+                key).fetchone()
+            if row is not None:
+                cached = (tuple(row[:3]), row[3])
+        if cached is not None and cached[0] == signature:
+            with self._lock:
+                self._memory[key] = cached
+                self.hits += 1
+            return cached[1]
+
+        digest = compute_digest(abspath, algorithm)
+        with self._lock:
+            self._memory[key] = (signature, digest)
+            self.misses += 1
+        if self.path is not None:
+            connection = self._connection()
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    key + signature + (digest, time.time()))
+        return digest
+
+    def stats(self):
+        with self._lock:
+            return {
+                'path': self.path,
+                'entries': len(self._memory),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+パラメータ調整用の画像キャッシュ。
+デコード結果と前処理の各段階（グレースケール・二値化・Hough変換）やタイル表示用の縮小画像を
+メモリ使用量の上限付きLRUで保持し、下流のパラメータだけが変わった場合は上流の結果を再利用する。
+"""
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+from functools import partial
+
+import cv2
+import numpy as np
+
+from line_detector import (
+    DecodedImage,
+    load_image,
+    to_grayscale,
+    binarize,
+    hough_lines,
+    hough_lines_with_votes,
+    select_lines_by_votes,
+)
+from pipeline import LinePipeline, preview_scale, resize_preview
+
+_MISSING = object()
+
+# 投票数付きの直線を求める際の投票数の下限（要求された line_accumulation に対する割合）
+# line_accumulation をこの割合まで下げても、投票し直さずに絞り込むだけで済む
+HOUGH_VOTES_MARGIN = 0.5
+
+
+def estimate_nbytes(value):
+    """キャッシュする値のおおよそのメモリ使用量（バイト）"""
+    if value is None:
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_nbytes(v) for v in value)
+    if isinstance(value, (int, float)):
+        return sys.getsizeof(value)
+    return 0
+
+
+class LRUCache:
+    """
+    メモリ使用量（バイト数）の上限付きLRUキャッシュ
+    上限を超えた場合は最も長く使われていない項目から破棄する
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # key -> (value, nbytes)
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """値を取得し、最近使った項目として扱う"""
+        with self._lock:
+            item = self._items.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, nbytes=None):
+        """値を登録する（上限より大きい値は登録しない）"""
+        if nbytes is None:
+            nbytes = estimate_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._current_bytes -= old[1]
+            self._items[key] = (value, nbytes)
+            self._current_bytes += nbytes
+            while self._current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._items.popitem(last=False)
+                self._current_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def resize(self, key, nbytes):
+        """
+        登録済みの値のメモリ使用量を更新する（登録後に大きさが変わる値のため）
+        上限を超えた場合は最も長く使われていない項目から破棄し、登録されていない場合は何もしない
+        """
+        with self._lock:
+            item = self._items.get(key, _MISSING)
+            if item is _MISSING:
+                return
+            self._items[key] = (item[0], nbytes)
+            self._current_bytes += nbytes - item[1]
+            while self._current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._items.popitem(last=False)
+                self._current_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        """キャッシュになければ compute() で計算して登録する"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            _freeze(value)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._items),
+                'bytes': self._current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def _freeze(value):
+    """キャッシュした配列が呼び出し側で書き換えられないよう読み取り専用にする"""
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+
+
+class ImageCache:
+    """
+    画像処理の各段階をキャッシュするクラス
+    キーには画像の絶対パス・更新時刻・サイズと、その段階までのパラメータを含めるため、
+    ファイルが更新された場合は自動的に別のキーとなる
+    """
+
+    def __init__(self, max_bytes):
+        self._lru = LRUCache(max_bytes)
+
+    def _file_key(self, image_path):
+        stat = os.stat(image_path)
+        return (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+
+    def color(self, image_path):
+        """デコードしたカラー画像（読み込みに失敗した場合はNone、キャッシュしない）"""
+        key = ('color',) + self._file_key(image_path)
+        color = self._lru.get(key)
+        if color is None:
+            decoded = load_image(image_path)
+            if decoded is None:
+                return None
+            color = decoded.color
+            _freeze(color)
+            self._lru.put(key, color)
+        return color
+
+    def decoded(self, image_path):
+        """キャッシュ済みのカラー・グレースケール画像を共有する DecodedImage"""
+        color = self.color(image_path)
+        if color is None:
+            return None
+        return DecodedImage(color=color, gray=self.gray(image_path))
+
+    def scaled(self, image_path, level):
+        """
+        カラー画像を1/2^level に縮小した画像（タイル表示用、読み込みに失敗した場合はNone）
+        1段ずつ縮小し、途中の段階もキャッシュする
+        """
+        if level <= 0:
+            return self.color(image_path)
+        if self.color(image_path) is None:
+            return None
+        key = ('scaled',) + self._file_key(image_path) + (level,)
+
+        def compute():
+            upper = self.scaled(image_path, level - 1)
+            height, width = upper.shape[:2]
+            return cv2.resize(upper, ((width + 1) // 2, (height + 1) // 2),
+                              interpolation=cv2.INTER_AREA)
+        return self._lru.get_or_compute(key, compute)
+
+    def preview(self, image_path, max_dimension):
+        """長辺が max_dimension 以下になるよう縮小したカラー画像（読み込みに失敗した場合はNone）"""
+        color = self.color(image_path)
+        if color is None:
+            return None
+        height, width = color.shape[:2]
+        if preview_scale(width, height, max_dimension) == 1.0:
+            return color
+        key = ('preview',) + self._file_key(image_path) + (max_dimension,)
+        return self._lru.get_or_compute(key, lambda: resize_preview(color, max_dimension))
+
+    def gray(self, image_path):
+        """グレースケール画像"""
+        key = ('gray',) + self._file_key(image_path)
+        return self._lru.get_or_compute(key, lambda: to_grayscale(self.color(image_path)))
+
+    def binary(self, image_path, binary_threshold):
+        """二値化した画像"""
+        key = ('binary',) + self._file_key(image_path) + (binary_threshold,)
+        return self._lru.get_or_compute(
+            key, lambda: binarize(self.gray(image_path), binary_threshold))
+
+    def detect_lines(
+        self,
+        image_path,
+        binary_threshold=100,
+        erode_kernel=3,
+        erode_iteration=2,
+        line_accumulation=10000,
+        rho_precision=2,
+        theta_precision=np.pi/90,
+        pyramid_levels=0,
+        border_band=0,
+    ):
+        """
+        line_detector.detect_lines と同じ結果をキャッシュ経由で返す
+        Hough変換は detect_lines と同様に erode 前の二値画像に対して行うため、
+        キーに erode のパラメータは含めず、erode も行わない
+        pyramid_levels・border_band が0の場合は hough_votes の結果を line_accumulation で絞り込むため、
+        line_accumulation だけを変えた場合は投票し直さない
+        """
+        if self.color(image_path) is None:
+            return None
+
+        # erode の結果は Hough変換に使わないため計算しない（キャッシュの容量を無駄にしない）
+        key = ('hough',) + self._file_key(image_path) + (
+            binary_threshold, rho_precision, theta_precision, line_accumulation,
+            pyramid_levels, border_band)
+
+        def compute():
+            if pyramid_levels == 0 and border_band == 0:
+                # 投票数付きの直線を閾値で絞り込む（cv2.HoughLines と同じ結果）
+                votes = self.hough_votes(image_path, binary_threshold, rho_precision,
+                                         theta_precision, line_accumulation)
+                return select_lines_by_votes(votes, line_accumulation)
+            return hough_lines(self.binary(image_path, binary_threshold),
+                               rho_precision, theta_precision, line_accumulation,
+                               pyramid_levels=pyramid_levels, border_band=border_band)
+        return self._lru.get_or_compute(key, compute)
+
+    def hough_votes(self, image_path, binary_threshold, rho_precision, theta_precision,
+                    line_accumulation):
+        """
+        line_accumulation で絞り込める投票数付きの直線（hough_lines_with_votes の結果）
+        キャッシュ済みの結果の投票数の下限が line_accumulation 以下ならそれをそのまま使い、
+        そうでなければ line_accumulation * HOUGH_VOTES_MARGIN を下限として投票し直す
+        """
+        key = ('hough_votes',) + self._file_key(image_path) + (
+            binary_threshold, rho_precision, theta_precision)
+        cached = self._lru.get(key)
+        if cached is not None and cached[0] <= line_accumulation:
+            return cached[1]
+        min_votes = int(line_accumulation * HOUGH_VOTES_MARGIN)
+        votes = hough_lines_with_votes(self.binary(image_path, binary_threshold),
+                                       rho_precision, theta_precision, min_votes)
+        _freeze(votes)
+        self._lru.put(key, (min_votes, votes))
+        return votes
+
+    def pipeline(self, image_path, image_size=None):
+        """
+        画像ごとの LinePipeline（読み込みに失敗した場合はNone）
+        パイプラインは画像そのものを保持せず、必要なときにキャッシュから取り出す
+        パイプラインが保持する各段階の結果の大きさは、段階を計算するたびにキャッシュの使用量に反映する
+        image_size（幅, 高さ）を指定した場合は、パイプラインを作るときに画像をデコードしない
+        （結果ストアの結果を restore して描画しない場合など）
+        """
+        key = ('pipeline',) + self._file_key(image_path)
+        pipeline = self._lru.get(key)
+        if pipeline is None:
+            if image_size is None:
+                color = self.color(image_path)
+                if color is None:
+                    return None
+                image_size = (color.shape[1], color.shape[0])
+            image = CachedImage(self, image_path, *image_size)
+            pipeline = LinePipeline(
+                image, detector=partial(self.detect_lines, image_path),
+                previewer=partial(self.preview, image_path),
+                on_memo_change=lambda changed: self._lru.resize(
+                    key, estimate_nbytes(changed.memoized())))
+            self._lru.put(key, pipeline, nbytes=0)
+        return pipeline
+
+    def clear(self):
+        self._lru.clear()
+
+    def stats(self):
+        return self._lru.stats()
+
+
+class CachedImage:
+    """
+    ImageCache 上の画像を参照する DecodedImage 互換のオブジェクト
+    画像の配列は保持しないため、キャッシュから破棄された場合は再度デコードされる
+    """
+
+    def __init__(self, cache, image_path, width, height):
+        self._cache = cache
+        self._image_path = image_path
+        self.width = width
+        self.height = height
+
+    @property
+    def color(self):
+        return self._cache.color(self._image_path)
+
+    @property
+    def gray(self):
+        return self._cache.gray(self._image_path)
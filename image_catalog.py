@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+対象ディレクトリの画像の索引（SQLite）。
+画像ごとのサイズ・更新時刻・画像の大きさ・制御点の有無・ハッシュ値・交点CSVの処理結果を保持し、
+一覧の取得のたびに os.listdir と画像ごとの os.path.exists を行わずに済むようにする。
+
+索引の更新は差分で行う:
+- ディレクトリの更新時刻が前回から変わっていなければ、そのディレクトリの中は読み直さない
+  （ファイルの追加・削除・名前の変更ではディレクトリの更新時刻が変わる）
+- 更新時刻が変わったディレクトリだけを読み直し、サイズ・更新時刻が変わった画像だけ大きさを読み直す
+- 同じ名前のまま上書きされた画像はディレクトリの更新時刻が変わらないため、
+  full_refresh_interval ごとにすべてのディレクトリを読み直して反映する
+- 更新は refresh_interval に1回まで（それより短い間隔の呼び出しでは索引をそのまま使う）
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+# 画像として扱う拡張子
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# 制御点ファイルの接尾辞（<画像ファイル名>.controls.geojson）
+CONTROLS_SUFFIX = '.controls.geojson'
+
+# 更新時刻がこの時間（ナノ秒）以内のディレクトリは、同じ時刻のうちにさらに変更される可能性があるため、
+# 次回の更新でも読み直す
+_RECENT_NS = 2 * 1000 * 1000 * 1000
+
+
+def default_catalog_path(target_dir):
+    """対象ディレクトリの隣に置く索引のパス（例: ./targets -> ./targets.catalog.sqlite3）"""
+    target_dir = os.path.abspath(target_dir)
+    return os.path.join(os.path.dirname(target_dir),
+                        os.path.basename(target_dir) + '.catalog.sqlite3')
+
+
+def image_dimensions(path):
+    """
+    JPEG・PNGのヘッダーから画像の (幅, 高さ) を読み取る（画像全体はデコードしない）
+    読み取れない場合は (None, None)。EXIFの回転は考慮しない
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(26)
+            if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+                return struct.unpack('>II', head[16:24])
+            if not head.startswith(b'\xff\xd8'):
+                return None, None
+            # JPEG: SOFマーカーまでセグメントを読み飛ばす
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None, None
+                if marker[1] == 0xFF:  # 埋め草
+                    f.seek(-1, os.SEEK_CUR)
+                    continue
+                if marker[1] in (0x01,) or 0xD0 <= marker[1] <= 0xD7:  # 長さのないマーカー
+                    continue
+                length = struct.unpack('>H', f.read(2))[0]
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack('>xHH', f.read(5))
+                    return width, height
+                f.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return None, None
+
+
+class ImageCatalog:
+    """
+    対象ディレクトリの画像の索引
+    画像名は対象ディレクトリからの相対パス（区切りは /）。recursive=True の場合はサブディレクトリも含める
+    制御点の有無は control_store（ControlPointStore）を指定した場合はストアから、
+    指定しない場合は以前の形式の制御点ファイル（<画像ファイル名>.controls.geojson）の有無から求める
+    SQLiteファイルはWALモードで開き、接続はスレッドごとに作成する
+    """
+
+    def __init__(self, root_dir, path, recursive=False, refresh_interval=2.0,
+                 full_refresh_interval=600.0, control_store=None):
+        self.root_dir = root_dir
+        self.path = path
+        self.recursive = recursive
+        self.control_store = control_store
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+        self._last_refresh = None
+        self._last_full_refresh = None
+        self.scanned_directories = 0  # 読み直したディレクトリの累計
+        self._create_tables()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _create_tables(self):
+        connection = self._connection()
+        with connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS images (
+                    name TEXT PRIMARY KEY,
+                    directory TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    width INTEGER,
+                    height INTEGER,
+                    has_controls INTEGER NOT NULL,
+                    hash TEXT,
+                    hash_algorithm TEXT
+                )
+            ''')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS images_directory ON images (directory)')
+            # mtime_ns が NULL のディレクトリは次回の更新で必ず読み直す
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS directories (
+                    path TEXT PRIMARY KEY,
+                    parent TEXT,
+                    mtime_ns INTEGER
+                )
+            ''')
+            # 画像ごとの交点CSVの処理結果（csv_index.CsvIndex が追記された行の分だけ反映する）
+            # 画像を読み直しても消えないよう images とは別に保持する
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS image_statuses (
+                    name TEXT PRIMARY KEY,
+                    status TEXT NOT NULL
+                )
+            ''')
+            # 以前と異なる設定（対象ディレクトリ・recursive・制御点の有無の求め方）の索引は作り直す
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            settings = json.dumps({'root_dir': os.path.abspath(self.root_dir),
+                                   'recursive': self.recursive,
+                                   'controls': 'files' if self.control_store is None else 'store'})
+            row = connection.execute(
+                "SELECT value FROM settings WHERE key = 'settings'").fetchone()
+            if row is None or row[0] != settings:
+                connection.execute('DELETE FROM images')
+                connection.execute('DELETE FROM directories')
+                connection.execute(
+                    "INSERT OR REPLACE INTO settings VALUES ('settings', ?)", (settings,))
+
+    def refresh(self, force=False, full=False):
+        """
+        索引を更新する（前回の更新から refresh_interval 以内の場合は何もしない。force=True で必ず更新）
+        full=True の場合（または前回の読み直しから full_refresh_interval 経過した場合）はすべてのディレクトリを読み直す
+        更新した場合は True を返す
+        """
+        with self._refresh_lock:
+            now = time.monotonic()
+            if (not force and not full and self._last_refresh is not None
+                    and now - self._last_refresh < self.refresh_interval):
+                return False
+            if self._last_full_refresh is None or now - self._last_full_refresh >= self.full_refresh_interval:
+                full = True
+
+            connection = self._connection()
+            with connection:
+                known = {path: (parent, mtime_ns) for path, parent, mtime_ns in connection.execute(
+                    'SELECT path, parent, mtime_ns FROM directories')}
+                seen = set()
+                stack = ['']
+                while stack:
+                    directory = stack.pop()
+                    absolute = os.path.join(self.root_dir, directory) if directory else self.root_dir
+                    try:
+                        mtime_ns = os.stat(absolute).st_mtime_ns
+                    except OSError:
+                        continue
+                    seen.add(directory)
+                    if not full and directory in known and known[directory][1] == mtime_ns:
+                        # 変更なし: 記録済みのサブディレクトリだけを辿る
+                        stack.extend(path for path, (parent, _) in known.items()
+                                     if parent == directory)
+                        continue
+                    stack.extend(self._scan_directory(connection, directory, absolute, mtime_ns))
+
+                # なくなったディレクトリの画像を削除
+                for directory in set(known) - seen:
+                    connection.execute('DELETE FROM images WHERE directory = ?', (directory,))
+                    connection.execute('DELETE FROM directories WHERE path = ?', (directory,))
+
+            self._last_refresh = now
+            if full:
+                self._last_full_refresh = now
+            return True
+
+    def _scan_directory(self, connection, directory, absolute, mtime_ns):
+        """1つのディレクトリを読み直して索引を更新し、サブディレクトリ（相対パス）のリストを返す"""
+        self.scanned_directories += 1
+        images = {}
+        controls = set()
+        subdirectories = []
+        try:
+            with os.scandir(absolute) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.recursive and not name.startswith('.'):
+                            subdirectories.append(f'{directory}/{name}' if directory else name)
+                    elif name.lower().endswith(IMAGE_EXTENSIONS):
+                        images[name] = entry
+                    elif name.endswith(CONTROLS_SUFFIX) and self.control_store is None:
+                        name = name[:-len(CONTROLS_SUFFIX)]
+                        controls.add(f'{directory}/{name}' if directory else name)
+        except OSError:
+            pass
+        if self.control_store is not None:
+            controls = self.control_store.names(f'{directory}/' if directory else None)
+
+        existing = {name: (size, mtime, has_controls) for name, size, mtime, has_controls in
+                    connection.execute('SELECT name, size, mtime_ns, has_controls FROM images '
+                                       'WHERE directory = ?', (directory,))}
+        current = set()
+        for file_name, entry in images.items():
+            name = f'{directory}/{file_name}' if directory else file_name
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            current.add(name)
+            has_controls = int(name in controls)
+            old = existing.get(name)
+            if old is not None and old[:2] == (stat.st_size, stat.st_mtime_ns):
+                if old[2] != has_controls:
+                    connection.execute('UPDATE images SET has_controls = ? WHERE name = ?',
+                                       (has_controls, name))
+                continue
+            # 新しい画像・変更された画像は大きさを読み直す（ハッシュ値は破棄する）
+            width, height = image_dimensions(entry.path)
+            connection.execute(
+                'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, NULL, NULL)',
+                (name, directory, stat.st_size, stat.st_mtime_ns, width, height, has_controls))
+
+        for name in set(existing) - current:
+            connection.execute('DELETE FROM images WHERE name = ?', (name,))
+
+        # 更新時刻が新しすぎるディレクトリは次回も読み直す
+        recent = time.time_ns() - mtime_ns < _RECENT_NS
+        connection.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)',
+                           (directory, _parent(directory), None if recent else mtime_ns))
+        for subdirectory in subdirectories:
+            connection.execute('INSERT OR IGNORE INTO directories VALUES (?, ?, NULL)',
+                               (subdirectory, directory))
+        return subdirectories
+
+    def list_images(self, prefix=None, has_controls=None, after=None, limit=None, status=None):
+        """
+        画像の情報を画像名の順に返す（呼び出し前に索引を更新する）
+        prefix: 画像名の先頭（サブディレクトリの指定にも使える）
+        has_controls: True / False の場合は制御点がある / ない画像だけ
+        after: この画像名より後の画像だけ（ページ送りのカーソル）
+        limit: 返す件数の上限
+        status: 交点CSVの処理結果がこの値の画像だけ（'unprocessed' は交点CSVに行がない画像）
+        """
+        self.refresh()
+        query, values = self._filter(prefix, has_controls, after, status)
+        query = ('SELECT name, size, mtime_ns, width, height, has_controls, hash, hash_algorithm, '
+                 '(SELECT status FROM image_statuses WHERE image_statuses.name = images.name) '
+                 f'FROM images{query} ORDER BY name')
+        if limit is not None:
+            query += ' LIMIT ?'
+            values.append(limit)
+        return [
+            {
+                'name': name,
+                'size': size,
+                'mtime_ns': mtime_ns,
+                'width': width,
+                'height': height,
+                'has_controls': bool(controls),
+                'hash': digest,
+                'hash_algorithm': algorithm,
+                'status': status or 'unprocessed',
+            }
+            for name, size, mtime_ns, width, height, controls, digest, algorithm, status
+            in self._connection().execute(query, values)
+        ]
+
+    def names(self, prefix=None, has_controls=None, status=None):
+        """画像名のリスト（画像名の順。呼び出し前に索引を更新する）"""
+        self.refresh()
+        query, values = self._filter(prefix, has_controls, None, status)
+        return [name for name, in self._connection().execute(
+            f'SELECT name FROM images{query} ORDER BY name', values)]
+
+    def count(self, prefix=None, has_controls=None, status=None):
+        """条件に合う画像の数（呼び出し前に索引を更新する）"""
+        self.refresh()
+        query, values = self._filter(prefix, has_controls, None, status)
+        return self._connection().execute(f'SELECT COUNT(*) FROM images{query}', values).fetchone()[0]
+
+    @staticmethod
+    def _filter(prefix, has_controls, after, status=None):
+        conditions = []
+        values = []
+        if prefix:
+            # 文字列の範囲で絞り込む（インデックスを使える）
+            conditions.append('name >= ? AND name < ?')
+            values.extend([prefix, prefix + '\U0010ffff'])
+        if has_controls is not None:
+            conditions.append('has_controls = ?')
+            values.append(int(bool(has_controls)))
+        if after is not None:
+            conditions.append('name > ?')
+            values.append(after)
+        if status == 'unprocessed':
+            conditions.append('name NOT IN (SELECT name FROM image_statuses)')
+        elif status is not None:
+            conditions.append('name IN (SELECT name FROM image_statuses WHERE status = ?)')
+            values.append(status)
+        return (' WHERE ' + ' AND '.join(conditions)) if conditions else '', values
+
+    def csv_status_state(self):
+        """交点CSVの処理結果をどこまで反映したか（csv_index.CsvIndex が記録した値。ない場合は None）"""
+        row = self._connection().execute(
+            "SELECT value FROM settings WHERE key = 'csv_status_state'").fetchone()
+        return row[0] if row is not None else None
+
+    def update_csv_statuses(self, statuses, state, reset=False):
+        """
+        交点CSVの処理結果（画像名 -> 処理結果）を反映し、反映した位置 state を記録する
+        reset=True の場合は以前の処理結果をすべて削除してから反映する（CSVが作り直された場合）
+        """
+        connection = self._connection()
+        with connection:
+            if reset:
+                connection.execute('DELETE FROM image_statuses')
+            connection.executemany('INSERT OR REPLACE INTO image_statuses VALUES (?, ?)',
+                                   statuses.items())
+            if state is None:
+                connection.execute("DELETE FROM settings WHERE key = 'csv_status_state'")
+            else:
+                connection.execute("INSERT OR REPLACE INTO settings VALUES ('csv_status_state', ?)",
+                                   (state,))
+
+    def set_controls(self, name, has_controls):
+        """制御点の保存・削除を索引に反映する"""
+        connection = self._connection()
+        with connection:
+            connection.execute('UPDATE images SET has_controls = ? WHERE name = ?',
+                               (int(bool(has_controls)), name))
+
+    def clear_controls(self):
+        """すべての制御点の削除を索引に反映する"""
+        connection = self._connection()
+        with connection:
+            connection.execute('UPDATE images SET has_controls = 0 WHERE has_controls != 0')
+
+    def set_hash(self, name, image_path, algorithm, digest):
+        """
+        計算した画像のハッシュ値を記録する
+        索引のサイズ・更新時刻が現在のファイルと異なる場合（索引の更新前に変更された場合）は記録しない
+        """
+        stat = os.stat(image_path)
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'UPDATE images SET hash = ?, hash_algorithm = ? '
+                'WHERE name = ? AND size = ? AND mtime_ns = ?',
+                (digest, algorithm, name, stat.st_size, stat.st_mtime_ns))
+
+    def stats(self):
+        connection = self._connection()
+        images, with_controls = connection.execute(
+            'SELECT COUNT(*), SUM(has_controls) FROM images').fetchone()
+        directories, = connection.execute('SELECT COUNT(*) FROM directories').fetchone()
+        return {
+            'path': self.path,
+            'recursive': self.recursive,
+            'images': images,
+            'with_controls': with_controls or 0,
+            'directories': directories,
+            'scanned_directories': self.scanned_directories,
+        }
+
+
+def _parent(directory):
+    """相対パスの親ディレクトリ（対象ディレクトリ自体は None）"""
+    if directory == '':
+        return None
+    return directory.rsplit('/', 1)[0] if '/' in directory else ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='画像の索引を更新して件数を表示')
+    parser.add_argument('target_dir', nargs='?', default='./targets',
+                        help='処理対象の画像が格納されているディレクトリ（デフォルト: ./targets）')
+    parser.add_argument('--catalog', default=None,
+                        help='索引のSQLiteファイル（デフォルト: 対象ディレクトリの隣の <ディレクトリ名>.catalog.sqlite3）')
+    parser.add_argument('--recursive', action='store_true',
+                        help='サブディレクトリの画像も含める')
+    parser.add_argument('--control-store', default=None,
+                        help='制御点ストアのSQLiteファイル（デフォルト: 対象ディレクトリの隣の <ディレクトリ名>.controls.sqlite3）')
+    args = parser.parse_args()
+
+    # 循環importを避けるためここでimportする（control_store は CONTROLS_SUFFIX を使う）
+    from control_store import ControlPointStore, default_control_store_path
+    control_store = ControlPointStore(args.control_store or default_control_store_path(args.target_dir))
+    catalog = ImageCatalog(args.target_dir, args.catalog or default_catalog_path(args.target_dir),
+                           recursive=args.recursive, control_store=control_store)
+    catalog.refresh(full=True)
+    print(json.dumps(catalog.stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,95 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+
 import numpy
 import cv2
 
+from line_utils import group_similar_lines
+from stage_timing import timed_stage
+
+
+class DecodedImage:
+    '''
+    一度だけデコードした画像。
+    カラー画像とグレースケール画像を共有し、同じファイルを何度もデコードしないようにする。
+    グレースケールは必要になった時点でカラーから変換する。
+    '''
+
+    def __init__(self, color=None, gray=None):
+        if color is None and gray is None:
+            raise ValueError("color と gray のどちらかは必要です。")
+        self.color = color
+        self._gray = gray
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = to_grayscale(self.color)
+        return self._gray
+
+    @property
+    def height(self):
+        return (self.color if self.color is not None else self._gray).shape[0]
+
+    @property
+    def width(self):
+        return (self.color if self.color is not None else self._gray).shape[1]
+
+
+@timed_stage('decode')
+def load_image(map_path, grayscale=False):
+    '''
+    画像ファイルを1回だけデコードして DecodedImage を返す。
+    grayscale=True の場合はカラー画像を保持せず、グレースケールで直接デコードする。
+    読み込みに失敗した場合は None を返す。
+    '''
+    if grayscale:
+        gray = cv2.imread(map_path, cv2.IMREAD_GRAYSCALE)
+        return None if gray is None else DecodedImage(gray=gray)
+    color = cv2.imread(map_path, cv2.IMREAD_COLOR)
+    return None if color is None else DecodedImage(color=color)
+
+
+@timed_stage('grayscale')
+def to_grayscale(image):
+    "デコード済みの配列をグレースケールに変換。既にグレースケールならそのまま返す。"
+    if image.ndim == 2:
+        return image
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def _grayscale_input(map_image):
+    "detect_lines の入力（パス・配列・DecodedImage）からグレースケール画像を取得。"
+    if isinstance(map_image, DecodedImage):
+        return map_image.gray
+    if isinstance(map_image, numpy.ndarray):
+        return to_grayscale(map_image)
+    if isinstance(map_image, (str, os.PathLike)):
+        with timed_stage('decode'):
+            return cv2.imread(map_image, 0)  # 第2引数を0にするとグレースケール。
+    raise TypeError(f"Unsupported image input: {type(map_image)!r}")
+
 
 def detect_lines(
-  map_path,
+  map_image,
   binary_threshold = 100,
   erode_kernel = 3,
   erode_iteration = 2,
   line_accumulation = 10000,
   rho_precision = 2,
   theta_precision = numpy.pi/90,
+  pyramid_levels = 0,
+  border_band = 0,
 ):
 
     '''
+    map_image には画像のパス、デコード済みの配列 (カラー/グレースケール)、
+    または DecodedImage を渡せる。デコード済みのものを渡すと再デコードしない。
+
     パラメーター説明。
     BINARY_THRESHOLD = 100  # 二値画像変換の閾値。
     ERODE_KERN,EL = 3  # erodeのkernelの大きさ
@@ -23,24 +97,293 @@ def detect_lines(
     LINE_ACCUMULATION = 10000  # 直線として認識されるのに必要な同一直線状のpx数。←違う？
     RHO_PRECISION = 2
     THETA_PRECISION = numpy.pi/90
+    PYRAMID_LEVELS = 0  # 0より大きい場合、1/2**PYRAMID_LEVELS に縮小した画像で直線の傾きを求め、その周辺の傾きだけを元の解像度で検出する（結果は元の解像度と同じ）。
+    BORDER_BAND = 0  # 0より大きい場合、画像の四辺から幅・高さの BORDER_BAND % の帯だけで検出する。
     '''
 
-    gray = cv2.imread(map_path, 0)  # 画像の読み込み。第2引数を0にするとグレースケール。
+    gray = _grayscale_input(map_image)  # グレースケール画像の取得。
+    if gray is None:
+        return None
+
+    thresh = binarize(gray, binary_threshold)
+    if(thresh is None):
+        return None
+    eroded = erode_binary(thresh, erode_kernel, erode_iteration)
+
+    "Hough変換は従来どおり erode 前の二値画像に対して行う。"
+    return hough_lines(thresh, rho_precision, theta_precision, line_accumulation,
+                       pyramid_levels=pyramid_levels, border_band=border_band)
 
+
+@timed_stage('threshold')
+def binarize(gray, binary_threshold):
     "二値画像へ変換。1つ目の戻り値 (retへ代入) は無視。"
     ret, thresh = cv2.threshold(gray, binary_threshold, 255,
                                 cv2.THRESH_BINARY_INV)
-    if(thresh is None):
-        return None
+    return thresh
+
+
+@timed_stage('erode')
+def erode_binary(thresh, erode_kernel, erode_iteration):
+    "境界を削り細線を除去。"
     kernel = numpy.ones((erode_kernel, erode_kernel), numpy.uint8)  # erodeのkernel。
-    eroded = cv2.erode(thresh, kernel, iterations=erode_iteration)  # 境界を削り細線を除去。
+    return cv2.erode(thresh, kernel, iterations=erode_iteration)
 
+
+@timed_stage('hough')
+def hough_lines(binary, rho_precision, theta_precision, line_accumulation, pyramid_levels=0,
+                border_band=0):
     """
     辺の候補となる直線 (極座標表示) を取得。
     引数は対象画像、ρの精度、θの精度、線分の閾値。
     この時点で直線の数は4本より多い。
+    pyramid_levels が0より大きい場合は coarse-to-fine で検出する (hough_lines_pyramid)。
+    border_band が0より大きい場合は四辺の帯だけで検出する (hough_lines_border)。
+    """
+    if border_band > 0:
+        return hough_lines_border(binary, rho_precision, theta_precision, line_accumulation,
+                                  border_band, pyramid_levels=pyramid_levels)
+    if pyramid_levels > 0:
+        return hough_lines_pyramid(binary, rho_precision, theta_precision,
+                                   line_accumulation, pyramid_levels)
+    return cv2.HoughLines(binary, rho_precision, theta_precision,
+                          line_accumulation)
+
+
+@timed_stage('hough')
+def hough_lines_with_votes(binary, rho_precision, theta_precision, min_votes):
+    """
+    投票数が min_votes より多い直線を投票数とともに取得 (cv2.HoughLinesWithAccumulator)。
+    戻り値は (N, 3) の float32 の (ρ, θ, 投票数)。cv2.HoughLines と同じ順 (投票数の多い順)。
+    閾値だけを変える場合は select_lines_by_votes で絞り込めば投票し直す必要がない。
     """
-    lines = cv2.HoughLines(thresh, rho_precision, theta_precision,
-                           line_accumulation)
+    lines = cv2.HoughLinesWithAccumulator(binary, rho_precision, theta_precision, min_votes)
+    if lines is None:
+        return numpy.empty((0, 3), numpy.float32)
+    return lines.reshape(-1, 3)
 
+
+@timed_stage('hough_select')
+def select_lines_by_votes(lines_with_votes, line_accumulation):
+    """
+    hough_lines_with_votes の結果から投票数が line_accumulation より多い直線を選ぶ。
+    line_accumulation が取得時の min_votes 以上であれば
+    cv2.HoughLines(binary, ρ, θ, line_accumulation) と同じ結果 (該当なしの場合は None) になる。
+    """
+    selected = lines_with_votes[lines_with_votes[:, 2] > line_accumulation]
+    if len(selected) == 0:
+        return None
+    return numpy.ascontiguousarray(selected[:, :2]).reshape(-1, 1, 2)
+
+
+# 縦の直線 (左右の辺) とみなす θ の範囲。それ以外 (π/4 - 3π/4) は横の直線 (上下の辺)。
+VERTICAL_THETA_RANGES = ((0.0, numpy.pi / 4), (numpy.pi * 3 / 4, numpy.pi))
+HORIZONTAL_THETA_RANGES = ((numpy.pi / 4, numpy.pi * 3 / 4),)
+
+
+def hough_lines_border(binary, rho_precision, theta_precision, line_accumulation,
+                       border_band, pyramid_levels=0):
+    """
+    図郭は画像の端の近くにあるため、四辺に沿った帯だけで直線を検出する。
+    左右の帯からは縦の直線、上下の帯からは横の直線だけを求め、元画像の (rho, theta) に戻す。
+    border_band は帯の幅 (画像の幅・高さに対する%)。投票する画素が減り、
+    地図の内容による余計な直線も検出されにくくなる。
+    戻り値は cv2.HoughLines と同じ形式 (見つからない場合は None)。
+    """
+    height, width = binary.shape[:2]
+    band_width = min(max(1, int(round(width * border_band / 100))), width)
+    band_height = min(max(1, int(round(height * border_band / 100))), height)
+    "cv2.HoughLines は rho を偶数丸めするため、帯の原点を rho の刻みの2倍の倍数にそろえる"
+    "(縦横の直線は画像全体で検出した場合と同じ rho・投票数になる)。"
+    origin_step = 2 * rho_precision
+    right = int(numpy.floor((width - band_width) / origin_step) * origin_step)
+    bottom = int(numpy.floor((height - band_height) / origin_step) * origin_step)
+    strips = (
+        ((0, 0, band_width, height), VERTICAL_THETA_RANGES),  # 左
+        ((right, 0, width, height), VERTICAL_THETA_RANGES),  # 右
+        ((0, 0, width, band_height), HORIZONTAL_THETA_RANGES),  # 上
+        ((0, bottom, width, height), HORIZONTAL_THETA_RANGES),  # 下
+    )
+
+    found = []
+    for (x0, y0, x1, y1), theta_ranges in strips:
+        strip = numpy.ascontiguousarray(binary[y0:y1, x0:x1])
+        for lines in _strip_lines(strip, rho_precision, theta_precision, line_accumulation,
+                                  theta_ranges, pyramid_levels):
+            "帯の原点 (x0, y0) を元画像の rho に戻し、元画像の rho の刻みにそろえる。"
+            rhos = lines[:, 0] + x0 * numpy.cos(lines[:, 1]) + y0 * numpy.sin(lines[:, 1])
+            lines[:, 0] = numpy.round(rhos / rho_precision) * rho_precision
+            found.append(lines)
+    if not found:
+        return None
+    lines = numpy.concatenate(found)
+    "左右・上下の帯が重なる場合に同じ直線が2回入らないようにする。"
+    lines = lines[numpy.sort(numpy.unique(lines, axis=0, return_index=True)[1])]
+    return lines.astype(numpy.float32).reshape(-1, 1, 2)
+
+
+def _strip_lines(strip, rho_precision, theta_precision, line_accumulation, theta_ranges,
+                 pyramid_levels):
+    "帯の中の直線のうち θ が theta_ranges (下限を含み上限を含まない) にあるものを、θの範囲ごとに (rho, theta) の配列で返す。"
+    if pyramid_levels > 0:
+        "帯には図郭の1辺しかないため、直線が1本も見つからない場合だけ帯全体で検出し直す。"
+        lines = hough_lines_pyramid(strip, rho_precision, theta_precision, line_accumulation,
+                                    pyramid_levels, min_groups=1)
+        if lines is None:
+            return
+        lines = lines.reshape(-1, 2).astype(numpy.float64)
+        for theta_lo, theta_hi in theta_ranges:
+            selected = lines[(lines[:, 1] >= theta_lo) & (lines[:, 1] < theta_hi)]
+            if len(selected):
+                yield selected
+        return
+
+    numangle = _hough_numangle(theta_precision)
+    for theta_lo, theta_hi in theta_ranges:
+        "θ を画像全体の場合と同じ θ の番号にそろえ、theta_hi は含めない。"
+        n_lo = int(numpy.ceil(theta_lo / theta_precision - 1e-9))
+        n_hi = min(int(numpy.ceil(theta_hi / theta_precision - 1e-9)) - 1, numangle - 1)
+        if n_lo > n_hi:
+            continue
+        lines = hough_lines_in_theta_ranges(strip, [(n_lo, n_hi)], rho_precision, theta_precision,
+                                            line_accumulation)
+        if lines is not None:
+            yield lines.reshape(-1, 2).astype(numpy.float64)
+
+
+# coarse-to-fine 検出で、縮小画像の投票数の閾値に掛ける割合 (閾値 = line_accumulation / 縮小率 * この値)。
+# 細い線や途切れた線は縮小画像での投票数が元の投票数 / 縮小率 より少なくなるため、閾値を下げて見落としを防ぐ。
+# 誤検出は元の解像度での投票で除かれる (その分だけ投票し直す θ の範囲は広がる)。
+PYRAMID_COARSE_VOTE_RATIO = 0.5
+# 元の解像度で得た直線のグループがこの数より少ない場合 (図郭の4辺が揃わない場合) は、元の解像度で検出し直す。
+PYRAMID_MIN_GROUPS = 4
+
+
+def hough_lines_pyramid(binary, rho_precision, theta_precision, line_accumulation,
+                        pyramid_levels, min_groups=PYRAMID_MIN_GROUPS):
+    """
+    縮小した二値画像で直線のおおよその傾きを求め、元の解像度ではその周辺の θ の範囲だけで
+    投票し直す。戻り値は cv2.HoughLines と同じ形式 (元画像の座標での rho, theta)。
+    探索した θ の範囲の直線は、元の解像度で cv2.HoughLines を適用した場合と同じ直線が同じ順で得られる。
+    縮小画像で見つからなかった傾きの直線は得られないため、直線のグループが min_groups より少ない場合は
+    元の解像度で検出し直す。
+    処理時間は縮小画像で見つかる直線の θ の広がりによって変わり、地図の内容が多い画像では
+    元の解像度で検出する場合より遅くなることもある (benchmark.py で比較できる)。
+    """
+    scale = 2 ** pyramid_levels
+    height, width = binary.shape[:2]
+
+    "1. 縮小画像で粗く検出。細い線が消えないよう、前景を1画素でも含むブロックは前景とする。"
+    small = cv2.resize(binary, (max(1, width // scale), max(1, height // scale)),
+                       interpolation=cv2.INTER_AREA)
+    ret, small = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY)
+    coarse_threshold = max(1, int(line_accumulation / scale * PYRAMID_COARSE_VOTE_RATIO))
+    coarse = cv2.HoughLines(small, rho_precision, theta_precision, coarse_threshold)
+
+    lines = None
+    if coarse is not None:
+        "2. 直線の θ の周囲をまとめ、まとめた範囲ごとに1回だけ元の解像度で投票し直す。"
+        "θ の探索幅は数ステップ分。ただし θ の刻みが粗い場合に隣の刻みまで広げないよう π/8 までとする。"
+        theta_margin = min(max(2 * theta_precision, numpy.pi / 180), numpy.pi / 8)
+        theta_ranges = _merge_theta_ranges(coarse.reshape(-1, 2)[:, 1], theta_margin,
+                                           theta_precision)
+        lines = hough_lines_in_theta_ranges(binary, theta_ranges, rho_precision, theta_precision,
+                                            line_accumulation)
+
+    "3. 縮小画像で辺を見落とした場合は元の解像度で検出し直す。"
+    if len(group_similar_lines(lines)) < min_groups:
+        return cv2.HoughLines(binary, rho_precision, theta_precision, line_accumulation)
     return lines
+
+
+def hough_lines_in_theta_ranges(binary, theta_ranges, rho_precision, theta_precision,
+                                line_accumulation):
+    """
+    θ の範囲を限定して cv2.HoughLines を適用する。
+    theta_ranges は (θ の番号の下限, θ の番号の上限) のリスト (θ = 番号 * theta_precision。範囲は重ならないこと)。
+    θ の表を画像全体の場合と同じ単精度の値から作るため、範囲内の直線は θ を限定せずに
+    cv2.HoughLines を適用した場合と同じ (rho, theta) になる。
+    戻り値は cv2.HoughLines と同じ形式・同じ順 (見つからない場合は None)。
+    """
+    angles = _hough_angles(theta_precision)
+    numangle = len(angles)
+    "極大値の判定に両隣の θ の投票数を使うため、前後に1つずつ広げて投票し、広げた分の直線は除く。"
+    windows = [(max(n_lo - 1, 0), min(n_hi + 1, numangle - 1)) for n_lo, n_hi in theta_ranges]
+    if sum(last - first + 1 for first, last in windows) >= numangle:
+        "すべての θ を投票することになる場合は、θ を限定せずに1回だけ投票する。"
+        return cv2.HoughLines(binary, rho_precision, theta_precision, line_accumulation)
+
+    found = []
+    for (n_lo, n_hi), (first, last) in zip(theta_ranges, windows):
+        "cv2.HoughLines は min_theta から theta_precision を単精度で足し合わせて θ の表を作る。"
+        min_theta = float(angles[first])
+        lines = cv2.HoughLinesWithAccumulator(
+            binary, rho_precision, theta_precision, line_accumulation,
+            min_theta=min_theta, max_theta=min_theta + (last - first + 0.5) * theta_precision)
+        if lines is None:
+            continue
+        lines = lines.reshape(-1, 3).astype(numpy.float64)
+        numbers = numpy.round(lines[:, 1] / theta_precision)
+        keep = (numbers >= n_lo) & (numbers <= n_hi)
+        lines = lines[keep]
+        "θ は画像全体の場合と同じ値 (cv2.HoughLines と同じく、番号と theta_precision の単精度の積) にする。"
+        lines[:, 1] = numbers[keep].astype(numpy.float32) * numpy.float32(theta_precision)
+        if len(lines):
+            found.append(lines)
+    if not found:
+        return None
+    return _sorted_unique_lines(numpy.concatenate(found))
+
+
+def _hough_numangle(theta_precision):
+    "cv2.HoughLines と同じ θ の個数。"
+    numangle = int(numpy.floor(numpy.pi / theta_precision)) + 1
+    if numangle > 1 and abs(numpy.pi - (numangle - 1) * theta_precision) < theta_precision / 2:
+        numangle -= 1
+    return numangle
+
+
+def _hough_angles(theta_precision):
+    "cv2.HoughLines が θ の表に使う角度 (0 から theta_precision を単精度で足し合わせた値)。"
+    step = numpy.float32(theta_precision)
+    angles = numpy.empty(_hough_numangle(theta_precision), dtype=numpy.float32)
+    angle = numpy.float32(0)
+    for n in range(len(angles)):
+        angles[n] = angle
+        angle = numpy.float32(angle + step)
+    return angles
+
+
+def _merge_theta_ranges(thetas, theta_margin, theta_precision):
+    """
+    各 θ ± theta_margin を θ の番号の範囲にし、重なる・隣り合う範囲をまとめて番号の順に返す。
+    0 や π をまたぐ範囲は反対側 (θ ∓ π) に折り返す (直線 (rho, θ) と (-rho, θ + π) は同じ直線)。
+    """
+    numangle = _hough_numangle(theta_precision)
+    intervals = []
+    for theta in thetas:
+        n_lo = int(numpy.ceil((theta - theta_margin) / theta_precision))
+        n_hi = int(numpy.floor((theta + theta_margin) / theta_precision))
+        if n_lo < 0:
+            intervals.append((n_lo + numangle, numangle - 1))
+        if n_hi >= numangle:
+            intervals.append((0, n_hi - numangle))
+        intervals.append((max(n_lo, 0), min(n_hi, numangle - 1)))
+    intervals.sort()
+
+    merged = []
+    for n_lo, n_hi in intervals:
+        "前後に1つずつ広げて投票する θ が重なる場合もまとめる (同じ θ を2回投票しない)。"
+        if merged and n_lo <= merged[-1][1] + 2:
+            merged[-1][1] = max(merged[-1][1], n_hi)
+        else:
+            merged.append([n_lo, n_hi])
+    return [tuple(interval) for interval in merged]
+
+
+def _sorted_unique_lines(lines):
+    "(rho, theta, 投票数) の配列から重複を除き、cv2.HoughLines と同様に投票数の多い順に並べる。"
+    lines = numpy.unique(lines, axis=0)
+    order = numpy.lexsort((lines[:, 0], lines[:, 1], -lines[:, 2]))
+    lines = lines[order]
+    return lines[:, :2].astype(numpy.float32).reshape(-1, 1, 2)
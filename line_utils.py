@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+検出した直線のグループ化・オフセット・交点計算などの補助関数群。
+app.py とバッチ処理のワーカープロセスの両方から利用する。
+"""
+
+import cv2
+import numpy as np
+
+def determine_orientation(line):
+    """
+    線の向き（縦/横）を判定する関数
+    """
+    rho, theta = line[0]
+    # theta が π/4 より小さいか、3π/4 より大きい場合は縦向き
+    # それ以外は横向き
+    return 'vertical' if (theta < np.pi/4 or theta > 3*np.pi/4) else 'horizontal'
+
+def offset_line(line, offset_percentage, image_width, image_height, orientation):
+    """
+    線をオフセットさせる関数
+    """
+    rho, theta = line[0]
+    # 画像サイズに基づいてオフセット量を計算
+    max_offset = min(image_width, image_height) * 0.3  # 最大30%までオフセット可能
+    offset_amount = max_offset * (offset_percentage / 100.0)
+
+    # 向きに応じてオフセット方向を決定
+    if orientation == 'vertical':
+        # 縦線の場合、内側に向かってオフセット
+        # 画像の中心からの距離に基づいて方向を決定
+        center_x = image_width / 2
+        line_x = rho * np.cos(theta)
+        if line_x > center_x:
+            # 右側の線は左に（内側に）オフセット
+            new_rho = rho - offset_amount
+        else:
+            # 左側の線は右に（内側に）オフセット
+            new_rho = rho + offset_amount
+    else:
+        # 横線の場合、内側に向かってオフセット
+        # 画像の中心からの距離に基づいて方向を決定
+        center_y = image_height / 2
+        line_y = rho * np.sin(theta)
+        if line_y > center_y:
+            # 下側の線は上に（内側に）オフセット
+            new_rho = rho - offset_amount
+        else:
+            # 上側の線は下に（内側に）オフセット
+            new_rho = rho + offset_amount
+
+    return np.array([[new_rho, theta]])
+
+def draw_line_full_extent(image, line, color, thickness=3):
+    """
+    線を画像の端から端まで描画する関数
+    元の描画方法を使用して、十分に長い線を描画
+    """
+    rho, theta = line[0]
+    a = np.cos(theta)
+    b = np.sin(theta)
+    x0 = a * rho
+    y0 = b * rho
+
+    # 元の方法を使用：十分に長い線を描画
+    # 画像サイズに関係なく、十分に長い線を描画することで
+    # 画像の境界で自然に切り取られる
+    extension = 20000  # 十分に大きな値
+    x1 = int(x0 + extension * (-b))
+    y1 = int(y0 + extension * (a))
+    x2 = int(x0 - extension * (-b))
+    y2 = int(y0 - extension * (a))
+
+    cv2.line(image, (x1, y1), (x2, y2), color, thickness)
+
+def representative_line(group_lines):
+    """
+    グループ内の直線のrhoとthetaの平均を代表線として返す関数
+    θ=0 付近と θ=π 付近の直線が混在する場合は、先頭の直線に近い側の表現
+    （(rho, θ) と同じ直線を表す (-rho, θ±π)）にそろえてから平均する
+    """
+    rhos = []
+    thetas = []
+    reference_theta = None
+    for line in group_lines:
+        rho, theta = line[0]
+        if reference_theta is None:
+            reference_theta = theta
+        elif theta - reference_theta > np.pi/2:
+            rho, theta = -rho, theta - np.pi
+        elif reference_theta - theta > np.pi/2:
+            rho, theta = -rho, theta + np.pi
+        rhos.append(rho)
+        thetas.append(theta)
+
+    # 平均を計算
+    avg_rho = sum(rhos) / len(rhos)
+    avg_theta = sum(thetas) / len(thetas)
+
+    # thetaを0以上π未満に戻す
+    if avg_theta < 0:
+        avg_rho, avg_theta = -avg_rho, avg_theta + np.pi
+    elif avg_theta >= np.pi:
+        avg_rho, avg_theta = -avg_rho, avg_theta - np.pi
+
+    return np.array([[avg_rho, avg_theta]])
+
+def calculate_representative_lines(line_groups, lines):
+    """
+    各グループの代表線を計算する関数
+    グループ内の全ての線のrhoとthetaの平均を取る
+    """
+    representative_lines = []
+
+    for group in line_groups:
+        if not group:  # 空のグループをスキップ
+            continue
+        representative_lines.append(representative_line([lines[line_idx] for line_idx in group]))
+
+    return representative_lines
+
+def lines_to_array(lines):
+    """
+    [[rho, theta]] 形式の線のリスト（またはHough変換の結果）を (N, 2) の配列にする関数
+    すべて単精度の場合は単精度のまま計算する（1組ずつ計算していた場合と結果をそろえるため）
+    """
+    if lines is None or len(lines) == 0:
+        return np.empty((0, 2))
+    if isinstance(lines, np.ndarray):
+        return lines.reshape(-1, 2)
+    arrays = [np.asarray(line).reshape(2) for line in lines]
+    return np.stack(arrays).astype(np.result_type(*arrays), copy=False)
+
+def intersect_lines(lines, image_size=None):
+    """
+    全ての線の組み合わせ (i < j) の交点をまとめて計算する関数
+    lines: (N, 2) の (rho, theta) の配列、または [[rho, theta]] 形式の線のリスト
+    image_size: (幅, 高さ) を指定すると画像の範囲内の交点だけを返す
+    戻り値は (M, 2) の整数配列で、i, j の順（compute_intersection を二重ループで呼んだ場合と同じ順）
+    平行な組み合わせ（thetaの差が0またはπ、行列式がほぼ0）は除く
+    """
+    rho_theta = lines_to_array(lines)
+    first, second = np.triu_indices(len(rho_theta), 1)
+    rho1, theta1 = rho_theta[first, 0], rho_theta[first, 1]
+    rho2, theta2 = rho_theta[second, 0], rho_theta[second, 1]
+
+    # 線の方程式の係数を計算
+    a1 = np.cos(theta1)
+    b1 = np.sin(theta1)
+    a2 = np.cos(theta2)
+    b2 = np.sin(theta2)
+    det = a1 * b2 - a2 * b1
+
+    # 平行線の場合は交点なし
+    theta_diff = np.abs(theta1 - theta2)
+    valid = (theta_diff >= 1e-10) & (np.abs(theta_diff - np.pi) >= 1e-10) & (np.abs(det) >= 1e-10)
+
+    # 連立方程式を解いて交点を計算
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (b2 * rho1 - b1 * rho2) / det
+        y = (-a2 * rho1 + a1 * rho2) / det
+    points = np.stack((np.trunc(x[valid]), np.trunc(y[valid])), axis=1).astype(np.int64)
+
+    if image_size is not None:
+        image_width, image_height = image_size
+        inside = ((points[:, 0] >= 0) & (points[:, 0] < image_width) &
+                  (points[:, 1] >= 0) & (points[:, 1] < image_height))
+        points = points[inside]
+    return points
+
+def compute_intersection(line1, line2):
+    """
+    2つの線の交点を計算する関数
+    line1, line2: [rho, theta] 形式の線のパラメータ
+    """
+    points = intersect_lines([np.asarray(line1), np.asarray(line2)])
+    if len(points) == 0:
+        return None
+    return tuple(points[0].tolist())
+
+def calculate_intersections(line_groups, lines):
+    """
+    グループ化された線同士の交点を計算する関数
+    """
+    # 各グループの代表線を計算
+    representative_lines = calculate_representative_lines(line_groups, lines)
+    # 全ての代表線の組み合わせについて交点を計算
+    return [tuple(point) for point in intersect_lines(representative_lines).tolist()]
+
+# 近接していると判定する rho の差と theta の差
+GROUP_RHO_TOLERANCE = 500
+GROUP_THETA_TOLERANCE = np.pi/18
+
+# 近接判定で一度に比較する直線の数（比較行列のメモリ使用量を抑える）
+GROUP_CHUNK_SIZE = 1024
+
+def line_proximity(rho_theta, others):
+    """
+    rho_theta (N, 2) と others (M, 2) の各組み合わせが近接しているかを表す (N, M) の真偽値配列
+    rhoの差が500以内かつthetaの差がπ/18以内の時に近接していると定義する
+    θ=0 付近と θ=π 付近の直線は (rho, θ) と (-rho, θ-π) が同じ直線を表すため、
+    符号を反転したrhoで比較する
+    """
+    rho1 = rho_theta[:, 0:1]
+    theta1 = rho_theta[:, 1:2]
+    rho2 = others[:, 0]
+    theta2 = others[:, 1]
+    theta_diff = np.abs(theta1 - theta2)
+    near = (np.abs(rho1 - rho2) < GROUP_RHO_TOLERANCE) & (theta_diff < GROUP_THETA_TOLERANCE)
+    wrapped = (np.abs(rho1 + rho2) < GROUP_RHO_TOLERANCE) & (np.pi - theta_diff < GROUP_THETA_TOLERANCE)
+    return near | wrapped
+
+def _union_edges(parent, first, second):
+    """
+    union-find の親配列 parent に辺 (first[k], second[k]) をまとめて追加する
+    根は常に連結成分の最小のインデックスとし、parent は毎回根まで圧縮しておく
+    """
+    while len(first):
+        root1 = parent[first]
+        root2 = parent[second]
+        unmerged = root1 != root2
+        if not unmerged.any():
+            return
+        root1 = root1[unmerged]
+        root2 = root2[unmerged]
+        first = first[unmerged]
+        second = second[unmerged]
+        # 大きい方の根を小さい方の根につなぐ
+        np.minimum.at(parent, np.maximum(root1, root2), np.minimum(root1, root2))
+        # 経路を圧縮（各要素の親を根にする）
+        while True:
+            compressed = parent[parent]
+            if np.array_equal(compressed, parent):
+                break
+            parent[:] = compressed
+
+def group_similar_lines(lines):
+    """
+    類似した直線をグループ化する関数
+    近接する直線同士を連結成分としてまとめる（近接の連鎖も同じグループになる）
+    グループは最小のインデックスの順、グループ内はインデックスの昇順で、
+    どの直線とも近接しない直線は1本だけのグループとして最後にインデックス順で追加する
+    """
+    if lines is None or len(lines) == 0:
+        return []
+
+    rho_theta = np.asarray(lines, dtype=np.float64).reshape(-1, 2)
+    count = len(rho_theta)
+
+    # 近接行列を一定の行数ずつ作り、近接する組み合わせ (i < j) を union-find でまとめる
+    parent = np.arange(count)
+    has_neighbor = np.zeros(count, dtype=bool)
+    for start in range(0, count, GROUP_CHUNK_SIZE):
+        stop = min(start + GROUP_CHUNK_SIZE, count)
+        near = line_proximity(rho_theta[start:stop], rho_theta)
+        near[np.arange(stop - start), np.arange(start, stop)] = False  # 自分自身は除く
+        has_neighbor[start:stop] = near.any(axis=1)
+        first, second = np.nonzero(near)
+        first += start
+        upper = first < second
+        _union_edges(parent, first[upper], second[upper])
+
+    # 根（＝連結成分の最小のインデックス）ごとにまとめる
+    order = np.argsort(parent, kind='stable')
+    roots, starts = np.unique(parent[order], return_index=True)
+    members = np.split(order, starts[1:])
+
+    grouped = [group.tolist() for root, group in zip(roots, members) if has_neighbor[root]]
+    independent = [[i] for i in np.nonzero(~has_neighbor)[0].tolist()]
+    return grouped + independent
+
+def sort_intersections(intersections):
+    """
+    4つの交点を左上、右上、左下、右下の順に並べ替える関数
+    並べ替えに失敗した場合はNoneを返す
+    """
+    points = np.asarray(intersections).reshape(-1, 2)
+    x = points[:, 0]
+    y = points[:, 1]
+    x_avg = x.sum() / len(points)
+    y_avg = y.sum() / len(points)
+
+    # 各交点の位置（0: 左上、1: 右上、2: 左下、3: 右下）
+    quadrants = np.select(
+        [(x < x_avg) & (y < y_avg), (x > x_avg) & (y < y_avg), (x < x_avg) & (y > y_avg)],
+        [0, 1, 2], default=3)
+
+    # 同じ位置に複数の交点がある場合は後の交点を使う
+    sorted_intersections = [None] * 4
+    for quadrant, point in zip(quadrants.tolist(), intersections):
+        sorted_intersections[quadrant] = point
+
+    # Noneがある場合（並べ替えに失敗した場合）
+    if None in sorted_intersections:
+        return None
+    return sorted_intersections
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+This script imports many maps to Map Warper in one run.
+
+Unlike main.py, which uploads one map per invocation, it signs in once and shares the
+authenticated, connection-pooled session across a bounded number of upload threads.
+Requests are retried with exponential backoff, and every result is recorded in a SQLite
+ledger so that an interrupted import can be resumed without uploading the maps that were
+already imported.
+
+Creating a map is not idempotent, so an upload is sent again only when the server provably
+did not process it (the connection could not be made, or HTTP 408/429 or 503 with Retry-After).
+When the map may have been created but the response was lost (a timeout, a dropped
+connection, another 5xx, or an upload in flight when an import was interrupted), the map is
+recorded as 'unknown' and reported instead of being uploaded again; check it in Map Warper,
+then resume with --retry-unknown to upload it again.
+
+    python -m mapwarper_interface.bulk_import ./targets https://mapwarper.example.org \\
+        -u user@example.org -p password -c attributes.csv --workers 4
+
+The source is either a directory of maps (attributes are looked up in the CSV given with -c,
+matched by file name as in generate_json) or a CSV whose rows name the map files
+(looked up in --image-dir, by default the CSV's directory).
+"""
+
+import argparse
+import base64
+import csv
+import json
+import mimetypes
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+
+# file extensions treated as maps
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+
+# responses worth retrying (the request may succeed later)
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+# responses to a request that was not processed, so that a non-idempotent request can be retried
+# (503 only with Retry-After, see _not_processed)
+NOT_PROCESSED_STATUSES = frozenset({408, 429, 503})
+
+# upper bound of a single backoff delay (seconds)
+MAX_BACKOFF = 60.0
+
+IMPORT_HEADERS = {"Content-Type": "application/json", "Accept": "application/json"}
+
+
+class MapWarperError(Exception):
+    """Raised when Map Warper rejects a request or cannot be reached after all retries."""
+
+    def __init__(self, message, attempts=None):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+class UploadOutcomeUnknown(MapWarperError):
+    """Raised when an upload may or may not have created the map (the response was lost or is a 5xx)."""
+
+
+def _not_processed(response):
+    """Whether the response shows that the server did not process the request."""
+    if response.status_code == 503:
+        return 'Retry-After' in response.headers
+    return response.status_code in NOT_PROCESSED_STATUSES
+
+
+def _never_sent(error):
+    """Whether a connection error or a timeout happened before the request reached the server."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    # NewConnectionError (refused, name resolution) is a subclass of ConnectTimeoutError
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def default_ledger_path(source):
+    """The ledger next to the source (./targets -> ./targets.mapwarper.sqlite3, maps.csv -> maps.mapwarper.sqlite3)."""
+    source = os.path.abspath(source)
+    if os.path.isdir(source):
+        return source + '.mapwarper.sqlite3'
+    return os.path.splitext(source)[0] + '.mapwarper.sqlite3'
+
+
+class ImportLedger:
+    """
+    Records which maps were imported to which Map Warper instance.
+    Maps are identified by their path relative to the source directory (or to the image
+    directory of a source CSV), with '/' separators, so that maps with the same file name in
+    different subdirectories are recorded separately, and a ledger can be shared by imports of
+    the same directory and of a CSV naming its maps. The SQLite file is opened in WAL mode with
+    one connection per thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        connection = self._connection()
+        with connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS imports (
+                    url TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    map_id TEXT,
+                    attempts INTEGER NOT NULL,
+                    error TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (url, name)
+                )
+            ''')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def statuses(self, url):
+        """{map name: status} of the maps recorded for url."""
+        return dict(self._connection().execute(
+            'SELECT name, status FROM imports WHERE url = ?', (url,)))
+
+    def record(self, url, name, status, map_id=None, attempts=0, error=None):
+        """
+        Record the status of an upload: 'uploading' before it is sent, then 'imported', 'failed'
+        or 'unknown' (the map may have been created).
+        """
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (url, name, status, map_id, attempts, error, time.time()))
+
+    def stats(self, url):
+        counts = dict(self._connection().execute(
+            'SELECT status, COUNT(*) FROM imports WHERE url = ? GROUP BY status', (url,)))
+        return {'path': self.path, 'imported': counts.get('imported', 0),
+                'failed': counts.get('failed', 0),
+                'unknown': counts.get('unknown', 0) + counts.get('uploading', 0)}
+
+
+def load_attributes(csv_path):
+    """
+    Read a CSV of Map Warper attributes once and index its rows by every cell value,
+    so that a map matches the same row as in generate_json (the last row containing its file name).
+    """
+    index = {}
+    with open(csv_path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        for row in reader:
+            attributes = dict(zip(header, row))
+            for value in row:
+                index[value] = attributes
+    return index
+
+
+def find_maps(source, csv_path=None, image_dir=None):
+    """
+    Return ([(name, map path, attributes)], [CSV rows whose map file was not found]) sorted by name.
+    source is a directory of maps, or a CSV whose rows contain the paths of maps relative to
+    image_dir. The name identifies a map in the ledger: its path relative to the directory,
+    with '/' separators.
+    """
+    if os.path.isdir(source):
+        attributes = load_attributes(csv_path) if csv_path else {}
+        names = sorted(name for name in os.listdir(source)
+                       if name.lower().endswith(IMAGE_EXTENSIONS))
+        return [(name, os.path.join(source, name), attributes.get(name, {})) for name in names], []
+
+    image_dir = image_dir or os.path.dirname(os.path.abspath(source))
+    maps = {}
+    missing = []
+    with open(source, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        for row in reader:
+            for value in row:
+                path = os.path.join(image_dir, value)
+                if value.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path):
+                    name = os.path.relpath(path, image_dir).replace(os.sep, '/')
+                    maps[name] = (name, path, dict(zip(header, row)))
+                    break
+            else:
+                missing.append(row)
+    return [maps[name] for name in sorted(maps)], missing
+
+
+def import_body(map_path, attributes):
+    """
+    The JSON body that imports a map (the same attributes as generate_json).
+    The image is appended to the serialized attributes as a data URI instead of being passed
+    through json.dumps, so the base64 text is not copied again while building the body.
+    """
+    map_name = os.path.basename(map_path)
+    attributes = {key: value for key, value in attributes.items() if value}
+    attributes["upload_file_name"] = map_name
+    mimetype = mimetypes.guess_type(map_name)[0] or "image/jpeg"
+
+    with open(map_path, 'rb') as map_file:
+        encoded_file = base64.b64encode(map_file.read())
+
+    head = json.dumps({"data": {"type": "maps", "attributes": attributes}})
+    # head ends with the closing braces of attributes, data and the body: '}}}'
+    return b''.join([head[:-3].encode('utf-8'), f', "upload": "data:{mimetype};base64,'.encode('ascii'),
+                     encoded_file, b'"}}}'])
+
+
+class MapWarperClient:
+    """
+    A Map Warper API client whose signed-in session is shared by the upload threads.
+    The connection pool holds up to `workers` connections, so concurrent uploads reuse them.
+    """
+
+    def __init__(self, url, user, password, workers=4, timeout=300.0, retries=3, backoff=1.0,
+                 sleep=time.sleep):
+        self.url = url.rstrip('/')
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep  # replaced in tests to skip the backoff delays
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, workers))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._sign_in_lock = threading.Lock()
+        self._sign_ins = 0  # incremented on every sign-in, so that an expired session is renewed only once
+
+    def _delay(self, attempt, response):
+        """Seconds to wait before the next attempt (Retry-After if given, otherwise exponential with jitter)."""
+        if response is not None:
+            try:
+                return min(float(response.headers['Retry-After']), MAX_BACKOFF)
+            except (KeyError, ValueError):
+                pass
+        return min(self.backoff * 2 ** attempt, MAX_BACKOFF) * random.uniform(0.5, 1.0)
+
+    def _request(self, method, path, idempotent=True, **kwargs):
+        """
+        Send a request and return (response, attempts), retrying connection errors, timeouts and
+        RETRY_STATUSES. After the last retry the retryable response is returned as is;
+        a connection error or a timeout raises MapWarperError.
+        A non-idempotent request is retried only when it was not processed (_not_processed,
+        _never_sent); any other response is returned as is, and a timeout or a connection error
+        after the request was sent raises UploadOutcomeUnknown.
+        """
+        for attempt in range(self.retries + 1):
+            response = None
+            try:
+                response = self.session.request(method, self.url + path, timeout=self.timeout, **kwargs)
+                if idempotent and response.status_code not in RETRY_STATUSES:
+                    return response, attempt + 1
+                if not idempotent and not _not_processed(response):
+                    return response, attempt + 1
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not idempotent and not _never_sent(e):
+                    raise UploadOutcomeUnknown(f'{type(e).__name__}: {e}', attempt + 1)
+                error = e
+            if attempt == self.retries:
+                break
+            self.sleep(self._delay(attempt, response))
+        if response is not None:
+            return response, self.retries + 1
+        raise MapWarperError(f'{type(error).__name__}: {error}', self.retries + 1)
+
+    def sign_in(self):
+        """Sign in and keep the session cookie for the following requests."""
+        with self._sign_in_lock:
+            self._sign_in()
+
+    def _sign_in(self):
+        authentication_data = {"user": {"email": self.user, "password": self.password}}
+        response, attempts = self._request('POST', '/u/sign_in.json', json=authentication_data)
+        if not response.ok:
+            raise MapWarperError(f'sign in failed: HTTP {response.status_code}', attempts)
+        self._sign_ins += 1
+
+    def _renew_sign_in(self, sign_ins):
+        """Sign in again unless another thread already did after `sign_ins`."""
+        with self._sign_in_lock:
+            if self._sign_ins == sign_ins:
+                self._sign_in()
+
+    def upload(self, map_path, attributes):
+        """
+        Import a map and return (map id or None, attempts).
+        Raises UploadOutcomeUnknown if the map may have been created, and MapWarperError if it was not.
+        """
+        body = import_body(map_path, attributes)
+        sign_ins = self._sign_ins
+        response, attempts = self._request('POST', '/api/v1/maps', idempotent=False, data=body,
+                                           headers=IMPORT_HEADERS)
+        if response.status_code == 401:
+            # the session has expired (the map was not created): sign in again and retry once
+            self._renew_sign_in(sign_ins)
+            response, more = self._request('POST', '/api/v1/maps', idempotent=False, data=body,
+                                           headers=IMPORT_HEADERS)
+            attempts += more
+        if response.status_code >= 500 and not _not_processed(response):
+            raise UploadOutcomeUnknown(f'HTTP {response.status_code}: {response.text[:200]}', attempts)
+        if not response.ok:
+            raise MapWarperError(f'HTTP {response.status_code}: {response.text[:200]}', attempts)
+        try:
+            map_id = response.json()['data']['id']
+        except (ValueError, KeyError, TypeError):
+            map_id = None
+        return (str(map_id) if map_id is not None else None), attempts
+
+
+def bulk_import(client, maps, ledger, workers=4, log=print, retry_unknown=False):
+    """
+    Upload the maps that are not recorded as imported in the ledger, with at most `workers`
+    uploads in flight, and record each result as soon as it completes.
+    Returns {'imported', 'failed', 'unknown', 'skipped'}.
+    A map is recorded as 'uploading' before it is sent, so a map whose upload was in flight when
+    the import was interrupted is treated as 'unknown' on resume. Maps recorded as 'unknown' may
+    exist in Map Warper and are reported and counted as unknown instead of being uploaded again,
+    unless retry_unknown is set.
+    """
+    statuses = ledger.statuses(client.url)
+    unresolved = set() if retry_unknown else {
+        name for name, status in statuses.items() if status in ('unknown', 'uploading')}
+    pending = []
+    counts = {'imported': 0, 'failed': 0, 'unknown': 0, 'skipped': 0}
+    for name, path, attributes in maps:
+        if statuses.get(name) == 'imported':
+            counts['skipped'] += 1
+        elif name in unresolved:
+            counts['unknown'] += 1
+            log(f"{name} -> unknown (an earlier upload may have created it; "
+                f"check Map Warper, then resume with --retry-unknown)")
+        else:
+            pending.append((name, path, attributes))
+    total = len(pending)
+
+    def upload(name, path, attributes):
+        ledger.record(client.url, name, 'uploading')
+        return client.upload(path, attributes)
+
+    def collect(futures):
+        finished, futures = wait(futures, return_when=FIRST_COMPLETED)
+        for future in finished:
+            name = futures_names.pop(future)
+            try:
+                map_id, attempts = future.result()
+            except UploadOutcomeUnknown as e:
+                ledger.record(client.url, name, 'unknown', attempts=e.attempts or 0, error=str(e))
+                counts['unknown'] += 1
+                log(f"{counts['imported'] + counts['failed'] + counts['unknown']}/{total}: "
+                    f"{name} -> unknown ({e}; the map may have been created, it is not uploaded again)")
+            except Exception as e:
+                ledger.record(client.url, name, 'failed', attempts=getattr(e, 'attempts', None) or 0,
+                              error=str(e) or type(e).__name__)
+                counts['failed'] += 1
+                log(f"{counts['imported'] + counts['failed'] + counts['unknown']}/{total}: "
+                    f"{name} -> failed ({e})")
+            else:
+                ledger.record(client.url, name, 'imported', map_id=map_id, attempts=attempts)
+                counts['imported'] += 1
+                log(f"{counts['imported'] + counts['failed'] + counts['unknown']}/{total}: "
+                    f"{name} -> imported (id {map_id})")
+        return futures
+
+    # only `workers` bodies (base64 images) are held in memory at a time
+    futures_names = {}
+    futures = set()
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        for name, path, attributes in pending:
+            while len(futures) >= max(1, workers):
+                futures = collect(futures)
+            future = executor.submit(upload, name, path, attributes)
+            futures_names[future] = name
+            futures.add(future)
+        while futures:
+            futures = collect(futures)
+    finally:
+        # on interruption, drop the uploads not yet started (finished ones are already in the ledger,
+        # and the ones in flight stay recorded as 'uploading')
+        executor.shutdown(wait=True, cancel_futures=True)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='import many maps to Map Warper with one signed-in session.')
+    parser.add_argument('source', type=str, help='a directory of maps, or a CSV whose rows name the map files')
+    parser.add_argument('url', type=str, help='Map Warper URL')
+    parser.add_argument('-u', '--user', action='store', type=str, required=True, help='a username')
+    parser.add_argument('-p', '--password', action='store', type=str, required=True, help='the password for the username')
+    parser.add_argument('-c', '--csv', action='store', type=str, default=None,
+                        help='a CSV of map attributes (when the source is a directory)')
+    parser.add_argument('--image-dir', type=str, default=None,
+                        help='the directory of the maps named in a source CSV (default: the directory of the CSV)')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='concurrent uploads (default: 4)')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='retries of a failed request (default: 3)')
+    parser.add_argument('--backoff', type=float, default=1.0,
+                        help='the first retry delay in seconds, doubled on every retry (default: 1.0)')
+    parser.add_argument('--timeout', type=float, default=300.0,
+                        help='timeout of a request in seconds (default: 300)')
+    parser.add_argument('--retry-unknown', action='store_true',
+                        help='upload again the maps whose earlier upload may have created them '
+                             '(check Map Warper for duplicates first)')
+    parser.add_argument('--ledger', type=str, default=None,
+                        help='the SQLite ledger of imported maps (default: <source>.mapwarper.sqlite3 next to the source)')
+    args = parser.parse_args()
+
+    maps, missing = find_maps(args.source, args.csv, args.image_dir)
+    for row in missing:
+        print(f"No map file found for the CSV row: {row}", file=sys.stderr)
+
+    ledger = ImportLedger(args.ledger or default_ledger_path(args.source))
+    client = MapWarperClient(args.url, args.user, args.password, workers=args.workers,
+                             timeout=args.timeout, retries=args.retries, backoff=args.backoff)
+    client.sign_in()
+
+    counts = bulk_import(client, maps, ledger, workers=args.workers, retry_unknown=args.retry_unknown)
+    print(f"imported {counts['imported']}, failed {counts['failed']}, "
+          f"unknown {counts['unknown']} (may have been created; check Map Warper), "
+          f"skipped {counts['skipped']} (already imported)")
+    return 1 if counts['failed'] or counts['unknown'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
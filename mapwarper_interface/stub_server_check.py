@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+This script checks bulk_import against a local stub of the Map Warper API, without a Map Warper instance.
+
+    python -m mapwarper_interface.stub_server_check
+
+The stub server answers the sign-in and the import requests the way Map Warper does, and on
+purpose answers some imports with 503 (with Retry-After), one with 401 (an expired session),
+one with 422 (a rejected map) and one with 500 after creating the map (a lost response).
+The script checks that:
+- 503 responses with Retry-After are retried and the map is imported
+- a 401 response renews the sign-in once and the map is imported
+- no more than `workers` uploads are in flight at a time
+- a second run skips the maps recorded as imported in the ledger and retries the failed one
+- maps with the same file name in different subdirectories of a CSV source are imported separately
+- a map answered with 500 after it was created is recorded as unknown and not posted again,
+  neither in the same run nor on resume (unless retry_unknown is set)
+- an upload in flight when an import was interrupted is not posted again on resume
+- an upload that cannot connect is retried, without being recorded as unknown
+It exits with status 1 if a check fails.
+"""
+
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mapwarper_interface.bulk_import import (ImportLedger, MapWarperClient, MapWarperError,
+                                             UploadOutcomeUnknown, bulk_import, find_maps)
+
+PASSWORD = 'password'
+
+# the stub only checks that the upload is base64, so the maps need not be valid images
+MAP_BYTES = b'\xff\xd8\xff\xd9'
+
+
+class StubState:
+    """What the stub server received, and the failures it still has to answer."""
+
+    def __init__(self, unavailable=None, expire=None, reject=(), lose=()):
+        self.lock = threading.Lock()
+        self.sign_ins = 0
+        self.uploads = []  # (upload_file_name, attributes without the image)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.unavailable = dict(unavailable or {})  # upload_file_name -> remaining 503 responses
+        self.expire = expire  # upload_file_name answered once with 401
+        self.reject = set(reject)  # upload_file_names answered with 422
+        self.lose = set(lose)  # upload_file_names created, then answered with 500
+        self.posts = []  # upload_file_name of every import request
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, headers=()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        state = self.server.state
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path == '/u/sign_in.json':
+            if body['user']['password'] != PASSWORD:
+                return self.reply(401, {'error': 'Invalid email or password.'})
+            with state.lock:
+                state.sign_ins += 1
+                token = f'session{state.sign_ins}'
+            return self.reply(200, {'email': body['user']['email']},
+                              [('Set-Cookie', f'_mapwarper_session={token}; Path=/')])
+        if self.path != '/api/v1/maps':
+            return self.reply(404, {'error': 'not found'})
+
+        attributes = body['data']['attributes']
+        name = attributes['upload_file_name']
+        with state.lock:
+            state.posts.append(name)
+            if '_mapwarper_session=' not in self.headers.get('Cookie', ''):
+                return self.reply(401, {'error': 'You need to sign in.'})
+            if state.expire == name:
+                state.expire = None
+                return self.reply(401, {'error': 'Your session expired.'})
+            if state.unavailable.get(name):
+                state.unavailable[name] -= 1
+                return self.reply(503, {'error': 'unavailable'}, [('Retry-After', '0')])
+            state.in_flight += 1
+            state.max_in_flight = max(state.max_in_flight, state.in_flight)
+        time.sleep(0.05)  # keep the upload in flight so that concurrent uploads overlap
+        with state.lock:
+            state.in_flight -= 1
+            if name in state.reject:
+                return self.reply(422, {'errors': [{'title': 'invalid map'}]})
+            base64.b64decode(attributes['upload'].split(',', 1)[1], validate=True)
+            state.uploads.append((name, {key: value for key, value in attributes.items()
+                                         if key != 'upload'}))
+            map_id = len(state.uploads)
+            if name in state.lose:
+                return self.reply(500, {'error': 'Internal Server Error'})
+        self.reply(200, {'data': {'id': str(map_id), 'type': 'maps'}})
+
+
+class StubServer:
+    """A stub Map Warper API on a free local port, served in a background thread."""
+
+    def __init__(self, state):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.state = state
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def write_maps(directory, names):
+    for name in names:
+        path = os.path.join(directory, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(MAP_BYTES)
+
+
+def check(condition, message, failures):
+    print(('ok      ' if condition else 'FAILED  ') + message)
+    if not condition:
+        failures.append(message)
+
+
+def client_for(server, workers=3):
+    return MapWarperClient(server.url, 'user@example.org', PASSWORD, workers=workers,
+                           retries=3, backoff=0.01, sleep=lambda seconds: None)
+
+
+def check_directory(work_dir, failures):
+    """503 retries, the sign-in renewal, bounded concurrency and resuming from the ledger."""
+    map_dir = os.path.join(work_dir, 'maps')
+    names = [f'm{i}.jpg' for i in range(8)]
+    write_maps(map_dir, names)
+    with open(os.path.join(work_dir, 'attributes.csv'), 'w', newline='') as f:
+        f.write('upload_file_name,title\nm1.jpg,Sheet 1\n')
+
+    state = StubState(unavailable={'m3.jpg': 2}, expire='m5.jpg', reject={'m7.jpg'})
+    ledger = ImportLedger(os.path.join(work_dir, 'maps.mapwarper.sqlite3'))
+    with StubServer(state) as server:
+        maps, missing = find_maps(map_dir, os.path.join(work_dir, 'attributes.csv'))
+        client = client_for(server)
+        client.sign_in()
+        counts = bulk_import(client, maps, ledger, workers=3, log=lambda message: None)
+        check(counts == {'imported': 7, 'failed': 1, 'unknown': 0, 'skipped': 0},
+              f'first run imports 7 maps and fails the rejected one: {counts}', failures)
+        uploaded = [name for name, _ in state.uploads]
+        check('m3.jpg' in uploaded and not state.unavailable['m3.jpg'],
+              'a map answered with 503 twice is retried and imported', failures)
+        check('m5.jpg' in uploaded and state.sign_ins == 2,
+              f'an expired session is renewed once (sign-ins: {state.sign_ins})', failures)
+        check(0 < state.max_in_flight <= 3,
+              f'at most 3 uploads are in flight (max: {state.max_in_flight})', failures)
+        check(dict(state.uploads)['m1.jpg'].get('title') == 'Sheet 1',
+              'attributes from the CSV are sent with the map', failures)
+
+        state.reject.clear()
+        counts = bulk_import(client, maps, ledger, workers=3, log=lambda message: None)
+        check(counts == {'imported': 1, 'failed': 0, 'unknown': 0, 'skipped': 7},
+              f'second run skips the imported maps and retries the failed one: {counts}', failures)
+        check(len(state.uploads) == 8, 'no map is uploaded twice', failures)
+        check(ledger.stats(client.url)['imported'] == 8, 'the ledger records all 8 maps', failures)
+
+        try:
+            MapWarperClient(server.url, 'user@example.org', 'wrong',
+                            sleep=lambda seconds: None).sign_in()
+            check(False, 'a wrong password raises MapWarperError', failures)
+        except MapWarperError:
+            check(True, 'a wrong password raises MapWarperError', failures)
+
+
+def check_subdirectories(work_dir, failures):
+    """Maps with the same file name in different subdirectories of a CSV source."""
+    image_dir = os.path.join(work_dir, 'sheets')
+    write_maps(image_dir, ['sheetA/001.jpg', 'sheetB/001.jpg'])
+    csv_path = os.path.join(work_dir, 'sheets.csv')
+    with open(csv_path, 'w', newline='') as f:
+        f.write('file,title\nsheetA/001.jpg,A\nsheetB/001.jpg,B\nsheetC/001.jpg,C\n')
+
+    state = StubState()
+    ledger = ImportLedger(os.path.join(work_dir, 'sheets.mapwarper.sqlite3'))
+    with StubServer(state) as server:
+        maps, missing = find_maps(csv_path, image_dir=image_dir)
+        check([name for name, _, _ in maps] == ['sheetA/001.jpg', 'sheetB/001.jpg'] and len(missing) == 1,
+              'maps in a CSV are named by their path relative to the image directory', failures)
+        client = client_for(server)
+        client.sign_in()
+        counts = bulk_import(client, maps, ledger, workers=2, log=lambda message: None)
+        check(counts == {'imported': 2, 'failed': 0, 'unknown': 0, 'skipped': 0},
+              f'maps with the same file name in different subdirectories are both imported: {counts}',
+              failures)
+        counts = bulk_import(client, maps, ledger, workers=2, log=lambda message: None)
+        check(counts == {'imported': 0, 'failed': 0, 'unknown': 0, 'skipped': 2},
+              f'both are skipped on the second run: {counts}', failures)
+
+
+def check_lost_responses(work_dir, failures):
+    """Uploads that may have created the map are not posted again."""
+    map_dir = os.path.join(work_dir, 'lost')
+    write_maps(map_dir, ['a.jpg', 'b.jpg', 'c.jpg'])
+    state = StubState(lose={'a.jpg'})
+    ledger = ImportLedger(os.path.join(work_dir, 'lost.mapwarper.sqlite3'))
+    with StubServer(state) as server:
+        maps, missing = find_maps(map_dir)
+        client = client_for(server)
+        client.sign_in()
+        # c.jpg was in flight when an earlier import was interrupted
+        ledger.record(client.url, 'c.jpg', 'uploading')
+        counts = bulk_import(client, maps, ledger, workers=2, log=lambda message: None)
+        check(counts == {'imported': 1, 'failed': 0, 'unknown': 2, 'skipped': 0},
+              f'a 500 after the map was created and an interrupted upload are unknown: {counts}', failures)
+        check(state.posts.count('a.jpg') == 1,
+              f'a 500 after the map was created is not posted again (posts: {state.posts.count("a.jpg")})',
+              failures)
+        check('c.jpg' not in state.posts, 'an interrupted upload is not posted again on resume', failures)
+        check(ledger.statuses(client.url) == {'a.jpg': 'unknown', 'b.jpg': 'imported', 'c.jpg': 'uploading'},
+              f'the ledger keeps the maps whose outcome is unknown: {ledger.statuses(client.url)}', failures)
+
+        counts = bulk_import(client, maps, ledger, workers=2, log=lambda message: None)
+        check(counts == {'imported': 0, 'failed': 0, 'unknown': 2, 'skipped': 1} and len(state.posts) == 2,
+              f'a second run reports the unknown maps without posting them: {counts}', failures)
+
+        state.lose.clear()
+        counts = bulk_import(client, maps, ledger, workers=2, log=lambda message: None, retry_unknown=True)
+        check(counts == {'imported': 2, 'failed': 0, 'unknown': 0, 'skipped': 1},
+              f'retry_unknown uploads the unknown maps again: {counts}', failures)
+
+    closed = StubServer(StubState())
+    closed.server.server_close()  # nothing listens on the port
+    client = client_for(closed)
+    try:
+        client.upload(os.path.join(map_dir, 'b.jpg'), {})
+        check(False, 'an upload that cannot connect raises MapWarperError', failures)
+    except UploadOutcomeUnknown:
+        check(False, 'an upload that cannot connect is not recorded as unknown', failures)
+    except MapWarperError as e:
+        check(e.attempts == client.retries + 1,
+              f'an upload that cannot connect is retried (attempts: {e.attempts})', failures)
+
+
+def main():
+    failures = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        check_directory(work_dir, failures)
+        check_subdirectories(work_dir, failures)
+        check_lost_responses(work_dir, failures)
+    print(f'{len(failures)} check(s) failed' if failures else 'all checks passed')
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
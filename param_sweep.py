@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+パラメータの組み合わせをまとめて評価するスイープ。
+指定した範囲のすべての組み合わせについて、対象ディレクトリの各画像から4隅を求められるか
+（交点がちょうど4つで、左上・右上・左下・右下の位置関係が正しく、画像の範囲内にあるか）を調べ、
+多くの画像で成功した組み合わせから順にJSONで出力する。
+
+前処理は共有する:
+- 画像のデコードは (画像, binary_threshold) ごとに1回、二値化も1回
+- Hough変換は (画像, binary_threshold, ρの精度, θの精度) ごとに1回だけ、line_accumulation の最小値で
+  投票数とともに行い、各 line_accumulation の結果は投票数で絞り込む（cv2.HoughLines と同じ結果）
+- line_offset だけが異なる組み合わせでは LinePipeline がグループ化までの結果を再利用する
+- Hough変換は erode 前の二値画像に対して行う（detect_lines と同じ）ため、erode_kernel・erode_iteration は
+  結果に影響しない。これらの値が異なる組み合わせには同じ結果を記録する
+
+使用例:
+  python param_sweep.py ./targets --binary-threshold 80:140:20 --line-accumulation 5000,10000,15000 \\
+      --theta-precision 90,180 --line-offset 0:10:5 --output sweep.json
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+
+import cv2
+import numpy as np
+
+from line_detector import (
+    load_image,
+    binarize,
+    hough_lines,
+    hough_lines_with_votes,
+    select_lines_by_votes,
+)
+from pipeline import (
+    DEFAULT_PARAMETERS,
+    LinePipeline,
+    PipelineError,
+    normalize_parameters,
+    parameters_key,
+)
+
+
+def check_corners(corners, width, height):
+    """
+    4隅（左上、右上、左下、右下）が四角形として正しい位置関係にあり、画像の範囲内にあるかを調べる
+    問題がある場合はその理由、ない場合はNoneを返す
+    """
+    (ul_x, ul_y), (ur_x, ur_y), (ll_x, ll_y), (lr_x, lr_y) = corners
+    if not (ul_x < ur_x and ll_x < lr_x and ul_y < ll_y and ur_y < lr_y):
+        return '4隅の位置関係が正しくありません'
+    if not all(0 <= x < width and 0 <= y < height for x, y in corners):
+        return '4隅が画像の範囲外です'
+    return None
+
+
+def evaluate(pipeline, params):
+    """1つの組み合わせを評価し、(4隅, エラーメッセージ) を返す（成功した場合はエラーがNone）"""
+    try:
+        corners = pipeline.corners(params)
+    except PipelineError as e:
+        return None, e.message
+    error = check_corners(corners, pipeline.image.width, pipeline.image.height)
+    if error is not None:
+        return None, error
+    return [list(point) for point in corners], None
+
+
+def sweep_image(target_dir, image_name, binary_threshold, grid):
+    """
+    1枚の画像・1つの binary_threshold について、残りのパラメータのすべての組み合わせを評価する
+    戻り値は (パラメータ, 4隅, エラーメッセージ) のリスト
+    ワーカープロセス内で実行されるため、例外はすべてエラーとして記録する
+    """
+    try:
+        return _sweep_image(target_dir, image_name, binary_threshold, grid)
+    except Exception as e:
+        return _error_records(binary_threshold, grid, f'処理中にエラーが発生しました: {str(e)}')
+
+
+def _error_records(binary_threshold, grid, message):
+    """すべての組み合わせを同じエラーとして記録"""
+    return [
+        (normalize_parameters(dict(zip(grid, values), binary_threshold=binary_threshold)),
+         None, message)
+        for values in product(*grid.values())
+    ]
+
+
+def _sweep_image(target_dir, image_name, binary_threshold, grid):
+    decoded = load_image(os.path.join(target_dir, image_name), grayscale=True)
+    if decoded is None:
+        return _error_records(binary_threshold, grid, '画像の読み込みに失敗しました')
+
+    binary = binarize(decoded.gray, binary_threshold)
+    min_accumulation = min(grid['line_accumulation'])
+    records = []
+    for rho_precision, theta_precision, pyramid_levels, border_band in product(
+            grid['rho_precision'], grid['theta_precision'],
+            grid['pyramid_levels'], grid['border_band']):
+        votes = None
+        if pyramid_levels == 0 and border_band == 0:
+            # 投票は1回だけ行い、閾値ごとの結果は投票数で絞り込む
+            votes = hough_lines_with_votes(binary, rho_precision, theta_precision, min_accumulation)
+
+        for line_accumulation in grid['line_accumulation']:
+            if votes is not None:
+                lines = select_lines_by_votes(votes, line_accumulation)
+            else:
+                lines = hough_lines(binary, rho_precision, theta_precision, line_accumulation,
+                                    pyramid_levels=pyramid_levels, border_band=border_band)
+            pipeline = LinePipeline(decoded, detector=lambda lines=lines, **_: lines)
+
+            for line_offset in grid['line_offset']:
+                params = dict(DEFAULT_PARAMETERS,
+                              binary_threshold=binary_threshold,
+                              rho_precision=rho_precision,
+                              theta_precision=theta_precision,
+                              pyramid_levels=pyramid_levels,
+                              border_band=border_band,
+                              line_accumulation=line_accumulation,
+                              line_offset=line_offset)
+                corners, error = evaluate(pipeline, params)
+                # erode のパラメータは結果に影響しないため、同じ結果を記録する
+                for erode_kernel, erode_iteration in product(grid['erode_kernel'],
+                                                             grid['erode_iteration']):
+                    records.append((dict(params, erode_kernel=erode_kernel,
+                                         erode_iteration=erode_iteration), corners, error))
+    return records
+
+
+def _init_worker():
+    """ワーカープロセスの初期化（OpenCV内部のスレッドとコア数を奪い合わないようにする）"""
+    cv2.setNumThreads(1)
+
+
+def run_sweep(target_dir, image_names, grid, workers=None, progress=None):
+    """
+    すべての画像と組み合わせを評価し、組み合わせごとの結果を成功した画像の多い順に返す
+    grid: パラメータ名 -> 値のリスト（DEFAULT_PARAMETERS のすべてのパラメータ）
+    画像と binary_threshold の組ごとにプロセスプールで並列に処理する
+    progress: 1組終わるごとに (完了数, 全体数) で呼ばれる関数
+    """
+    # binary_threshold は処理の単位にするため、残りのパラメータとは分けて渡す
+    rest = {name: values for name, values in grid.items() if name != 'binary_threshold'}
+    tasks = [(image_name, binary_threshold)
+             for image_name in image_names for binary_threshold in grid['binary_threshold']]
+
+    combinations = {}
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    def collect(records, image_name):
+        for params, corners, error in records:
+            combination = combinations.setdefault(parameters_key(params), {
+                'parameters': params,
+                'success_count': 0,
+                'corners': {},
+                'errors': {},
+            })
+            if error is None:
+                combination['success_count'] += 1
+                combination['corners'][image_name] = corners
+            else:
+                combination['errors'][image_name] = error
+
+    if workers <= 1:
+        for done, (image_name, binary_threshold) in enumerate(tasks, 1):
+            collect(sweep_image(target_dir, image_name, binary_threshold, rest), image_name)
+            if progress:
+                progress(done, len(tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            futures = {
+                executor.submit(sweep_image, target_dir, image_name, binary_threshold, rest): image_name
+                for image_name, binary_threshold in tasks
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                collect(future.result(), futures[future])
+                if progress:
+                    progress(done, len(tasks))
+
+    # 成功した画像の多い順（同じ場合はパラメータの指定順）
+    def sort_key(combination):
+        params = combination['parameters']
+        return (-combination['success_count'],
+                tuple(values.index(params[name]) for name, values in grid.items()))
+    return sorted(combinations.values(), key=sort_key)
+
+
+def parse_values(spec, value_type):
+    """
+    値の指定を値のリストにする
+    "a,b,c" はそのまま、"start:stop:step" は start から stop まで（stop を含む）step ごとの値
+    """
+    values = []
+    for part in spec.split(','):
+        if ':' in part:
+            start, stop, step = (value_type(v) for v in part.split(':'))
+            if step <= 0:
+                raise argparse.ArgumentTypeError(f'step は正の値を指定してください: {part}')
+            count = int(np.floor((stop - start) / step + 1e-9)) + 1
+            values.extend(value_type(start + step * i) for i in range(count))
+        else:
+            values.append(value_type(part))
+    # 重複を除く（指定順は保つ）
+    return list(dict.fromkeys(values))
+
+
+# CLIで指定できるパラメータ（パラメータ名 -> 値の型）
+SWEEP_PARAMETERS = {
+    'binary_threshold': int,
+    'erode_kernel': int,
+    'erode_iteration': int,
+    'line_accumulation': int,
+    'rho_precision': int,
+    'theta_precision': float,  # CLIでは画面と同じく π/値 の「値」で指定する
+    'line_offset': float,
+    'pyramid_levels': int,
+    'border_band': float,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='パラメータの組み合わせをまとめて評価し、4隅を求められる組み合わせを探す')
+    parser.add_argument('target_dir', nargs='?', default='./targets',
+                        help='処理対象の画像が格納されているディレクトリ（デフォルト: ./targets）')
+    for name, value_type in SWEEP_PARAMETERS.items():
+        option = '--' + name.replace('_', '-')
+        if name == 'theta_precision':
+            help_text = 'θの精度（π/値 の値。例: 90,180。デフォルト: 90）'
+        else:
+            help_text = f'{name} の値（例: 1,2,3 または 開始:終了:刻み。デフォルト: {DEFAULT_PARAMETERS[name]}）'
+        parser.add_argument(option, dest=name, default=None,
+                            type=lambda spec, value_type=value_type: parse_values(spec, value_type),
+                            help=help_text)
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='並列プロセス数（デフォルト: CPUコア数）')
+    parser.add_argument('-o', '--output', default=None,
+                        help='結果のJSONの出力先（デフォルト: 標準出力）')
+    parser.add_argument('--top', type=int, default=None,
+                        help='出力する組み合わせの数（デフォルト: すべて）')
+    args = parser.parse_args()
+
+    grid = {}
+    for name in SWEEP_PARAMETERS:
+        values = getattr(args, name)
+        if values is None:
+            values = [DEFAULT_PARAMETERS[name]]
+        elif name == 'theta_precision':
+            values = [np.pi / value for value in values]
+        grid[name] = values
+
+    image_names = sorted(
+        f for f in os.listdir(args.target_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    combination_count = int(np.prod([len(values) for values in grid.values()]))
+    print(f'{len(image_names)}枚の画像 × {combination_count}通りの組み合わせを評価します',
+          file=sys.stderr)
+
+    def progress(done, total):
+        print(f'\r{done}/{total}', end='', file=sys.stderr, flush=True)
+
+    combinations = run_sweep(args.target_dir, image_names, grid, args.workers, progress)
+    print(file=sys.stderr)
+    if args.top is not None:
+        combinations = combinations[:args.top]
+
+    report = {
+        'images': image_names,
+        'grid': grid,
+        'combinations': combinations,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+    for combination in combinations[:5]:
+        print(f"{combination['success_count']}/{len(image_names)}: {combination['parameters']}",
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
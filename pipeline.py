@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+直線検出 → グループ化 → オフセット → 代表線 → 交点 → 描画 を段階ごとに実行するパイプライン。
+/api/process・バッチ処理・corner_getter.py で共通に使用する。
+"""
+
+import hashlib
+import json
+import threading
+
+import cv2
+import numpy as np
+
+from line_detector import detect_lines
+from line_utils import (
+    determine_orientation,
+    offset_line,
+    draw_line_full_extent,
+    intersect_lines,
+    lines_to_array,
+    group_similar_lines,
+    representative_line,
+    sort_intersections,
+)
+from stage_timing import timed_stage
+
+# 処理内容のバージョン
+# 直線検出・グループ化・交点計算の結果が変わる変更をした場合は上げる（結果ストアに保存した古い結果を使わないようにする）
+PIPELINE_VERSION = 2
+
+# パラメータのデフォルト値
+DEFAULT_PARAMETERS = {
+    'binary_threshold': 100,
+    'erode_kernel': 3,
+    'erode_iteration': 2,
+    'line_accumulation': 10000,
+    'rho_precision': 2,
+    'theta_precision': np.pi/90,
+    'line_offset': 0,  # デフォルト値は0（オフセットなし）
+    'pyramid_levels': 0,  # 0の場合は元の解像度でHough変換を行う
+    'border_band': 0,  # 0の場合は画像全体でHough変換を行う
+}
+
+# 直線検出（detect_lines）に渡すパラメータ
+DETECTION_PARAMETERS = (
+    'binary_threshold',
+    'erode_kernel',
+    'erode_iteration',
+    'line_accumulation',
+    'rho_precision',
+    'theta_precision',
+    'pyramid_levels',
+    'border_band',
+)
+
+# 許容するグループ数の上限
+MAX_GROUPS = 10
+
+# グループごとの描画色
+GROUP_COLORS = [
+    (0, 0, 255),    # 赤
+    (0, 255, 0),    # 緑
+    (255, 0, 0),    # 青
+    (0, 255, 255),  # 黄
+    (255, 0, 255),  # マゼンタ
+    (255, 255, 0),  # シアン
+    (128, 0, 128),  # 紫
+    (255, 165, 0),  # オレンジ
+]
+
+
+def normalize_parameters(params):
+    """リクエストのパラメータにデフォルト値を補い、パイプラインで使う形式にする"""
+    normalized = dict(DEFAULT_PARAMETERS)
+    if params:
+        for name in DEFAULT_PARAMETERS:
+            if params.get(name) is not None:
+                normalized[name] = params[name]
+    return normalized
+
+
+def parameters_key(params):
+    """
+    正規化したパラメータの組を表す短い文字列
+    同じパラメータで処理した結果かどうかの判定に使う
+    """
+    normalized = normalize_parameters(params)
+    encoded = json.dumps(normalized, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+def preview_scale(width, height, max_dimension):
+    """長辺を max_dimension 以下にする縮小率（指定なし・元の画像の方が小さい場合は1）"""
+    if not max_dimension or max(width, height) <= max_dimension:
+        return 1.0
+    return max_dimension / max(width, height)
+
+
+@timed_stage('preview')
+def resize_preview(color, max_dimension):
+    """長辺が max_dimension 以下になるよう縮小したプレビュー用の画像"""
+    height, width = color.shape[:2]
+    scale = preview_scale(width, height, max_dimension)
+    if scale == 1.0:
+        return color
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(color, size, interpolation=cv2.INTER_AREA)
+
+
+class PipelineError(Exception):
+    """
+    交点を求められなかった場合の例外
+    message はCSVのerror列やAPIのエラーメッセージにそのまま使う
+    """
+
+    def __init__(self, message, **details):
+        super().__init__(message)
+        self.message = message
+        self.details = details
+
+
+class LinePipeline:
+    """
+    1枚の画像に対する処理パイプライン
+    各段階の結果を入力パラメータとともに保持し、関係するパラメータが変わった段階以降だけを再計算する
+    （例えば line_offset だけを変えた場合は、オフセット以降の段階だけを再実行する）
+
+    image: DecodedImage（または width / height / color を持つ互換オブジェクト）
+    detector: 検出パラメータを受け取って直線を返す関数（省略時は detect_lines(image, ...)）
+    previewer: 長辺の画素数を受け取って縮小した画像を返す関数（省略時は resize_preview(image.color, ...)）
+    on_memo_change: 保持する段階の結果が変わるたびにパイプラインを渡して呼ぶ関数（キャッシュの使用量の更新用）
+    """
+
+    def __init__(self, image, detector=None, previewer=None, on_memo_change=None):
+        self.image = image
+        if detector is None:
+            detector = lambda **detection_params: detect_lines(image, **detection_params)
+        if previewer is None:
+            previewer = lambda max_dimension: resize_preview(image.color, max_dimension)
+        self._detector = detector
+        self._previewer = previewer
+        self._on_memo_change = on_memo_change
+        self._memo = {}  # 段階名 -> (キー, 結果)
+        self._lock = threading.RLock()
+
+    def _stage(self, name, key, compute):
+        """
+        キーが前回と同じなら保持している結果を返し、異なれば再計算する
+        再計算した時間は段階名で StageTimer に記録する
+        """
+        with self._lock:
+            memo = self._memo.get(name)
+            if memo is not None and memo[0] == key:
+                return memo[1]
+            with timed_stage(name):
+                result = compute()
+            self._memo[name] = (key, result)
+            if self._on_memo_change is not None:
+                self._on_memo_change(self)
+            return result
+
+    def memoized(self):
+        """保持している各段階の結果のリスト"""
+        with self._lock:
+            return [result for _, result in self._memo.values()]
+
+    @staticmethod
+    def _detection_key(params):
+        return tuple(params[name] for name in DETECTION_PARAMETERS)
+
+    def lines(self, params):
+        """直線を検出"""
+        key = self._detection_key(params)
+        return self._stage('lines', key, lambda: self._detector(
+            **{name: params[name] for name in DETECTION_PARAMETERS}))
+
+    def groups(self, params):
+        """直線をグループ化"""
+        key = self._detection_key(params)
+        return self._stage('groups', key, lambda: group_similar_lines(self.lines(params)))
+
+    def offset_lines(self, params):
+        """各直線にオフセットを適用（オフセットが0の場合は検出した線のまま）"""
+        key = self._detection_key(params) + (params['line_offset'],)
+        return self._stage('offset_lines', key, lambda: self._compute_offset_lines(params))
+
+    def _compute_offset_lines(self, params):
+        lines = self.lines(params)
+        if lines is None:
+            return []
+        line_offset = params['line_offset']
+        if line_offset <= 0:
+            return list(lines)
+        image_width, image_height = self.image.width, self.image.height
+        return [
+            offset_line(line, line_offset, image_width, image_height, determine_orientation(line))
+            for line in lines
+        ]
+
+    def representative_lines(self, params):
+        """オフセット適用後の各グループの代表線（rhoとthetaの平均）"""
+        key = self._detection_key(params) + (params['line_offset'],)
+        return self._stage('representative_lines', key,
+                           lambda: self._compute_representative_lines(params))
+
+    def _compute_representative_lines(self, params):
+        offset_lines = self.offset_lines(params)
+        representative_lines = []
+        for group in self.groups(params):
+            if not group:  # 空のグループをスキップ
+                continue
+            representative_lines.append(
+                representative_line([offset_lines[line_idx] for line_idx in group]))
+        return representative_lines
+
+    def intersections(self, params):
+        """代表線同士の交点"""
+        key = self._detection_key(params) + (params['line_offset'],)
+        return self._stage('intersections', key,
+                           lambda: self._compute_intersections(params))
+
+    def _compute_intersections(self, params):
+        # 全ての代表線の組み合わせについて交点をまとめて計算
+        points = intersect_lines(self.representative_lines(params))
+        return [tuple(point) for point in points.tolist()]
+
+    def check_groups(self, params):
+        """グループ数が多すぎる場合は PipelineError を送出し、グループを返す"""
+        line_groups = self.groups(params)
+        if len(line_groups) > MAX_GROUPS:
+            raise PipelineError(f'グループ数が多すぎます（{len(line_groups)}個）',
+                                groups_count=len(line_groups))
+        return line_groups
+
+    def corners(self, params):
+        """
+        図郭の4隅を左上、右上、左下、右下の順に返す
+        求められない場合は理由を含む PipelineError を送出する
+        """
+        lines = self.lines(params)
+        if lines is None or len(lines) == 0:
+            raise PipelineError('線が検出されませんでした')
+
+        self.check_groups(params)
+
+        intersections = self.intersections(params)
+        if len(intersections) != 4:
+            raise PipelineError(f'交点が4つではありません（{len(intersections)}個）',
+                                intersections_count=len(intersections))
+
+        sorted_intersections = sort_intersections(intersections)
+        if sorted_intersections is None:
+            raise PipelineError('交点の並べ替えに失敗しました')
+        return sorted_intersections
+
+    def summary(self, params):
+        """
+        直線・グループ・交点・4隅（求められない場合はエラーメッセージ）と画像の大きさをまとめて返す
+        結果ストアに保存する形式（JSONに変換できる値のみ）
+        image_size は保存した結果から描画せずに応答する場合に、画像をデコードせずに使う
+        """
+        lines = self.lines(params)
+        groups = self.groups(params)
+        # グループ数が多すぎる場合は交点を計算しない（/api/process と同様）
+        intersections = self.intersections(params) if len(groups) <= MAX_GROUPS else []
+        corners = None
+        error = None
+        error_details = {}
+        try:
+            corners = self.corners(params)
+        except PipelineError as e:
+            error = e.message
+            error_details = e.details
+        return {
+            'lines': lines.reshape(-1, 2).tolist() if lines is not None else None,
+            'groups': groups,
+            'intersections': intersections,
+            'corners': corners,
+            'error': error,
+            'error_details': error_details,
+            'image_size': [self.image.width, self.image.height],
+        }
+
+    def restore(self, params, result):
+        """
+        summary の結果（結果ストアから取り出したもの）を各段階の結果として登録する
+        直線検出をやり直さずに描画などを行える
+        """
+        key = self._detection_key(params)
+        lines = result['lines']
+        if lines is not None:
+            lines = np.array(lines, dtype=np.float32).reshape(-1, 1, 2)
+        with self._lock:
+            self._memo['lines'] = (key, lines)
+            self._memo['groups'] = (key, result['groups'])
+            if len(result['groups']) <= MAX_GROUPS:
+                self._memo['intersections'] = (key + (params['line_offset'],),
+                                               list(result['intersections']))
+            if self._on_memo_change is not None:
+                self._on_memo_change(self)
+
+    @timed_stage('overlay')
+    def overlay(self, params):
+        """
+        render で描画する内容を配列で返す（クライアント側で描画するためのもの）
+        lines: オフセット適用後の各直線の (rho, theta)、(N, 2) の float32
+        line_groups: 各直線のグループ番号（グループ化されていない直線は-1）、(N,) の int32
+        representative_lines: 各グループの代表線の (rho, theta)、(M, 2) の float32
+        intersections: 代表線同士の交点のうち画像の範囲内のもの、(K, 2) の int64
+        """
+        image_size = (self.image.width, self.image.height)
+        if self.lines(params) is None:
+            return {
+                'lines': np.empty((0, 2), np.float32),
+                'line_groups': np.empty(0, np.int32),
+                'representative_lines': np.empty((0, 2), np.float32),
+                'intersections': np.empty((0, 2), np.int64),
+            }
+
+        offset_lines = lines_to_array(self.offset_lines(params)).astype(np.float32)
+        line_groups = np.full(len(offset_lines), -1, np.int32)
+        for group_idx, group in enumerate(self.groups(params)):
+            line_groups[group] = group_idx
+        representative_lines = self.representative_lines(params)
+        return {
+            'lines': offset_lines,
+            'line_groups': line_groups,
+            'representative_lines': lines_to_array(representative_lines).astype(np.float32),
+            'intersections': intersect_lines(representative_lines, image_size),
+        }
+
+    @timed_stage('draw')
+    def render(self, params, max_dimension=None):
+        """
+        元の画像にグループごとの色で線を、白丸で交点を描画した画像を返す
+        max_dimension を指定した場合は長辺がその画素数以下になるよう縮小した画像に描画する
+        （線と交点の座標も同じ倍率で縮小する）
+        """
+        image_width, image_height = self.image.width, self.image.height
+        scale = preview_scale(image_width, image_height, max_dimension)
+        if scale == 1.0:
+            result_image = self.image.color.copy()
+        else:
+            result_image = self._previewer(max_dimension).copy()
+        if self.lines(params) is None:
+            return result_image
+
+        offset_lines = self.offset_lines(params)
+        for group_idx, group in enumerate(self.groups(params)):
+            color = GROUP_COLORS[group_idx % len(GROUP_COLORS)]
+            for line_idx in group:
+                # 線を画像の端から端まで描画（縮小した画像では rho だけを縮小する）
+                line = offset_lines[line_idx]
+                if scale != 1.0:
+                    line = [[line[0][0] * scale, line[0][1]]]
+                draw_line_full_extent(result_image, line, color, 3)
+
+        # 交点を画像上に描画（元の画像の範囲内にある交点のみ）
+        points = intersect_lines(self.representative_lines(params), (image_width, image_height))
+        for x, y in points.tolist():
+            point = (round(x * scale), round(y * scale)) if scale != 1.0 else (x, y)
+            cv2.circle(result_image, point, 10, (255, 255, 255), -1)  # 白い円で交点を描画
+            cv2.circle(result_image, point, 10, (0, 0, 0), 2)  # 黒い輪郭線
+        return result_image
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+処理結果（直線・グループ・交点・4隅）を画像の内容のハッシュ値とパラメータの組ごとに保存する
+SQLiteの結果ストア。/api/process・バッチ処理・corner_getter.py で共通に使用し、
+同じ画像を同じパラメータで処理した結果はサーバーを再起動しても再計算しない。
+
+保存した結果は pipeline.PIPELINE_VERSION ごとに区別されるため、直線検出などの処理内容を
+変更した場合は PIPELINE_VERSION を上げれば古い結果は使われなくなる。古い結果の削除は
+  python result_store.py purge [ストアのパス]
+で行う（--all を付けるとすべての結果を削除する）。
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from file_hash import FileHashCache
+from pipeline import PIPELINE_VERSION, normalize_parameters, parameters_key
+
+# 画像の内容の識別に使うハッシュアルゴリズム
+CONTENT_HASH_ALGORITHM = 'sha256'
+
+def default_store_path(target_dir):
+    """対象ディレクトリの隣に置く結果ストアのパス（例: ./targets -> ./targets.results.sqlite3）"""
+    target_dir = os.path.abspath(target_dir)
+    return os.path.join(os.path.dirname(target_dir),
+                        os.path.basename(target_dir) + '.results.sqlite3')
+
+
+class ResultStore:
+    """
+    SQLiteファイルに処理結果を保存するクラス
+    バッチ処理では複数のプロセスから同時に書き込むため、WALモードで開き、
+    接続はスレッドごとに作成する
+    画像の内容のハッシュ値も同じファイルにキャッシュし、変更されていない画像は再度読み込まない
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._create_tables()
+        self._hashes = FileHashCache(path)
+
+    def content_hash(self, image_path):
+        """画像ファイルの内容のハッシュ値（結果を探すキー）"""
+        return self._hashes.digest(image_path, CONTENT_HASH_ALGORITHM)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _create_tables(self):
+        connection = self._connection()
+        with connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    content_hash TEXT NOT NULL,
+                    parameters_key TEXT NOT NULL,
+                    pipeline_version INTEGER NOT NULL,
+                    parameters TEXT NOT NULL,
+                    lines TEXT,
+                    groups TEXT NOT NULL,
+                    intersections TEXT NOT NULL,
+                    corners TEXT,
+                    error TEXT,
+                    error_details TEXT,
+                    created_at REAL NOT NULL,
+                    image_width INTEGER,
+                    image_height INTEGER,
+                    PRIMARY KEY (content_hash, parameters_key, pipeline_version)
+                )
+            ''')
+            # 画像の幅・高さの列がない以前のストアには列を追加する（以前の結果の幅・高さは NULL）
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(results)')}
+            for column in ('image_width', 'image_height'):
+                if column not in columns:
+                    connection.execute(f'ALTER TABLE results ADD COLUMN {column} INTEGER')
+
+    def get(self, digest, params):
+        """保存済みの結果（LinePipeline.summary と同じ形式）を返す。ない場合は None"""
+        row = self._connection().execute(
+            'SELECT lines, groups, intersections, corners, error, error_details, image_width, image_height '
+            'FROM results WHERE content_hash = ? AND parameters_key = ? AND pipeline_version = ?',
+            (digest, parameters_key(params), PIPELINE_VERSION)).fetchone()
+        if row is None:
+            return None
+        lines, groups, intersections, corners, error, error_details, width, height = row
+        return {
+            'lines': json.loads(lines) if lines is not None else None,
+            'groups': json.loads(groups),
+            'intersections': [tuple(point) for point in json.loads(intersections)],
+            'corners': [tuple(point) for point in json.loads(corners)] if corners is not None else None,
+            'error': error,
+            'error_details': json.loads(error_details) if error_details is not None else {},
+            'image_size': [width, height] if width is not None else None,
+        }
+
+    def put(self, digest, params, result):
+        """LinePipeline.summary の結果を保存する"""
+        lines = result['lines']
+        corners = result['corners']
+        width, height = result.get('image_size') or (None, None)
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO results (content_hash, parameters_key, pipeline_version, '
+                'parameters, lines, groups, intersections, corners, error, error_details, created_at, '
+                'image_width, image_height) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (digest, parameters_key(params), PIPELINE_VERSION,
+                 json.dumps(normalize_parameters(params), sort_keys=True),
+                 json.dumps(lines) if lines is not None else None,
+                 json.dumps(result['groups']),
+                 json.dumps([list(point) for point in result['intersections']]),
+                 json.dumps([list(point) for point in corners]) if corners is not None else None,
+                 result['error'],
+                 json.dumps(result['error_details']) if result['error'] is not None else None,
+                 time.time(), width, height))
+
+    def purge(self, all_versions=False):
+        """現在の PIPELINE_VERSION 以外の結果（all_versions=True の場合はすべて）を削除し、削除件数を返す"""
+        connection = self._connection()
+        with connection:
+            if all_versions:
+                cursor = connection.execute('DELETE FROM results')
+            else:
+                cursor = connection.execute('DELETE FROM results WHERE pipeline_version != ?',
+                                            (PIPELINE_VERSION,))
+        connection.execute('VACUUM')
+        return cursor.rowcount
+
+    def stats(self):
+        count, current = self._connection().execute(
+            'SELECT COUNT(*), SUM(pipeline_version = ?) FROM results',
+            (PIPELINE_VERSION,)).fetchone()
+        return {
+            'path': self.path,
+            'entries': count,
+            'current_version_entries': current or 0,
+            'pipeline_version': PIPELINE_VERSION,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='処理結果ストアの管理')
+    parser.add_argument('command', choices=['stats', 'purge'],
+                        help='stats: 保存件数を表示 / purge: 古いバージョンの結果を削除')
+    parser.add_argument('path', nargs='?', default=default_store_path('./targets'),
+                        help='結果ストアのパス（デフォルト: ./targets.results.sqlite3）')
+    parser.add_argument('--all', action='store_true',
+                        help='purge で現在のバージョンの結果も含めてすべて削除する')
+    args = parser.parse_intermixed_args()
+
+    store = ResultStore(args.path)
+    if args.command == 'purge':
+        print(f'{store.purge(all_versions=args.all)}件の結果を削除しました。')
+    else:
+        print(json.dumps(store.stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
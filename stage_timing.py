@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+処理の段階ごとの時間計測。
+StageTimer を有効にしたスレッドでは、timed_stage で囲んだ段階（デコード・二値化・Hough変換・描画など）の
+処理時間（必要であればメモリ割り当て量）を記録する。StageTimer が有効でない場合は何もしない。
+StageMetrics は記録した処理時間を段階ごとのヒストグラムに集計し、Prometheus のテキスト形式で出力する。
+"""
+
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# 現在のスレッドで有効な StageTimer
+_local = threading.local()
+
+# ヒストグラムのバケットの上限（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Prometheus のメトリクス名の接頭辞
+METRICS_PREFIX = 'gaihozu'
+
+
+class StageTimer:
+    """
+    1回分の処理（1リクエスト・1画像）の段階ごとの処理時間を記録するクラス
+    with 文の中で実行された timed_stage の時間を段階名ごとに合計する
+    段階が入れ子になった場合は、内側の段階の時間を外側の段階から除く（各段階の時間の合計が全体の時間を超えない）
+    trace_allocations=True の場合は、各段階で増えたメモリ使用量のピーク（tracemalloc）も記録する
+    （tracemalloc はプロセス全体で共有するため、同時に処理しているスレッドの割り当ても含む目安の値）
+    """
+
+    def __init__(self, trace_allocations=False):
+        self.trace_allocations = trace_allocations
+        self.stages = {}  # 段階名 -> {'seconds', 'calls'(, 'allocated_bytes')}
+        self._stack = []  # 実行中の段階の [開始時刻, 内側の段階の時間, メモリのピーク, 開始時のメモリ使用量]
+        self._started_at = None
+        self._finished_at = None
+        self._previous = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'timer', None)
+        _local.timer = self
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._finished_at = time.perf_counter()
+        _local.timer = self._previous
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+
+    def _enter_stage(self):
+        memory = peak = None
+        if self.trace_allocations and tracemalloc.is_tracing():
+            memory, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                # 外側の段階のそれまでのピークを残してからリセットする
+                parent = self._stack[-1]
+                parent[2] = max(parent[2], peak)
+            tracemalloc.reset_peak()
+            peak = memory
+        self._stack.append([time.perf_counter(), 0.0, peak, memory])
+
+    def _exit_stage(self, name):
+        started, child_seconds, peak, memory = self._stack.pop()
+        elapsed = time.perf_counter() - started
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] += elapsed - child_seconds
+        stage['calls'] += 1
+        if memory is not None and tracemalloc.is_tracing():
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            stage['allocated_bytes'] = max(stage.get('allocated_bytes', 0), peak - memory)
+        if self._stack:
+            parent = self._stack[-1]
+            parent[1] += elapsed
+            if parent[2] is not None and peak is not None:
+                parent[2] = max(parent[2], peak)
+
+    @property
+    def total_seconds(self):
+        """with 文の開始からの時間（終了後は with 文全体の時間）"""
+        if self._started_at is None:
+            return 0.0
+        return (self._finished_at or time.perf_counter()) - self._started_at
+
+    def to_dict(self):
+        """JSONで返せる形式（秒はマイクロ秒単位に丸める）"""
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage, seconds=round(stage['seconds'], 6))
+        return {'stages': stages, 'total_seconds': round(self.total_seconds, 6)}
+
+    def server_timing(self):
+        """Server-Timing ヘッダーの値（各段階と全体の時間をミリ秒で）"""
+        entries = [f'{name};dur={stage["seconds"] * 1000:.1f}'
+                   for name, stage in self.stages.items()]
+        entries.append(f'total;dur={self.total_seconds * 1000:.1f}')
+        return ', '.join(entries)
+
+
+def current_timer():
+    """現在のスレッドで有効な StageTimer（ない場合はNone）"""
+    return getattr(_local, 'timer', None)
+
+
+@contextmanager
+def timed_stage(name):
+    """
+    囲んだ処理の時間を、現在のスレッドで有効な StageTimer に段階 name として記録する
+    関数のデコレーターとしても使える（@timed_stage('hough')）
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        yield
+        return
+    timer._enter_stage()
+    try:
+        yield
+    finally:
+        timer._exit_stage(name)
+
+
+class StageMetrics:
+    """
+    StageTimer の記録を (集計元, 段階) ごとのヒストグラムに集計するクラス
+    集計元は 'process'（/api/process）や 'batch'（バッチ処理）など
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._stages = {}  # (集計元, 段階名) -> [バケットごとの件数, 合計秒, 件数]
+        self._totals = {}  # 集計元 -> [バケットごとの件数, 合計秒, 件数]
+        self._lock = threading.Lock()
+
+    def _observe(self, histograms, key, seconds):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, upper in enumerate(self.buckets):
+            if seconds <= upper:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def observe(self, source, timings):
+        """StageTimer.to_dict() の結果を集計する"""
+        with self._lock:
+            for name, stage in timings['stages'].items():
+                self._observe(self._stages, (source, name), stage['seconds'])
+            self._observe(self._totals, source, timings['total_seconds'])
+
+    def prometheus(self):
+        """Prometheus のテキスト形式（version 0.0.4）"""
+        with self._lock:
+            lines = []
+            stage_metric = f'{METRICS_PREFIX}_stage_duration_seconds'
+            lines.append(f'# HELP {stage_metric} 処理の段階ごとの処理時間')
+            lines.append(f'# TYPE {stage_metric} histogram')
+            for (source, name), histogram in sorted(self._stages.items()):
+                lines.extend(self._histogram_lines(
+                    stage_metric, f'source="{source}",stage="{name}"', histogram))
+
+            total_metric = f'{METRICS_PREFIX}_run_duration_seconds'
+            lines.append(f'# HELP {total_metric} 1回分の処理（1リクエスト・1画像）全体の処理時間')
+            lines.append(f'# TYPE {total_metric} histogram')
+            for source, histogram in sorted(self._totals.items()):
+                lines.extend(self._histogram_lines(total_metric, f'source="{source}"', histogram))
+        return '\n'.join(lines) + '\n'
+
+    def _histogram_lines(self, metric, labels, histogram):
+        counts, total, count = histogram
+        for upper, bucket_count in zip(self.buckets, counts):
+            yield f'{metric}_bucket{{{labels},le="{upper:g}"}} {bucket_count}'
+        yield f'{metric}_bucket{{{labels},le="+Inf"}} {count}'
+        yield f'{metric}_sum{{{labels}}} {total:.6f}'
+        yield f'{metric}_count{{{labels}}} {count}'
+
+    def clear(self):
+        with self._lock:
+            self._stages.clear()
+            self._totals.clear()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""
+テスト共通の設定と、図郭だけを描いた小さな合成画像のディレクトリ。
+"""
+
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+# リポジトリ直下のモジュール（batch_processor など）を読み込めるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 合成画像の大きさと、図郭を検出できる line_accumulation
+IMAGE_WIDTH = 1600
+IMAGE_HEIGHT = 1200
+PARAMS = {'line_accumulation': 800}
+
+
+def write_sheet(path, shift=0):
+    """図郭（太さ5の矩形）を描いた画像。shift ごとに左辺と下辺の位置が変わる"""
+    image = np.full((IMAGE_HEIGHT, IMAGE_WIDTH, 3), 235, np.uint8)
+    cv2.rectangle(image, (100 + 10 * shift, 100), (1500, 1100 - 10 * shift), (0, 0, 0), 5)
+    cv2.imwrite(path, image)
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    """図郭の位置が異なる6枚の画像と、読み込めない画像1枚のディレクトリ"""
+    directory = tmp_path / 'targets'
+    directory.mkdir()
+    for i in range(6):
+        write_sheet(str(directory / f'sheet{i}.png'), shift=i)
+    (directory / 'broken.png').write_bytes(b'not an image')
+    return str(directory)
+
+
+@pytest.fixture
+def image_names(image_dir):
+    return sorted(os.listdir(image_dir))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+batch_jobs: キャンセル・再開（変更されていない行の再利用と変更された画像の再処理）・行の順・ジョブの保持数。
+"""
+
+import csv
+import os
+import time
+
+import pytest
+
+import batch_jobs
+from batch_jobs import BatchJob, JobManager
+from batch_processor import CSV_HEADER
+from conftest import PARAMS
+
+
+def read_rows(csv_path):
+    with open(csv_path, newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        assert next(reader) == CSV_HEADER
+        return list(reader)
+
+
+def record_pending(monkeypatch, cancel_after=None, job=None):
+    """iter_batch_rows に渡された画像名を記録する（cancel_after 行目を返す前に job をキャンセルする）"""
+    pending = []
+    real_iter_batch_rows = batch_jobs.iter_batch_rows
+
+    def iter_batch_rows(target_dir, image_names, params, **kwargs):
+        pending.extend(image_names)
+        for count, row in enumerate(real_iter_batch_rows(target_dir, image_names, params, **kwargs), 1):
+            if count == cancel_after:
+                job.cancel()
+            yield row
+
+    monkeypatch.setattr(batch_jobs, 'iter_batch_rows', iter_batch_rows)
+    return pending
+
+
+def run_job(image_dir, image_names, csv_path, job_id, resume=False, workers=1):
+    job = BatchJob(job_id, image_dir, image_names, PARAMS, csv_path, workers=workers, resume=resume)
+    job.run()
+    return job
+
+
+def test_cancel_keeps_processed_rows(monkeypatch, image_dir, image_names, tmp_path):
+    csv_path = str(tmp_path / 'intersections.csv')
+    job = BatchJob('cancelled', image_dir, image_names, PARAMS, csv_path, workers=1)
+    record_pending(monkeypatch, cancel_after=3, job=job)
+    job.run()
+
+    assert job.status == 'cancelled'
+    assert job.to_dict()['processed'] == 3
+    assert [row[0] for row in read_rows(csv_path)] == image_names[:3]
+
+
+def test_resume_reuses_unchanged_rows_and_reprocesses_changed(monkeypatch, image_dir, image_names,
+                                                              tmp_path):
+    csv_path = str(tmp_path / 'intersections.csv')
+    first = BatchJob('first', image_dir, image_names, PARAMS, csv_path, workers=1)
+    record_pending(monkeypatch, cancel_after=4, job=first)
+    first.run()
+    # broken.png（失敗）と sheet0〜2 を処理した時点でキャンセルし、sheet1 を更新する
+    assert [row[0] for row in read_rows(csv_path)] == ['broken.png', 'sheet0.png', 'sheet1.png',
+                                                      'sheet2.png']
+    os.utime(os.path.join(image_dir, 'sheet1.png'), ns=(1, 1))
+
+    pending = record_pending(monkeypatch)
+    resumed = run_job(image_dir, image_names, csv_path, 'resumed', resume=True, workers=2)
+
+    # 失敗した画像・更新した画像・未処理の画像だけを処理する
+    assert pending == ['broken.png', 'sheet1.png', 'sheet3.png', 'sheet4.png', 'sheet5.png']
+    progress = resumed.to_dict()
+    assert progress['status'] == 'completed'
+    assert progress['skipped'] == 2
+    assert progress['processed'] == len(image_names)
+
+    # 行は画像の順で、最初から処理し直した場合と同じ
+    resumed_rows = read_rows(csv_path)
+    assert [row[0] for row in resumed_rows] == image_names
+    fresh = run_job(image_dir, image_names, str(tmp_path / 'fresh.csv'), 'fresh')
+    assert resumed_rows == read_rows(fresh.csv_path)
+
+
+def test_resume_of_finished_job_processes_only_failures(monkeypatch, image_dir, image_names, tmp_path):
+    csv_path = str(tmp_path / 'intersections.csv')
+    run_job(image_dir, image_names, csv_path, 'first')
+    rows = read_rows(csv_path)
+
+    pending = record_pending(monkeypatch)
+    resumed = run_job(image_dir, image_names, csv_path, 'resumed', resume=True)
+
+    assert pending == ['broken.png']
+    assert read_rows(csv_path) == rows
+    # 処理速度は今回処理した1枚を、前回のCSVを読み終えてからの時間で割った値
+    progress = resumed.to_dict()
+    assert progress['skipped'] == len(image_names) - 1
+    processing_seconds = resumed.finished_at - resumed.processing_started_at
+    assert progress['images_per_second'] == pytest.approx(1 / processing_seconds, abs=1e-3)
+
+
+def test_job_manager_discards_old_finished_jobs(image_dir, image_names, tmp_path):
+    manager = JobManager(max_finished=2)
+    job_ids = []
+    for i in range(4):
+        job = manager.submit(image_dir, image_names[:1], PARAMS, str(tmp_path / f'{i}.csv'), workers=1)
+        while job.finished_at is None:
+            time.sleep(0.01)
+        job_ids.append(job.job_id)
+
+    assert manager.get(job_ids[0]) is None
+    assert all(manager.get(job_id) is not None for job_id in job_ids[1:])
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+"""
+batch_processor.iter_batch_rows: プロセスプールの結果が逐次処理と同じであること。
+"""
+
+from batch_processor import CSV_HEADER, ERROR_COLUMN, iter_batch_rows
+from conftest import PARAMS
+
+
+def test_process_pool_matches_serial(image_dir, image_names):
+    serial = list(iter_batch_rows(image_dir, image_names, PARAMS, workers=1))
+    pooled = list(iter_batch_rows(image_dir, image_names, PARAMS, workers=2, max_in_flight=2))
+
+    assert pooled == serial
+    assert [row[0] for row in pooled] == image_names
+    assert all(len(row) == len(CSV_HEADER) for row in pooled)
+
+
+def test_rows_report_corners_and_errors(image_dir, image_names):
+    rows = {row[0]: row for row in iter_batch_rows(image_dir, image_names, PARAMS, workers=2)}
+
+    assert rows['broken.png'][ERROR_COLUMN] == '画像の読み込みに失敗しました'
+    # 左上・右上・左下・右下の順（図郭の線の太さの分だけ内側にずれる）
+    assert rows['sheet0.png'][1:ERROR_COLUMN + 1] == [102, 100, 1498, 100, 102, 1100, 1498, 1100, '']
+    assert rows['sheet3.png'][1:ERROR_COLUMN + 1] == [130, 100, 1498, 100, 130, 1068, 1498, 1068, '']
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+result_store: 保存した結果がそのまま返ること、PIPELINE_VERSION を上げると使われなくなること。
+"""
+
+import os
+
+import pytest
+
+import batch_processor
+import result_store
+from batch_processor import process_image_row
+from conftest import PARAMS
+from line_detector import load_image
+from pipeline import LinePipeline, PIPELINE_VERSION, normalize_parameters
+from result_store import ResultStore
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    path = str(tmp_path / 'targets.results.sqlite3')
+    yield path
+    # process_image_row が開いたストアを次のテストに持ち越さない
+    batch_processor._result_stores.pop(path, None)
+
+
+def forbid_detection(monkeypatch):
+    """直線検出を行うとテストを失敗させる"""
+    def fail(*args, **kwargs):
+        raise AssertionError('保存済みの結果があるのに直線検出を行いました')
+    monkeypatch.setattr(batch_processor, 'LinePipeline', fail)
+
+
+def test_stored_result_is_returned_unchanged(image_dir, store_path):
+    image_path = os.path.join(image_dir, 'sheet2.png')
+    params = normalize_parameters(PARAMS)
+    summary = LinePipeline(load_image(image_path, grayscale=True)).summary(params)
+
+    store = ResultStore(store_path)
+    digest = store.content_hash(image_path)
+    store.put(digest, params, summary)
+
+    assert store.get(digest, params) == summary
+    assert store.get(digest, dict(params, line_accumulation=900)) is None
+
+
+def test_batch_row_uses_stored_result(monkeypatch, image_dir, store_path):
+    row = process_image_row(image_dir, 'sheet2.png', PARAMS, store_path)
+
+    forbid_detection(monkeypatch)
+    assert process_image_row(image_dir, 'sheet2.png', PARAMS, store_path) == row
+
+
+def test_pipeline_version_invalidates_stored_results(monkeypatch, image_dir, store_path):
+    image_path = os.path.join(image_dir, 'sheet2.png')
+    row = process_image_row(image_dir, 'sheet2.png', PARAMS, store_path)
+    store = ResultStore(store_path)
+    digest = store.content_hash(image_path)
+    assert store.get(digest, PARAMS) is not None
+
+    monkeypatch.setattr(result_store, 'PIPELINE_VERSION', PIPELINE_VERSION + 1)
+    assert store.get(digest, PARAMS) is None
+
+    # 新しいバージョンでは計算し直して保存する
+    detected = []
+    real_pipeline = batch_processor.LinePipeline
+    monkeypatch.setattr(batch_processor, 'LinePipeline',
+                        lambda image: detected.append(image) or real_pipeline(image))
+    assert process_image_row(image_dir, 'sheet2.png', PARAMS, store_path) == row
+    assert len(detected) == 1
+    assert store.get(digest, PARAMS) is not None
+
+    assert store.purge() == 1
+    assert store.stats()['entries'] == 1
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ハンディモードの画像表示に使うタイルピラミッド。
+元の解像度（レベル0）から1/2ずつ縮小した各レベルの画像を TILE_SIZE 四方のJPEGタイルに分割し、
+対象ディレクトリの隣の <ディレクトリ名>.tiles/ にキャッシュする。
+タイルは要求されたときに生成する（python tile_pyramid.py [対象ディレクトリ] ですべて事前に生成できる）。
+"""
+
+import argparse
+import json
+import os
+import shutil
+import threading
+from urllib.parse import quote
+
+import cv2
+
+from image_cache import ImageCache
+
+# タイルの一辺の画素数
+TILE_SIZE = 256
+
+# タイルのJPEG品質
+TILE_JPEG_QUALITY = 85
+
+
+def default_tile_dir(target_dir):
+    """対象ディレクトリの隣に置くタイルのキャッシュディレクトリ（例: ./targets -> ./targets.tiles）"""
+    target_dir = os.path.abspath(target_dir)
+    return os.path.join(os.path.dirname(target_dir), os.path.basename(target_dir) + '.tiles')
+
+
+def level_sizes(width, height, tile_size=TILE_SIZE):
+    """
+    各レベルの (幅, 高さ)
+    レベル0が元の解像度で、1つ上がるごとに1/2（端数は切り上げ）。最後のレベルは1枚のタイルに収まる
+    """
+    sizes = [(width, height)]
+    while max(sizes[-1]) > tile_size:
+        level_width, level_height = sizes[-1]
+        sizes.append(((level_width + 1) // 2, (level_height + 1) // 2))
+    return sizes
+
+
+def _write_atomic(path, data):
+    """書き込み途中のファイルが読まれないよう、一時ファイルに書いてから置き換える"""
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class TilePyramid:
+    """
+    画像ごとのタイルをディスクにキャッシュするクラス
+    キャッシュは画像ファイルのサイズ・更新時刻ごとのディレクトリに置くため、
+    画像が更新された場合は自動的に作り直す（古いディレクトリは削除する）
+    縮小画像の作成には ImageCache を使い、同じ画像のタイルを続けて生成する場合はデコードし直さない
+    root_dir を指定した場合は root_dir からの相対パスを画像名とする（サブディレクトリの同名の画像を区別する）
+    """
+
+    def __init__(self, cache_dir, image_cache, tile_size=TILE_SIZE, quality=TILE_JPEG_QUALITY,
+                 root_dir=None):
+        self.cache_dir = cache_dir
+        self.image_cache = image_cache
+        self.root_dir = root_dir
+        self.tile_size = tile_size
+        self.quality = quality
+        self._locks = {}  # 画像のキャッシュディレクトリ -> Lock（同じ画像を同時にデコードしないため）
+        self._locks_lock = threading.Lock()
+
+    def _image_dir(self, image_path):
+        stat = os.stat(image_path)
+        if self.root_dir is not None:
+            name = os.path.relpath(image_path, self.root_dir).replace(os.sep, '/')
+        else:
+            name = os.path.basename(image_path)
+        name = quote(name, safe='')
+        return os.path.join(self.cache_dir, name, f'{stat.st_size:x}-{stat.st_mtime_ns:x}')
+
+    def _lock(self, image_dir):
+        with self._locks_lock:
+            return self._locks.setdefault(image_dir, threading.Lock())
+
+    def info(self, image_path):
+        """
+        画像の大きさと各レベルのタイル数（読み込みに失敗した場合はNone）
+        levels[i] は {'width', 'height', 'columns', 'rows'}
+        """
+        image_dir = self._image_dir(image_path)
+        info_path = os.path.join(image_dir, 'pyramid.json')
+        if os.path.exists(info_path):
+            with open(info_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+
+        with self._lock(image_dir):
+            if os.path.exists(info_path):
+                with open(info_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            color = self.image_cache.color(image_path)
+            if color is None:
+                return None
+            height, width = color.shape[:2]
+            info = {
+                'width': width,
+                'height': height,
+                'tile_size': self.tile_size,
+                'levels': [
+                    {
+                        'width': level_width,
+                        'height': level_height,
+                        'columns': -(-level_width // self.tile_size),
+                        'rows': -(-level_height // self.tile_size),
+                    }
+                    for level_width, level_height in level_sizes(width, height, self.tile_size)
+                ],
+            }
+            self._remove_stale(image_dir)
+            os.makedirs(image_dir, exist_ok=True)
+            _write_atomic(info_path, json.dumps(info).encode('utf-8'))
+            return info
+
+    def _remove_stale(self, image_dir):
+        """同じ画像の以前のバージョンのタイルを削除"""
+        parent = os.path.dirname(image_dir)
+        if not os.path.isdir(parent):
+            return
+        for name in os.listdir(parent):
+            path = os.path.join(parent, name)
+            if path != image_dir:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def tile_path(self, image_path, level, column, row):
+        """
+        タイル画像（JPEG）のパス。まだ生成していない場合は生成する
+        範囲外のタイルを指定した場合や画像の読み込みに失敗した場合はNone
+        """
+        info = self.info(image_path)
+        if info is None or not 0 <= level < len(info['levels']):
+            return None
+        level_info = info['levels'][level]
+        if not (0 <= column < level_info['columns'] and 0 <= row < level_info['rows']):
+            return None
+
+        image_dir = self._image_dir(image_path)
+        path = os.path.join(image_dir, str(level), f'{column}_{row}.jpg')
+        if os.path.exists(path):
+            return path
+
+        with self._lock(image_dir):
+            if os.path.exists(path):
+                return path
+            scaled = self.image_cache.scaled(image_path, level)
+            if scaled is None:
+                return None
+            top, left = row * self.tile_size, column * self.tile_size
+            tile = scaled[top:top + self.tile_size, left:left + self.tile_size]
+            ok, encoded = cv2.imencode('.jpg', tile, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if not ok:
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_atomic(path, encoded.tobytes())
+        return path
+
+    def generate_all(self, image_path):
+        """画像のすべてのタイルを生成し、生成したタイル数を返す（読み込みに失敗した場合は0）"""
+        info = self.info(image_path)
+        if info is None:
+            return 0
+        count = 0
+        for level, level_info in enumerate(info['levels']):
+            for row in range(level_info['rows']):
+                for column in range(level_info['columns']):
+                    if self.tile_path(image_path, level, column, row) is not None:
+                        count += 1
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ハンディモード用のタイルを事前に生成')
+    parser.add_argument('target_dir', nargs='?', default='./targets',
+                        help='処理対象の画像が格納されているディレクトリ（デフォルト: ./targets）')
+    parser.add_argument('--tile-dir', default=None,
+                        help='タイルの保存先（デフォルト: 対象ディレクトリの隣の <ディレクトリ名>.tiles）')
+    parser.add_argument('--cache-mb', type=int, default=1024,
+                        help='縮小画像のキャッシュに使うメモリの上限（MB、デフォルト: 1024）')
+    args = parser.parse_args()
+
+    image_cache = ImageCache(max_bytes=args.cache_mb * 1024 * 1024)
+    pyramid = TilePyramid(args.tile_dir or default_tile_dir(args.target_dir), image_cache,
+                          root_dir=args.target_dir)
+    for filename in sorted(os.listdir(args.target_dir)):
+        if not filename.lower().endswith(('.jpg', '.jpeg', '.png')):
+            continue
+        count = pyramid.generate_all(os.path.join(args.target_dir, filename))
+        print(f'{filename}: {count}枚')
+        # 次の画像の前にデコード結果を破棄してメモリを空ける
+        image_cache.clear()
+
+
+if __name__ == '__main__':
+    main()